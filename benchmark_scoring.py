@@ -0,0 +1,299 @@
+## Offline microbenchmarks of scoring and building collections on synthetic data,
+## no server or MongoDB needed. Results are written as JSON and optionally
+## compared against a baseline to catch performance regressions.
+## Usage: python benchmark_scoring.py -o bench.json [--baseline baseline.json]
+## Absolute timings depend on the machine, so no baseline is committed: save one
+## with -o from a known good commit. Each run also times a fixed calibration 
+## workload, and the medians of the baseline are scaled by the ratio of the 
+## calibration times before comparing, which accounts for a different speed of
+## the machine. The hardware is recorded with the results, comparisons across 
+## different hardware only warn about it since the scaling is approximate.
+import os, sys, json
+import time
+import platform
+import argparse
+import multiprocessing
+
+import numpy as np
+import scipy
+import scipy.sparse as sp
+
+# import matrix_ops directly, importing the creeds package connects to the DB
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), 'creeds'))
+from matrix_ops import (simulate_matrix, fast_jaccard, fast_signed_jaccard,
+	bitset_signed_jaccard, top_k_indices, pack_rows, gene_index_matrices)
+
+parser = argparse.ArgumentParser(description='Offline microbenchmarks of CREEDS scoring')
+parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000],
+	help='numbers of signatures in the synthetic collections, 1M signatures take '
+	'about 12 GB of memory with their bitsets')
+parser.add_argument('--query-sizes', type=int, nargs='+', default=[10, 100, 300, 1000],
+	help='numbers of up (and down) genes of the queries')
+parser.add_argument('--n-genes', type=int, default=20000)
+parser.add_argument('--n-genes-per-sig', type=int, default=300,
+	help='number of up (and down) genes of each signature')
+parser.add_argument('--build-sizes', type=int, nargs='+', default=[10000, 100000],
+	help='numbers of signatures of the collections assembled from gene indexes, '
+	'their gene indexes take about 12 KB per signature')
+parser.add_argument('--repeats', type=int, default=50)
+parser.add_argument('--build-repeats', type=int, default=5)
+parser.add_argument('--warmup', type=int, default=3,
+	help='number of untimed runs before the timed runs')
+parser.add_argument('--time-budget', type=float, default=10.,
+	help='seconds after which the untimed or the timed runs of a benchmark stop, '
+	'at least 3 runs are timed')
+parser.add_argument('--top-k', type=int, default=100)
+parser.add_argument('--seed', type=int, default=42)
+parser.add_argument('-o', '--out', default=None, help='output .json file, stdout if omitted')
+parser.add_argument('--baseline', default=None, help='.json file of previous results')
+parser.add_argument('--tolerance', type=float, default=0.2,
+	help='max relative increase of the median time before failing')
+parser.add_argument('--noise-floor', type=float, default=0.002,
+	help='min increase of the median time (seconds) before failing')
+
+
+def timings(func, repeats, warmup=0, budget=None):
+	## run func `warmup` times untimed to warm up caches and allocators,
+	## then `repeats` times, return the seconds of each timed run. 
+	## The runs of slow benchmarks stop once they took `budget` seconds, 
+	## so the number of runs adapts to the time of each run
+	start = time.time()
+	for _ in xrange(warmup):
+		func()
+		if budget is not None and time.time() - start > budget:
+			break
+	seconds = []
+	for _ in xrange(repeats):
+		start = time.time()
+		func()
+		seconds.append(time.time() - start)
+		if budget is not None and len(seconds) >= 3 and sum(seconds) > budget:
+			break
+	return np.array(seconds)
+
+
+def hardware():
+	## the processor, number of cpus and memory of this machine
+	processor = platform.processor()
+	if os.path.isfile('/proc/cpuinfo'):
+		for line in open('/proc/cpuinfo'):
+			if line.startswith('model name'):
+				processor = line.split(':', 1)[1].strip()
+				break
+	memory = None
+	if hasattr(os, 'sysconf') and 'SC_PHYS_PAGES' in os.sysconf_names:
+		memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+	return {
+		'machine': platform.machine(),
+		'processor': processor,
+		'cpu_count': multiprocessing.cpu_count(),
+		'memory': memory,
+		}
+
+
+def calibration(args):
+	## a fixed workload of sorting and sparse products, unrelated to the code
+	## under test, timing the speed of the machine
+	rs = np.random.RandomState(0)
+	values = rs.rand(10 ** 6)
+	mat = sp.random(20000, 20000, density=1e-3, format='csr', random_state=rs)
+	vec = rs.rand(20000)
+	def func():
+		np.sort(values)
+		mat.dot(vec)
+	seconds = timings(func, args.repeats, args.warmup, args.time_budget)
+	return summarize('calibration', seconds, 1)
+
+
+def summarize(name, seconds, n_items, **params):
+	## statistics of the timings, throughput is the number of items per second
+	p50, p90, p99 = np.percentile(seconds, [50, 90, 99])
+	result = {
+		'name': name,
+		'repeats': len(seconds),
+		'mean': float(seconds.mean()),
+		'min': float(seconds.min()),
+		'p50': float(p50),
+		'p90': float(p90),
+		'p99': float(p99),
+		'throughput': float(n_items / p50) if p50 > 0 else None,
+		}
+	result.update(params)
+	return result
+
+
+def result_key(result):
+	## identify a benchmark by its name and parameters
+	return tuple(sorted((key, val) for key, val in result.items()
+		if key in ('name', 'n_signatures', 'query_size')))
+
+
+def csr_nbytes(mat):
+	## bytes of the arrays of a sparse matrix
+	return mat.data.nbytes + mat.indices.nbytes + mat.indptr.nbytes
+
+
+def random_query(n_genes, size):
+	## binary vectors of `size` distinct up and down genes
+	genes = np.random.choice(n_genes, size * 2, replace=False)
+	vec_up = np.zeros(n_genes, dtype=np.int8)
+	vec_dn = np.zeros(n_genes, dtype=np.int8)
+	vec_up[genes[:size]] = 1
+	vec_dn[genes[size:]] = 1
+	return vec_up, vec_dn
+
+
+def random_gene_indexes(n_sigs, n_genes, n_genes_per_sig):
+	## (idx_cs, idx_i, vals) of each signature as returned by
+	## DBSignature.get_gene_indexes_and_clear: at most `n_genes_per_sig` up
+	## and down genes, with a few case variants sharing an idx_i and a few
+	## missing genes
+	gene_indexes = []
+	for _ in xrange(n_sigs):
+		idx_cs = np.unique(np.random.randint(0, n_genes, n_genes_per_sig * 2))
+		np.random.shuffle(idx_cs)
+		idx_i = idx_cs.copy()
+		idx_i[:5] = idx_i[5:10]
+		idx_i[-5:] = -1
+		idx_cs[-10:-5] = -1
+		vals = np.random.rand(len(idx_cs)).astype(np.float32) + 0.1
+		vals[len(idx_cs) // 2:] *= -1
+		gene_indexes.append((idx_cs, idx_i, vals))
+	return gene_indexes
+
+
+def serialize_results(uids, rows, scores):
+	## format and serialize results as in SignatureMatrices.result_meta
+	scores = np.round(scores.astype(np.float64), 5).tolist()
+	return json.dumps([{'id': uid, 'geo_id': None, 'name': [uid, None],
+		'signed_jaccard': score} for uid, score in zip(uids[rows].tolist(), scores)])
+
+
+def run_benchmarks(args):
+	results = [calibration(args)]
+	for n_sigs in args.build_sizes:
+		np.random.seed(args.seed)
+		print >> sys.stderr, 'Assembling collection of %d signatures' % n_sigs
+		# the COO to CSR assembly used by DBSignatureCollection
+		gene_indexes = random_gene_indexes(n_sigs, args.n_genes, args.n_genes_per_sig)
+		seconds = timings(lambda: gene_index_matrices(gene_indexes, args.n_genes,
+			args.n_genes), args.build_repeats, min(args.warmup, 1), args.time_budget)
+		results.append(summarize('build_csr', seconds, n_sigs, n_signatures=n_sigs))
+		gene_indexes = None
+
+	for n_sigs in args.sizes:
+		np.random.seed(args.seed)
+		print >> sys.stderr, 'Simulating collection of %d signatures' % n_sigs
+		mat_up, _ = simulate_matrix(n_sigs, args.n_genes, args.n_genes_per_sig)
+		mat_dn, _ = simulate_matrix(n_sigs, args.n_genes, args.n_genes_per_sig)
+		seconds = timings(lambda: (mat_up.tocsc(), mat_dn.tocsc()),
+			args.build_repeats, min(args.warmup, 1), args.time_budget)
+		results.append(summarize('build_csc', seconds, n_sigs, n_signatures=n_sigs,
+			nbytes=sum(csr_nbytes(mat) for mat in (mat_up, mat_dn))))
+		seconds = timings(lambda: (pack_rows(mat_up), pack_rows(mat_dn)),
+			args.build_repeats, min(args.warmup, 1), args.time_budget)
+		bits_up, bits_dn = pack_rows(mat_up), pack_rows(mat_dn)
+		results.append(summarize('build_bitset', seconds, n_sigs, n_signatures=n_sigs,
+			nbytes=bits_up.nbytes + bits_dn.nbytes))
+		sizes_up, sizes_dn = mat_up.getnnz(axis=1), mat_dn.getnnz(axis=1)
+		uids = np.array(['sig:%d' % i for i in xrange(n_sigs)], dtype=object)
+
+		for query_size in args.query_sizes:
+			vec_up, vec_dn = random_query(args.n_genes, query_size)
+			params = dict(n_signatures=n_sigs, query_size=query_size)
+			seconds = timings(lambda: fast_jaccard(mat_up, vec_up),
+				args.repeats, args.warmup, args.time_budget)
+			results.append(summarize('fast_jaccard', seconds, n_sigs, **params))
+			seconds = timings(lambda: fast_signed_jaccard(mat_up, mat_dn, vec_up, vec_dn),
+				args.repeats, args.warmup, args.time_budget)
+			results.append(summarize('fast_signed_jaccard', seconds, n_sigs, **params))
+			# faster than the csr matrices for ~20 genes, 2-6 times slower for 
+			# 300-1000 genes, the time budget bounds its runs on large collections
+			seconds = timings(lambda: bitset_signed_jaccard(bits_up, bits_dn, 
+				sizes_up, sizes_dn, vec_up, vec_dn), args.repeats, args.warmup,
+				args.time_budget)
+			results.append(summarize('bitset_signed_jaccard', seconds, n_sigs, **params))
+
+			scores = fast_signed_jaccard(mat_up, mat_dn, vec_up, vec_dn)
+			seconds = timings(lambda: top_k_indices(np.abs(scores), args.top_k),
+				args.repeats, args.warmup, args.time_budget)
+			results.append(summarize('top_k', seconds, n_sigs, **params))
+			seconds = timings(lambda: np.abs(scores).argsort()[::-1],
+				args.repeats, args.warmup, args.time_budget)
+			results.append(summarize('full_sort', seconds, n_sigs, **params))
+
+			rows = top_k_indices(np.abs(scores), args.top_k)
+			seconds = timings(lambda: serialize_results(uids, rows, scores[rows]),
+				args.repeats, args.warmup, args.time_budget)
+			results.append(summarize('serialize_top_k', seconds, len(rows), **params))
+		# release the matrices before building the next collection
+		mat_up = mat_dn = bits_up = bits_dn = None
+	return results
+
+
+def compare(output, baseline, tolerance, noise_floor):
+	## compare the median times with those of the baseline scaled by the ratio 
+	## of the calibration times, return the regressions: the medians slower 
+	## than the scaled ones by more than both `tolerance` and `noise_floor`
+	if baseline['meta'].get('hardware') != output['meta']['hardware']:
+		print >> sys.stderr, 'Warning: the baseline was run on other hardware: %s' % \
+			baseline['meta'].get('hardware')
+	d_baseline = {result_key(result): result for result in baseline['results']}
+	results = output['results']
+	base_calibration = d_baseline.get(result_key(results[0]))
+	if base_calibration is None:
+		raise ValueError('The baseline has no calibration, regenerate it')
+	scale = results[0]['p50'] / base_calibration['p50']
+	print >> sys.stderr, 'Calibration: %.6f s, %.2f times the baseline' % (
+		results[0]['p50'], scale)
+
+	regressions = []
+	print >> sys.stderr, '%-22s %12s %10s %12s %12s %8s' % ('benchmark',
+		'signatures', 'query', 'scaled p50', 'p50', 'ratio')
+	for result in results[1:]:
+		base = d_baseline.get(result_key(result))
+		if base is None:
+			continue
+		expected = base['p50'] * scale
+		ratio = result['p50'] / expected if expected > 0 else float('inf')
+		flag = ''
+		if ratio > 1 + tolerance and result['p50'] - expected > noise_floor:
+			regressions.append(result)
+			flag = 'REGRESSION'
+		print >> sys.stderr, '%-22s %12d %10s %12.6f %12.6f %8.2f %s' % (result['name'],
+			result['n_signatures'], result.get('query_size', '-'),
+			expected, result['p50'], ratio, flag)
+	return regressions
+
+
+if __name__ == '__main__':
+	args = parser.parse_args()
+	results = run_benchmarks(args)
+	output = {
+		'meta': {
+			'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+			'python': platform.python_version(),
+			'numpy': np.__version__,
+			'scipy': scipy.__version__,
+			'hardware': hardware(),
+			'n_genes': args.n_genes,
+			'n_genes_per_sig': args.n_genes_per_sig,
+			'repeats': args.repeats,
+			'build_repeats': args.build_repeats,
+			'warmup': args.warmup,
+			'time_budget': args.time_budget,
+			'seed': args.seed,
+			},
+		'results': results,
+		}
+	if args.out is None:
+		json.dump(output, sys.stdout, indent=2)
+	else:
+		json.dump(output, open(args.out, 'w'), indent=2)
+
+	if args.baseline is not None:
+		regressions = compare(output, json.load(open(args.baseline)), args.tolerance,
+			args.noise_floor)
+		if regressions:
+			print >> sys.stderr, '%d benchmarks slower than the baseline' % len(regressions)
+			sys.exit(1)
@@ -1,6 +1,10 @@
 '''
 Config objects.
 '''
+import os
+
+# directory of this file, the root of the repo
+BASE_DIR = os.path.dirname(os.path.realpath(__file__))
 
 class Config(object):
 	"""Default configs"""
@@ -9,7 +13,8 @@ class Config(object):
 	DATABASE_URI = 'mongodb://127.0.0.1:27017/'
 	HOST = '127.0.0.1'
 	PORT = 5000
-	# list of kwargs for DBSignatureCollection globals
+	# list of kwargs for DBSignatureCollection globals,
+	# 'lsh' builds MinHash/LSH tables at load for queries with mode='approx'
 	DBSC_PARAMS = [
 		{
 			'filter_': {'$and':[ 
@@ -31,16 +36,83 @@ class Config(object):
 				{'chdir_sva_exp2': {'$exists': True}},
 				{'version': '2.0'},
 			]},
-			'name': 'p1.0', 'name_prefix': 'Automatic'
+			'name': 'p1.0', 'name_prefix': 'Automatic',
+			'lsh': {'n_hashes': 128, 'n_bands': 64}
 			}
 	]
+	# number of worker processes scoring shards of the collections in parallel, 
+	# 0 to score in the request thread
+	SCORING_WORKERS = 0
+	SCORING_SHARDS_PER_WORKER = 1
+	# where the shards are memory-mapped from, the workers share their pages in
+	# the page cache. A dir under /dev/shm keeps them in RAM, but the shards of 
+	# the full DB need a larger /dev/shm than Docker's default 64MB 
+	# (docker run --shm-size)
+	SCORING_SHARD_DIR = os.path.join(BASE_DIR, 'shards')
+	# max total bytes of cached stacked matrices for multi-version queries
+	STACKED_CACHE_SIZE = 2e9
+	# max total bytes (as JSON) of cached query results of saved signatures
+	RESULT_CACHE_SIZE = 2e8
+	# whether to also save the query results with the signatures in the DB,
+	# off by default as it makes every POST /search write to the DB
+	RESULT_CACHE_PERSIST = False
+	# max number of results in a saved page, and max number of pages saved
+	# with each signature
+	RESULT_PERSIST_MAX_ROWS = 1000
+	RESULT_PERSIST_MAX_PAGES = 20
+	# max number of signatures in a batch query, max top_k of each of them and
+	# max number of up (and down) genes of each of them
+	BATCH_MAX_SIGNATURES = 100
+	BATCH_MAX_TOP_K = 1000
+	BATCH_MAX_GENES = 2000
+	# number of query results serialized at a time in streamed responses
+	RESULT_STREAM_CHUNK_SIZE = 1000
+	# max total bytes of cached serialized signatures for /api
+	API_CACHE_SIZE = 5e7
+	# max number of ids retrieved at once from /api, and max number of genes
+	# of each signature
+	API_MAX_IDS = 1000
+	API_MAX_TOPN = 2000
+	# max number of signatures found by a string search
+	SEARCH_MAX_LIMIT = 1000
+	# seconds clients may cache the full autocomplete list
+	AUTOCOMPLETE_MAX_AGE = 3600
+	# max number of names completing a prefix
+	AUTOCOMPLETE_MAX_LIMIT = 100
+	# max total bytes of cached clustergrams as JSON
+	CLUSTERGRAM_CACHE_SIZE = 1e8
+	# where snapshots of DBSC instances are saved for fast start up, None to disable
+	SNAPSHOT_DIR = os.path.join(BASE_DIR, 'snapshots')
+	# seconds between checks for changed documents of DBSC instances, 0 to disable
+	REFRESH_INTERVAL = 0
+	# seconds to wait for other apps (PAEA and L1000CDS2) and the number of retries
+	# of failed connections, posts reaching the apps are not retried
+	HTTP_TIMEOUT = 10
+	HTTP_RETRIES = 2
+	HTTP_POOL_SIZE = 10
+	PAEA_POST_URL = 'http://amp.pharm.mssm.edu/Enrichr/addList'
+	PAEA_BASE_URL = 'http://amp.pharm.mssm.edu/PAEA?id='
+	CDS2_POST_URL = 'http://amp.pharm.mssm.edu/L1000CDS2/query'
+	CDS2_BASE_URL = 'http://amp.pharm.mssm.edu/L1000CDS2/#/result/'
+	# max total bytes of cached urls of signatures posted to other apps
+	APP_URL_CACHE_SIZE = 1e7
+	# uids of signatures to post to other apps in the background at start up,
+	# and the number of the most requested ones to post again after refreshes
+	APP_URL_PREFETCH_IDS = []
+	APP_URL_PREFETCH_TOP = 0
+	# whether to time the stages of handling requests for /metrics
+	METRICS_ENABLED = True
 	# whether to generate files for downloading from DBSC instances
 	MAKE_DOWNLOAD_FILES = True
+	# number of processes writing download files in parallel
+	DOWNLOAD_FILE_WORKERS = 3
 
 
 class ProductionConfig(Config):
 	DATABASE_URI = 'mongodb://146.203.54.131:27017/'
 	HOST = '0.0.0.0'
+	SCORING_WORKERS = 2
+	REFRESH_INTERVAL = 600
 
 
 class DevelopmentConfig(Config):
@@ -48,6 +120,8 @@ class DevelopmentConfig(Config):
 
 
 class TestingConfig(DevelopmentConfig):
+	# tests of snapshots use temporary dirs
+	SNAPSHOT_DIR = None
 	DBSC_PARAMS = [
 		{
 			'filter_': {'$and':[ 
@@ -72,7 +146,8 @@ class TestingConfig(DevelopmentConfig):
 				{'version': '2.0'},
 				{'id': {'$in': ['gene:P9030', 'dz:P1814', 'drug:P2341']}}
 			]},
-			'name': 'p1.0', 'name_prefix': 'Automatic'
+			'name': 'p1.0', 'name_prefix': 'Automatic',
+			'lsh': {'n_hashes': 128, 'n_bands': 64}
 			}
 	]
 
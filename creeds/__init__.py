@@ -6,6 +6,8 @@ os.environ['TZ'] = 'US/Eastern'
 time.tzset()
 
 import logging
+import mimetypes
+import threading
 from collections import OrderedDict
 
 import clustergram
@@ -22,7 +24,7 @@ class CIRule(Rule):
 		self._regex = re.compile(self._regex.pattern, 
 			re.UNICODE | re.IGNORECASE)
 
-from flask import (Flask, request, Response, send_from_directory)
+from flask import (Flask, request, Response, send_from_directory, safe_join)
 
 class CIFlask(Flask):
     url_rule_class = CIRule
@@ -42,6 +44,8 @@ conn = MongoClient(app.config['DATABASE_URI'])
 # Import models and utils
 from .orm import *
 from .utils import *
+from . import executor
+from . import streaming
 
 app.logger.setLevel(logging.INFO)
 
@@ -54,10 +58,99 @@ if not app.debug:
 	
 
 
+def get_page_params(params):
+	## parse the paging parameters of query results from a dict-like object,
+	## return None if they are not numbers or top_k or offset is negative
+	try:
+		top_k = params.get('top_k', None)
+		if top_k is not None:
+			top_k = int(top_k)
+		min_abs_score = float(params.get('min_abs_score', 0))
+		offset = int(params.get('offset', 0))
+	except (TypeError, ValueError):
+		return None
+	if (top_k is not None and top_k < 0) or offset < 0 or \
+		min_abs_score != min_abs_score: # nan
+		return None
+	return dict(top_k=top_k, min_abs_score=min_abs_score, offset=offset)
+
+
+def get_limit(params, default, max_limit, key='limit'):
+	## parse the max number of items to respond with from `key` of a dict-like
+	## object, capped at `max_limit`, return None if it is not a positive integer
+	try:
+		limit = int(params.get(key, default))
+	except (TypeError, ValueError):
+		return None
+	if limit <= 0:
+		return None
+	return min(limit, max_limit)
+
+
+def valid_db_version(db_version):
+	## whether db_version is the name of a collection, or a list of them
+	if type(db_version) != list:
+		db_version = [db_version]
+	return len(db_version) > 0 and \
+		all(isinstance(name, basestring) and name in d_dbsc for name in db_version)
+
+
+def valid_gene_vals(gene_vals):
+	## whether gene_vals is a list of [gene, value] pairs of a gene symbol 
+	## and a finite number (not nan, inf or too large for a float)
+	if type(gene_vals) != list:
+		return False
+	for pair in gene_vals:
+		if type(pair) != list or len(pair) != 2:
+			return False
+		gene, val = pair
+		if not isinstance(gene, basestring) or type(val) not in (int, long, float) \
+			or not abs(val) <= sys.float_info.max:
+			return False
+	return True
+
+
+def valid_gene_list(genes, max_len):
+	## whether genes is a list of at most `max_len` gene symbols
+	return type(genes) == list and len(genes) <= max_len and \
+		all(isinstance(gene, basestring) for gene in genes)
+
+
+def query_results_response(sig, params):
+	'''
+	Respond with the query results of sig for the paging parameters. 
+	If params has 'stream' set to 'json' or 'ndjson', the results are streamed
+	in chunks as a JSON array or newline delimited JSON, gzipped if the client
+	accepts it.
+	'''
+	page_params = get_page_params(params)
+	if page_params is None: # bad request
+		return ('', 400, '')
+	stream = params.get('stream', None)
+	if stream not in ('json', 'ndjson'):
+		json_str = sig.get_query_results_json(d_dbsc, **page_params)
+		return Response(json_str, mimetype='application/json')
+
+	chunks = sig.iter_query_results(d_dbsc, 
+		chunk_size=app.config.get('RESULT_STREAM_CHUNK_SIZE', 1000), 
+		**page_params)
+	if stream == 'json':
+		pieces = streaming.json_array_pieces(chunks)
+		mimetype = 'application/json'
+	else:
+		pieces = streaming.ndjson_pieces(chunks)
+		mimetype = 'application/x-ndjson'
+	headers = {'Vary': 'Accept-Encoding'}
+	if 'gzip' in request.accept_encodings:
+		pieces = streaming.gzip_pieces(pieces)
+		headers['Content-Encoding'] = 'gzip'
+	return Response(pieces, mimetype=mimetype, headers=headers)
+
+
 @app.before_first_request
 def load_globals():
 	# Load globals DBSignatureCollection instances
-	global d_dbsc
+	global d_dbsc, uid_index, name_index
 	d_dbsc = OrderedDict() # {name : DBSignatureCollection instance}
 	
 	app.logger.info('# signatures: %d, # genes(s): %d, # genes(i) : %d' \
@@ -72,48 +165,201 @@ def load_globals():
 		app.logger.info('%s\t%d\t%.2f' % (collection_name, 
 			len(d_dbsc[collection_name]), 
 			sys.getsizeof(d_dbsc[collection_name])/1e6))
+		invalidate_query_results(d_dbsc[collection_name])
+		if d_dbsc[collection_name].lsh_params is not None:
+			app.logger.info('%s\tLSH recall at jaccard 0.05, 0.1, 0.2, 0.5: %s' % (collection_name,
+				d_dbsc[collection_name].lsh_recall([0.05, 0.1, 0.2, 0.5]).round(3).tolist()))
 
 	app.logger.info('DBSignatureCollections loaded')
+	uid_index = build_uid_index(d_dbsc) # {uid: (DBSignatureCollection instance, row)}
+	name_index = build_name_index(d_dbsc)
+
+	if app.config['SCORING_WORKERS'] > 0:
+		# score shards of the collections in parallel worker processes
+		scorer = executor.init_scorer(app.config['SCORING_WORKERS'], 
+			app.config['SCORING_SHARD_DIR'], 
+			shards_per_worker=app.config['SCORING_SHARDS_PER_WORKER'])
+		for dbsc in d_dbsc.values():
+			scorer.register(dbsc)
+			# remove the shards left by previous runs of the app
+			scorer.retire(dbsc.name, dbsc.generation)
+		app.logger.info('Sharded scoring enabled with %d workers' % scorer.n_workers)
 	
 	if app.config['MAKE_DOWNLOAD_FILES']:
 		for dbsc in d_dbsc.values():
 			dbsc.make_all_download_files()
 
+	if app.config['APP_URL_PREFETCH_IDS']:
+		start_prefetch(app.config['APP_URL_PREFETCH_IDS'])
+
+	if app.config['REFRESH_INTERVAL'] > 0:
+		poller = threading.Thread(target=poll_collections, 
+			args=(app.config['REFRESH_INTERVAL'],))
+		poller.daemon = True
+		poller.start()
 	return
 
 
+def refresh_collections():
+	## swap new generations of the collections with changed documents into d_dbsc
+	global uid_index, name_index
+	if genes_changed():
+		app.logger.warning('Genes changed in the DB, restart to reload all collections')
+		return
+	refreshed = False
+	for collection_name, dbsc in d_dbsc.items():
+		new_dbsc = dbsc.refresh()
+		if new_dbsc is None:
+			continue
+		if executor.SCORER is not None:
+			executor.SCORER.register(new_dbsc)
+		# replacing the item is atomic, queries in flight keep the old generation
+		d_dbsc[collection_name] = new_dbsc
+		if executor.SCORER is not None:
+			# shards of the old generation are removed once no query uses them
+			executor.SCORER.retire(collection_name, new_dbsc.generation)
+		invalidate_query_results(new_dbsc)
+		if app.config['MAKE_DOWNLOAD_FILES']:
+			new_dbsc.make_all_download_files()
+		app.logger.info('%s refreshed\t%d -> %d' % (collection_name, 
+			len(dbsc), len(new_dbsc)))
+		refreshed = True
+	if refreshed:
+		# stacked groups of the new generations, built here rather than by queries
+		DBSignatureCollectionGroup.rebuild(d_dbsc)
+		uid_index = build_uid_index(d_dbsc)
+		refresh_all_uids()
+		name_index = build_name_index(d_dbsc)
+		if app.config['APP_URL_PREFETCH_TOP'] > 0:
+			# urls of the changed collections are no longer cached
+			with APP_URL_HITS_LOCK:
+				top_hits = APP_URL_HITS.most_common(app.config['APP_URL_PREFETCH_TOP'])
+			start_prefetch([uid for uid, _ in top_hits])
+	return
+
+
+def start_prefetch(uids):
+	## post signatures to other apps in a background thread to cache their urls
+	prefetcher = threading.Thread(target=prefetch_app_urls, args=(uids, uid_index))
+	prefetcher.daemon = True
+	prefetcher.start()
+	return prefetcher
+
+
+def poll_collections(interval):
+	## refresh the collections every `interval` seconds
+	while True:
+		time.sleep(interval)
+		try:
+			refresh_collections()
+		except Exception:
+			app.logger.exception('Failed to refresh DBSignatureCollections')
+
+
+@app.before_request
+def start_request_metrics():
+	METRICS.start_request()
+
+
+@app.after_request
+def end_request_metrics(response):
+	## record the latency of the request, and report its stages to the client
+	stages = METRICS.end_request(request.endpoint or 'unknown')
+	if stages:
+		response.headers['Server-Timing'] = ', '.join('%s;dur=%.2f' % (name, seconds * 1000) 
+			for name, seconds in stages)
+	return response
+
+
+def collection_metrics():
+	## number of signatures and memory of the collections, collected by METRICS
+	collections = d_dbsc.values() if 'd_dbsc' in globals() else []
+	for dbsc in collections:
+		# sizes are computed once for each generation
+		key = (dbsc.name, dbsc.generation)
+		if key not in COLLECTION_SIZES:
+			for stale_key in [k for k in COLLECTION_SIZES if k[0] == dbsc.name]:
+				del COLLECTION_SIZES[stale_key]
+			COLLECTION_SIZES[key] = sys.getsizeof(dbsc)
+	return [
+		('collection_signatures', 'gauge', 'Number of signatures in the collections', 
+			[({'collection': dbsc.name}, len(dbsc)) for dbsc in collections]),
+		('collection_bytes', 'gauge', 'Memory used by the collections', 
+			[({'collection': dbsc.name}, COLLECTION_SIZES.get((dbsc.name, dbsc.generation), 0)) 
+				for dbsc in collections]),
+		]
+
+COLLECTION_SIZES = {} # {(name, generation): bytes}
+METRICS.register_collector(collection_metrics)
+
+
+@app.route(ENTER_POINT + '/metrics', methods=['GET'])
+def send_metrics():
+	## metrics of the app in the Prometheus text format
+	return Response(METRICS.render(), content_type='text/plain; version=0.0.4')
+
+
 @app.route(ENTER_POINT + '/')
 def root():
 	return app.send_static_file('index.html')
 
 
-@app.route(ENTER_POINT + '/api', methods=['GET'])
+@app.route(ENTER_POINT + '/api', methods=['GET', 'POST'])
 @crossdomain(origin='*')
 def retrieve_signature():
-	## to retrieve data and meta data given id of signature like `gene:24`
+	## to retrieve data and meta data given id of signature like `gene:24`,
+	## or a list of ids with POST
 	if request.method == 'GET':
 		uid = request.args.get('id', '')
-		cutoff = request.args.get('topn', '') # number of genes to return
-		if cutoff == '':
-			cutoff = 600
-		else:
-			cutoff = int(cutoff)
+		# number of genes to return, 600 if missing or blank
+		topn = request.args.get('topn', '') or 600
+		cutoff = get_limit({'topn': topn}, 600, app.config['API_MAX_TOPN'], key='topn')
+		if cutoff is None: # bad request
+			return ('', 400, '')
 
-		if uid in ALL_UIDS:
-			sig = DBSignature(uid) # Signature instance
-			sig.init_cs_vectors(cutoff)
-			return Response(sig.to_json(meta_only=False), mimetype='application/json')
+		json_str = signature_json(uid, cutoff, uid_index)
+		if json_str is not None:
+			return Response(json_str, mimetype='application/json')
 		else: # bad request
 			return ('', 400, '')
 
+	elif request.method == 'POST':
+		data = json.loads(request.data)
+		if type(data) != dict:
+			return ('the body should be an object', 400, '')
+		uids = data.get('ids', [])
+		if type(uids) != list or not all(isinstance(uid, basestring) for uid in uids):
+			return ('ids should be a list of strings', 400, '')
+		if len(uids) > app.config['API_MAX_IDS']:
+			return ('ids should have at most %d items' % app.config['API_MAX_IDS'], 400, '')
+		cutoff = get_limit(data, 600, app.config['API_MAX_TOPN'], key='topn')
+		if cutoff is None:
+			return ('topn should be a positive integer', 400, '')
+		# null for unknown ids
+		json_strs = [signature_json(uid, cutoff, uid_index) or 'null' for uid in uids]
+		return Response('[' + ','.join(json_strs) + ']', mimetype='application/json')
+
 
 @app.route(ENTER_POINT + '/autoCompleteList', methods=['GET', 'POST'])
 @crossdomain(origin='*')
 def get_all_names():
-	## get a list of names for signatures in mongodb with chdir
+	## get a list of names for signatures in mongodb with chdir,
+	## or the names starting with `prefix`
 	if request.method == 'GET':
-		d_cat_names = make_autocomplete()
-		return json.dumps(d_cat_names)
+		autocomplete = get_autocomplete(d_dbsc.values())
+		prefix = request.args.get('prefix', None)
+		if prefix is not None:
+			limit = get_limit(request.args, 10, app.config['AUTOCOMPLETE_MAX_LIMIT'])
+			if limit is None: # bad request
+				return ('', 400, '')
+			return Response(json.dumps(autocomplete.complete(prefix, limit=limit)), 
+				mimetype='application/json')
+
+		resp = Response(autocomplete.json, mimetype='application/json')
+		resp.set_etag(autocomplete.etag)
+		resp.cache_control.public = True
+		resp.cache_control.max_age = app.config['AUTOCOMPLETE_MAX_AGE']
+		return resp.make_conditional(request)
 
 
 @app.route(ENTER_POINT + '/search', methods=['GET', 'POST'])
@@ -122,70 +368,128 @@ def search():
 	## handle searching signatures using string and query signatures with up/down genes 
 	if request.method == 'GET': # search signatures using string
 		search_string = request.args.get('q', '')
-		search_dict = {'$and': [
-			{'chdir_sva_exp2': {'$exists': True}},
-			{"incorrect": {"$ne": True}},
-			{"$or":[
-				{'hs_gene_symbol' : {"$regex": search_string, "$options":"i"}},
-				{'hs_gene_symbol' : {'$elemMatch': {'name': {"$regex": search_string, "$options":"i"}}}},
-				{'mm_gene_symbol' : {"$regex": search_string, "$options":"i"}},
-				{'disease_name' : {"$regex": search_string, "$options":"i"}},
-				{'disease_name' : {'$elemMatch': {'name': {"$regex": search_string, "$options":"i"}}}},
-				{'drug_name' : {"$regex": search_string, "$options":"i"}},
-				{'drug_name' : {'$elemMatch': {'name': {"$regex": search_string, "$options":"i"}}}},
-				]}
-		]}
+		limit = get_limit(request.args, app.config['SEARCH_MAX_LIMIT'], 
+			app.config['SEARCH_MAX_LIMIT'])
+		if limit is None: # bad request
+			return ('', 400, '')
+		prefix = request.args.get('prefix', 'false') == 'true'
 		
 		docs = []
-		for doc in COLL.find(search_dict, {'id':True,'_id':False}):
-			uid = doc['id']
-			sig = DBSignature(uid) # Signature instance
-			docs.append(sig.meta)
+		for dbsc, row in name_index.search(search_string, limit=limit, prefix=prefix):
+			docs.append(dbsc[dbsc.uids[row]].meta)
 
 		return Response(json.dumps(docs), mimetype='application/json')
 
 	elif request.method == 'POST': # search using custom up/dn gene list
 		data = json.loads(request.data)
-		up_genes = data['up_genes']
-		dn_genes = data['dn_genes']
+		up_genes = data.get('up_genes', None)
+		dn_genes = data.get('dn_genes', None)
+		gene_vals = data.get('genes', None) # [[gene, value]] for weighted metrics
+		if gene_vals is not None and not valid_gene_vals(gene_vals):
+			return ('', 400, '')
 
 		name = data.get('name', None)
 		meta = data.get('meta', None)
 		direction = data.get('direction', 'similar')
 		db_version = data.get('db_version', 'v1.0')
 		query_params = dict(direction=direction, db_version=db_version)
+		metric = data.get('metric', 'signed_jaccard')
+		if direction not in Signature.directions or not valid_db_version(db_version) or \
+			metric not in Signature.metrics or \
+			(metric != 'signed_jaccard' and not gene_vals) or \
+			(up_genes is None and dn_genes is None and not gene_vals):
+			return ('', 400, '')
+		if metric != 'signed_jaccard': # only add to query_params when not default
+			query_params['metric'] = metric
+		mode = data.get('mode', 'exact')
+		if mode == 'approx': # only add to query_params when not default
+			approx_bands = data.get('approx_bands', None)
+			# a positive number of the LSH bands to use, all of them if None
+			if approx_bands is not None and \
+				(type(approx_bands) not in (int, long) or approx_bands <= 0):
+				return ('', 400, '')
+			query_params['mode'] = mode
+			query_params['approx_bands'] = approx_bands
 		client = data.get('client', 'api')
 
-		sig = Signature(name, meta, up_genes, dn_genes, query_params)
+		sig = Signature(name, meta, up_genes, dn_genes, query_params, gene_vals=gene_vals)
 		if sig is None:
 			return ('', 400, '')
 		else:
 			# Save the user signature
-			h = sig.save()
+			with METRICS.stage('save_signature'):
+				h = sig.save()
 
 			if client == 'api': # perform the query only when client is api
-				sig.init_vectors()
-				uid_data = sig.get_query_results(d_dbsc)
-
-				return Response(json.dumps(uid_data), mimetype='application/json')
+				return query_results_response(sig, data)
 
 			else: # return the hash of the signature to front-end
 				return Response(json.dumps(h), mimetype='application/json')
 
 
+@app.route(ENTER_POINT + '/search/batch', methods=['POST'])
+@crossdomain(origin='*')
+def search_batch():
+	## query the DB with many up/down gene lists in one request
+	if request.method == 'POST':
+		try:
+			data = json.loads(request.data)
+		except ValueError:
+			data = None
+		if type(data) != dict:
+			return ('the body should be a JSON object', 400, '')
+		# defaults for all signatures in this batch
+		direction = data.get('direction', 'similar')
+		db_version = data.get('db_version', 'v1.0')
+		try:
+			top_k = int(data.get('top_k', 50))
+		except (TypeError, ValueError):
+			top_k = -1
+		if top_k < 0: # bad request
+			return ('top_k should be a non-negative integer', 400, '')
+		top_k = min(top_k, app.config['BATCH_MAX_TOP_K'])
+		signatures = data.get('signatures', [])
+		if type(signatures) != list:
+			return ('signatures should be a list', 400, '')
+		if len(signatures) > app.config['BATCH_MAX_SIGNATURES']:
+			return ('signatures should have at most %d items' % 
+				app.config['BATCH_MAX_SIGNATURES'], 400, '')
+
+		max_genes = app.config['BATCH_MAX_GENES']
+		sigs = []
+		for i, sig_data in enumerate(signatures):
+			if type(sig_data) != dict or \
+				not valid_gene_list(sig_data.get('up_genes', None), max_genes) or \
+				not valid_gene_list(sig_data.get('dn_genes', None), max_genes):
+				return ('signatures[%d] should have lists of at most %d up_genes and '
+					'dn_genes' % (i, max_genes), 400, '')
+			query_params = dict(direction=sig_data.get('direction', direction),
+				db_version=sig_data.get('db_version', db_version))
+			if not valid_db_version(query_params['db_version']):
+				return ('Unknown db_version of signatures[%d]' % i, 400, '')
+			if query_params['direction'] not in Signature.directions:
+				return ('Unknown direction of signatures[%d]' % i, 400, '')
+			sig = Signature(sig_data.get('name', None), sig_data.get('meta', None),
+				sig_data['up_genes'], sig_data['dn_genes'], query_params)
+			sigs.append(sig)
+
+		results = Signature.batch_query_results(sigs, d_dbsc, top_k=top_k)
+		return Response(json.dumps(results), mimetype='application/json')
+
+
 @app.route(ENTER_POINT + '/result', methods=['GET'])
 @crossdomain(origin='*')
 def result():
 	## retrieve a Signature using a hash, perform query, then return the result
 	if request.method == 'GET':
 		h = request.args.get('id', None)
-		sig = Signature.from_hash(h)
+		with METRICS.stage('load_signature'):
+			sig = Signature.from_hash(h)
 		if sig is None:
 			return ('', 400, '')
 		else:
-			sig.init_vectors()
-			uid_data = sig.get_query_results(d_dbsc)
-			return Response(json.dumps(uid_data), mimetype='application/json')
+			# vectors are only initialized when the results are not cached
+			return query_results_response(sig, request.args)
 
 
 @app.route(ENTER_POINT + '/download', methods=['GET'])
@@ -199,9 +503,17 @@ def send_download_meta():
 
 @app.route(ENTER_POINT + '/download/<path:filename>')
 def download_file(filename):
-	## safely send the file for download
-	return send_from_directory(SCRIPT_PATH+'/static/downloads', 
-		filename, as_attachment=True)
+	## safely send the file for download, the gzipped copy if the client accepts it
+	download_dir = SCRIPT_PATH+'/static/downloads'
+	if 'gzip' in request.accept_encodings and not filename.endswith('.gz') \
+		and os.path.isfile(safe_join(download_dir, filename + '.gz')):
+		resp = send_from_directory(download_dir, filename + '.gz', 
+			as_attachment=True, attachment_filename=filename,
+			mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+		resp.headers['Content-Encoding'] = 'gzip'
+		resp.headers['Vary'] = 'Accept-Encoding'
+		return resp
+	return send_from_directory(download_dir, filename, as_attachment=True)
 
 
 @app.route(ENTER_POINT + '/geneSigClustergram', methods=['POST'])
@@ -213,10 +525,18 @@ def make_gene_sig_clustergram():
 		genes = post_data.get('genes', '')
 		genes = map(lambda x: x.upper(), genes)
 		na_val = post_data.get('na_val', 0)
-		mat = get_matrix(uids, genes, na_val=na_val)
+		mat = get_matrix(uids, genes, uid_index, na_val=na_val)
+		# 'links' for the nodes and links of every cell, 
+		# 'compact' for the orders and the encoded flat array of values
+		compact = post_data.get('format', 'links') == 'compact'
+		encoding = post_data.get('encoding', 'float32')
+		if encoding not in ('float32', 'float16', 'uint8'):
+			return ('', 400, '')
+		optimal_ordering = bool(post_data.get('optimal_ordering', False))
 
-		json_data = clustergram.clustergram(mat, genes, uids)
-		return json.dumps(json_data)
+		json_str = get_clustergram_json(mat, genes, uids, 
+			optimal_ordering=optimal_ordering, compact=compact, encoding=encoding)
+		return Response(json_str, mimetype='application/json')
 
 
 @app.route(ENTER_POINT + '/appUrl', methods=['GET'])
@@ -226,14 +546,10 @@ def get_link():
 	if request.method == 'GET':
 		uid = request.args.get('id', '')
 		app_name = request.args.get('app', '')
-		url = None
-		if uid in ALL_UIDS:
-			sig = DBSignature(uid) # Signature instance
-			sig.init_cs_vectors(cutoff=2000)
-			if app_name == 'paea':
-				url = sig.post_to_paea(cutoff=2000)
-			elif app_name == 'cds2':
-				url = sig.post_to_cds2(cutoff=2000)
+		if uid in ALL_UIDS_SET:
+			with APP_URL_HITS_LOCK:
+				APP_URL_HITS[uid] += 1
+		url = get_app_url(uid, app_name, uid_index)
 		return json.dumps(url)	
 
 
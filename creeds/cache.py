@@ -0,0 +1,81 @@
+'''
+A thread safe in-process LRU cache bounded by the total size of its values.
+'''
+import sys
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+	'''
+	Least recently used cache. Items are evicted once the sum of `sizeof(value)`
+	exceeds `max_size` (in bytes), or once there are more than `max_items`.
+	'''
+	def __init__(self, max_size, max_items=None, sizeof=sys.getsizeof):
+		self.max_size = max_size
+		self.max_items = max_items
+		self.sizeof = sizeof
+		self.size = 0
+		self.hits = 0
+		self.misses = 0
+		self._data = OrderedDict() # {key: (value, size)}
+		self._lock = threading.RLock()
+
+	def __len__(self):
+		return len(self._data)
+
+	def __contains__(self, key):
+		return key in self._data
+
+	def keys(self):
+		## the keys from the least to the most recently used
+		with self._lock:
+			return list(self._data)
+
+	def get(self, key, default=None):
+		with self._lock:
+			if key in self._data:
+				value, size = self._data.pop(key)
+				self._data[key] = (value, size) # move to the most recent end
+				self.hits += 1
+				return value
+			self.misses += 1
+			return default
+
+	def set(self, key, value):
+		'''Add value to the cache, values larger than `max_size` are not kept.
+		'''
+		size = self.sizeof(value)
+		with self._lock:
+			self.pop(key)
+			if size > self.max_size:
+				return
+			self._data[key] = (value, size)
+			self.size += size
+			while self.size > self.max_size or \
+				(self.max_items is not None and len(self._data) > self.max_items):
+				_, (_, size_evicted) = self._data.popitem(last=False)
+				self.size -= size_evicted
+		return
+
+	def pop(self, key, default=None):
+		with self._lock:
+			if key in self._data:
+				value, size = self._data.pop(key)
+				self.size -= size
+				return value
+			return default
+
+	def invalidate(self, predicate):
+		'''Remove all items whose key satisfies `predicate(key)`.
+		'''
+		with self._lock:
+			for key in [key for key in self._data if predicate(key)]:
+				self.pop(key)
+		return
+
+	def clear(self):
+		with self._lock:
+			self._data.clear()
+			self.size = 0
+		return
@@ -1,15 +1,159 @@
 ## to do HC and output a json compatible with Nick's visualization
 
+import json
+import base64
+import hashlib
+
 import numpy as np
 import scipy.cluster.hierarchy as sch
 import scipy.spatial.distance as dist
 from scipy.stats import zscore
 
 
+def optimal_leaf_order(Y, d):
+	'''
+	Get the order of leaves of the linkage `Y` minimizing the sum of the 
+	distances `d` (condensed) between adjacent leaves, among the orders made by
+	flipping the children of the nodes (Bar-Joseph et al., 2001). 
+	For every node the lowest cost of each pair of its outermost leaves, one in
+	each child, is built bottom-up and the order is traced back from the root,
+	in O(n^3) time. scipy.cluster.hierarchy.optimal_leaf_ordering is missing
+	from the pinned scipy.
+	'''
+	n = Y.shape[0] + 1
+	leaves = sch.leaves_list(Y)
+	# distances between the leaves in the order of leaves_list, 
+	# in which the leaves of every node are contiguous
+	D = dist.squareform(d)[np.ix_(leaves, leaves)]
+	starts = np.empty(2*n - 1, dtype=np.int64)
+	starts[leaves] = np.arange(n)
+	sizes = np.ones(2*n - 1, dtype=np.int64)
+	children = Y[:, :2].astype(np.int64)
+	# {node: costs of orders from each leaf of the left child to each of the right}
+	costs = {}
+
+	def node_costs(node):
+		## costs of orders between each pair of leaves of the node
+		if node < n:
+			return np.zeros((1, 1))
+		n_left = sizes[children[node - n, 0]]
+		C = np.empty((sizes[node], sizes[node]))
+		C.fill(np.inf)
+		C[:n_left, n_left:] = costs[node]
+		C[n_left:, :n_left] = costs[node].T
+		return C
+
+	def split(node):
+		## costs within the children and distances between them
+		left, right = children[node - n]
+		start, n_left = starts[node], sizes[left]
+		D_lr = D[start:start+n_left, start+n_left:start+sizes[node]]
+		return left, right, node_costs(left), node_costs(right), D_lr
+
+	for i in xrange(n - 1):
+		node = n + i
+		left, right = children[i]
+		starts[node] = starts[left]
+		sizes[node] = sizes[left] + sizes[right]
+		_, _, C_left, C_right, D_lr = split(node)
+		# from a leaf of left to the leaf k ending it, then to the leaf m 
+		# starting right and to a leaf of right
+		T = np.empty(D_lr.shape)
+		T.fill(np.inf)
+		for k in xrange(D_lr.shape[0]):
+			np.minimum(T, C_left[:, k:k+1] + D_lr[k], out=T)
+		costs[node] = np.empty(D_lr.shape)
+		costs[node].fill(np.inf)
+		for m in xrange(D_lr.shape[1]):
+			np.minimum(costs[node], T[:, m:m+1] + C_right[m], out=costs[node])
+
+	root = 2*n - 2
+	first, last = np.unravel_index(np.argmin(costs[root]), costs[root].shape)
+	first, last = starts[root] + first, starts[root] + sizes[children[-1, 0]] + last
+	# (node, position of its first leaf, position of its last leaf)
+	stack = [(root, first, last)]
+	order = []
+	while stack:
+		node, first, last = stack.pop()
+		if node < n:
+			order.append(first)
+			continue
+		left, right, C_left, C_right, D_lr = split(node)
+		start, n_left = starts[node], sizes[left]
+		if first < start + n_left: # from left to right
+			a, b = first - start, last - start - n_left
+			cost = C_left[a][:, None] + D_lr + C_right[:, b][None, :]
+			k, m = np.unravel_index(np.argmin(cost), cost.shape)
+			k, m = start + k, start + n_left + m
+			stack.extend([(right, m, last), (left, first, k)])
+		else: # from right to left
+			a, b = first - start - n_left, last - start
+			cost = C_left[:, b][:, None] + D_lr + C_right[a][None, :]
+			k, m = np.unravel_index(np.argmin(cost), cost.shape)
+			k, m = start + k, start + n_left + m
+			stack.extend([(left, k, last), (right, first, m)])
+	return leaves[order]
+
+
+def cluster_order(data, metric='euclidean', method='average', optimal_ordering=False):
+	## get the order of leaves from hierarchical clustering of the rows of data,
+	## linkage is computed directly from the condensed distance matrix
+	if data.shape[0] < 2:
+		return np.arange(data.shape[0])
+	d = dist.pdist(data, metric=metric)
+	Y = sch.linkage(d, method=method)
+	if optimal_ordering:
+		return optimal_leaf_order(Y, d)
+	return sch.leaves_list(Y)
+
+
+def encode_values(values, encoding='float32', decimals=4):
+	'''
+	Encode an array of values in a compact JSON compatible form:
+	'float32': list of values rounded to `decimals`
+	'float16': base64 of little-endian float16 values
+	'uint8': base64 of values quantized into 256 levels,
+		decoded as `min` + `scale` * level
+	'''
+	values = np.asarray(values, dtype=np.float64).ravel()
+	if encoding == 'float32':
+		return {'encoding': encoding, 'data': np.round(values, decimals).tolist()}
+	elif encoding == 'float16':
+		return {'encoding': encoding,
+			'data': base64.b64encode(values.astype('<f2').tostring())}
+	elif encoding == 'uint8':
+		if len(values) > 0:
+			vmin, vmax = values.min(), values.max()
+		else:
+			vmin, vmax = 0., 0.
+		scale = (vmax - vmin) / 255.
+		if scale == 0:
+			scale = 1.
+		levels = np.round((values - vmin) / scale).astype(np.uint8)
+		return {'encoding': encoding, 'data': base64.b64encode(levels.tostring()),
+			'min': float(vmin), 'scale': float(scale)}
+	else:
+		raise ValueError('Unknown encoding: %s' % encoding)
+
+
+def clustergram_key(data, rids, cids, **kwargs):
+	## hash of the inputs of clustergram, used as the key to cache its outputs
+	h = hashlib.md5(np.ascontiguousarray(data, dtype=np.float64).tostring())
+	h.update(json.dumps([list(rids), list(cids), sorted(kwargs.items())]))
+	return h.hexdigest()
+
+
 def clustergram(data, rids, cids,
-	row_linkage='average', col_linkage='average', 
+	row_linkage='average', col_linkage='average',
 	row_pdist='euclidean', col_pdist='euclidean',
-	standardize=3, log=False):
+	standardize=3, log=False, optimal_ordering=False,
+	compact=False, encoding='float32'):
+	'''
+	Cluster the rows and columns of data.
+	By default returns the nodes and links of every cell for the visualization.
+	If `compact`, returns the names, the orders of rows and columns and the
+	values in their original row-major order encoded by `encode_values`.
+	'''
 	## preprocess data
 	if log:
 		data = np.log2(data + 1.0)
@@ -20,37 +164,40 @@ def clustergram(data, rids, cids,
 		data = zscore(data, axis=1)
 
 	## perform hierarchical clustering for rows and cols
-	## compute pdist for rows:
-	d1 = dist.pdist(data, metric=row_pdist)
-	D1 = dist.squareform(d1)
-	Y1 = sch.linkage(D1, method=row_linkage, metric=row_pdist)
-	Z1 = sch.dendrogram(Y1, orientation='right')
-	idx1 = Z1['leaves']
-
-	## compute pdist for cols
-	d2 = dist.pdist(data.T, metric=col_pdist)
-	D2 = dist.squareform(d2)
-	Y2 = sch.linkage(D2, method=col_linkage, metric=col_pdist)
-	Z2 = sch.dendrogram(Y2)
-	idx2 = Z2['leaves']
+	idx1 = cluster_order(data, metric=row_pdist, method=row_linkage,
+		optimal_ordering=optimal_ordering)
+	idx2 = cluster_order(data.T, metric=col_pdist, method=col_linkage,
+		optimal_ordering=optimal_ordering)
+
+	if compact:
+		json_data = {
+			'row_names': list(rids),
+			'col_names': list(cids),
+			'row_order': idx1.tolist(),
+			'col_order': idx2.tolist(),
+			'values': encode_values(data, encoding=encoding)
+			}
+		return json_data
 
 	row_nodes = []
-	rids = np.array(rids)[np.array(idx1)]
+	rids = np.array(rids)[idx1]
 	for idx, rid in enumerate(rids):
-		row_nodes.append({'sort': idx, 'name': rid})		
+		row_nodes.append({'sort': idx, 'name': rid})
 
 
 	col_nodes = []
-	cids = np.array(cids)[np.array(idx2)]
+	cids = np.array(cids)[idx2]
 	for idx, cid in enumerate(cids):
-		col_nodes.append({'sort': idx, 'name': cid})	
+		col_nodes.append({'sort': idx, 'name': cid})
 
 
+	# values in the same order as the nodes
+	data = data[np.ix_(idx1, idx2)]
 	links = []
 	for i in range(len(rids)):
 		for j in range(len(cids)):
 			links.append({'source': i, 'target': j, 'value': data[i,j]})
-	
+
 	json_data = {
 		'row_nodes':row_nodes,
 		'col_nodes':col_nodes,
@@ -70,5 +217,3 @@ def clustergram(data, rids, cids,
 # json_data = clustergram(data, rids, cids)
 # # print json_data
 # json.dump(json_data, open('data/test_clustergram.json', 'wb'))
-
-
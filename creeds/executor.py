@@ -0,0 +1,209 @@
+'''
+Multi-core scoring of DBSignatureCollections. The rows of the matrices of each
+collection are split into shards saved as .npy files under SCORING_SHARD_DIR,
+which worker processes memory-map so the pages are shared between them. 
+A query is scored on all the shards in parallel and the per-shard top results
+are merged. Shards of retired generations are deleted once no query uses them.
+'''
+import os
+import shutil
+import threading
+import multiprocessing
+from collections import deque
+
+import numpy as np
+
+from .matrix_ops import fast_signed_jaccard, top_k_indices, save_csr, load_csr
+
+## shards loaded by a worker process: {shard_dir: (mat_up, mat_dn)}
+_SHARDS = {}
+
+def _load_shard(shard_dir):
+	if shard_dir not in _SHARDS:
+		shape = tuple(np.load(os.path.join(shard_dir, 'shape.npy')))
+		_SHARDS[shard_dir] = (load_csr(os.path.join(shard_dir, 'up'), shape),
+			load_csr(os.path.join(shard_dir, 'dn'), shape))
+	return _SHARDS[shard_dir]
+
+
+def select_scores(scores, direction, k=None, min_abs_score=0):
+	'''Indices of the top `k` scores with the sign of `direction` and abs(score)
+	>= `min_abs_score`, in descending order of abs(score).
+	'''
+	if direction == 'similar':
+		mask = scores > 0
+	elif direction == 'opposite':
+		mask = scores < 0
+	else:
+		raise ValueError('Unknown direction: %s' % direction)
+	if min_abs_score > 0:
+		mask &= np.abs(scores) >= min_abs_score
+	idx = np.flatnonzero(mask)
+	return idx[top_k_indices(np.abs(scores[idx]), k)]
+
+
+def _score_shard(args):
+	## score a query against one shard in a worker process
+	shard_dir, offset, n_cols, up_idx, dn_idx, direction, k, min_abs_score, evict = args
+	# drop the shards of retired generations loaded by this worker
+	for old_dir in evict:
+		_SHARDS.pop(old_dir, None)
+	mat_up, mat_dn = _load_shard(shard_dir)
+	v_up = np.zeros(n_cols, dtype=np.int8)
+	v_up[up_idx] = 1
+	v_dn = np.zeros(n_cols, dtype=np.int8)
+	v_dn[dn_idx] = 1
+	scores = fast_signed_jaccard(mat_up, mat_dn, v_up, v_dn)
+	idx = select_scores(scores, direction, k, min_abs_score)
+	return idx + offset, scores[idx]
+
+
+class ShardedScorer(object):
+	'''
+	A pool of `n_workers` processes scoring the shards of registered
+	collections, saved under `shard_dir`. Shards of a generation are only 
+	removed once it is retired and no query is using them.
+	'''
+	def __init__(self, n_workers, shard_dir, shards_per_worker=1):
+		self.n_workers = n_workers
+		self.n_shards = n_workers * shards_per_worker
+		self.shard_dir = shard_dir
+		if not os.path.isdir(shard_dir):
+			os.makedirs(shard_dir)
+		self.shards = {} # {(name, generation): [(shard_dir, row offset)]}
+		self.in_use = {} # {(name, generation): number of queries using the shards}
+		self.retired = set() # (name, generation) to remove once not in use
+		# recently removed shard dirs, sent to the workers to drop them
+		self.evicted = deque(maxlen=1024)
+		self._lock = threading.RLock()
+		self.pool = multiprocessing.Pool(n_workers)
+
+	def register(self, dbsc):
+		'''Write the shards of a DBSignatureCollection. Shards of previous 
+		generations of the collection are kept until `retire` is called.
+		'''
+		key = (dbsc.name, dbsc.generation)
+		with self._lock:
+			if key in self.shards:
+				return
+
+		n_rows = dbsc.mat_up.shape[0]
+		bounds = np.linspace(0, n_rows, self.n_shards + 1).astype(int)
+		shards = []
+		for i, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+			shard_dir = os.path.join(self.shard_dir, '%s-%s-%d' % (key + (i,)))
+			if not os.path.isdir(shard_dir):
+				os.makedirs(shard_dir)
+			for direction, mat in (('up', dbsc.mat_up), ('dn', dbsc.mat_dn)):
+				save_csr(os.path.join(shard_dir, direction), mat[start:end])
+			np.save(os.path.join(shard_dir, 'shape.npy'), np.array([end - start, mat.shape[1]]))
+			shards.append((shard_dir, start))
+		with self._lock:
+			self.shards[key] = shards
+		return
+
+	def retire(self, name, generation):
+		'''Retire the shards of the generations of collection `name` other than
+		`generation`, they are removed once no query in flight uses them.
+		Shard dirs of other generations left in `shard_dir` by previous 
+		processes are removed right away.
+		'''
+		with self._lock:
+			for key in self.shards:
+				if key[0] == name and key[1] != generation:
+					self.retired.add(key)
+			self._collect()
+			known = set(shard_dir for shards in self.shards.values() 
+				for shard_dir, _ in shards)
+			for dirname in os.listdir(self.shard_dir):
+				shard_dir = os.path.join(self.shard_dir, dirname)
+				parts = dirname.rsplit('-', 2)
+				if len(parts) == 3 and parts[0] == name and parts[1] != generation \
+					and shard_dir not in known:
+					shutil.rmtree(shard_dir, ignore_errors=True)
+		return
+
+	def _collect(self):
+		## remove the shards of retired generations not in use
+		for key in [key for key in self.retired if self.in_use.get(key, 0) == 0]:
+			self.retired.discard(key)
+			self.in_use.pop(key, None)
+			for shard_dir, _ in self.shards.pop(key, []):
+				shutil.rmtree(shard_dir, ignore_errors=True)
+				self.evicted.append(shard_dir)
+		return
+
+	def _acquire(self, members):
+		## get the shards of the collections and mark them in use, 
+		## None if any of them is not registered
+		keys = [(dbsc.name, dbsc.generation) for dbsc in members]
+		with self._lock:
+			shards = [self.shards.get(key) for key in keys]
+			if any(member_shards is None for member_shards in shards):
+				return None
+			for key in keys:
+				self.in_use[key] = self.in_use.get(key, 0) + 1
+		return shards
+
+	def _release(self, members):
+		with self._lock:
+			for dbsc in members:
+				self.in_use[(dbsc.name, dbsc.generation)] -= 1
+			self._collect()
+		return
+
+	def has(self, db_sig_collection):
+		members = getattr(db_sig_collection, 'members', [db_sig_collection])
+		with self._lock:
+			return all((dbsc.name, dbsc.generation) in self.shards for dbsc in members)
+
+	def top_signed_jaccard(self, db_sig_collection, v_up, v_dn, direction='similar',
+		k=None, min_abs_score=0):
+		'''Score a query on all the shards of a DBSignatureCollection or
+		DBSignatureCollectionGroup in parallel. Return the rows of the top `k`
+		signatures (see `select_scores`) and their scores, or None if the 
+		shards of the collections are not registered (anymore).
+		'''
+		members = getattr(db_sig_collection, 'members', [db_sig_collection])
+		shards = self._acquire(members)
+		if shards is None:
+			return None
+		try:
+			up_idx = np.flatnonzero(v_up)
+			dn_idx = np.flatnonzero(v_dn)
+			n_cols = len(v_up)
+			evict = tuple(self.evicted)
+			tasks = []
+			offset = 0
+			for dbsc, member_shards in zip(members, shards):
+				for shard_dir, start in member_shards:
+					tasks.append((shard_dir, offset + start, n_cols, up_idx, dn_idx,
+						direction, k, min_abs_score, evict))
+				offset += dbsc.mat_up.shape[0]
+
+			results = self.pool.map(_score_shard, tasks)
+		finally:
+			self._release(members)
+		rows = np.concatenate([r for r, _ in results])
+		scores = np.concatenate([s for _, s in results])
+		srt_idx = top_k_indices(np.abs(scores), k)
+		return rows[srt_idx], scores[srt_idx]
+
+	def close(self):
+		self.pool.terminate()
+		self.pool.join()
+		for shards in self.shards.values():
+			for shard_dir, _ in shards:
+				shutil.rmtree(shard_dir, ignore_errors=True)
+		self.shards = {}
+
+
+## the ShardedScorer used by the app, if enabled in the config
+SCORER = None
+
+def init_scorer(n_workers, shard_dir, shards_per_worker=1):
+	global SCORER
+	if SCORER is not None:
+		SCORER.close()
+	SCORER = ShardedScorer(n_workers, shard_dir, shards_per_worker=shards_per_worker)
+	return SCORER
@@ -7,21 +7,31 @@ import numpy as np
 import scipy.sparse as sp
 
 
-def simulate_matrix(n_rows, n_cols, n_ones_per_row=300, sparse=True):
-	'''Simulate a sparse binary matrix and a binary vector. '''
+def simulate_matrix(n_rows, n_cols, n_ones_per_row=300, sparse=True, chunk_size=10000):
+	'''Simulate a sparse binary matrix and a binary vector. 
+	Each row has at most `n_ones_per_row` ones at columns drawn with replacement.
+	The indices are drawn `chunk_size` rows at a time and the csr_matrix is 
+	assembled directly, so simulating millions of rows is feasible.
+	'''
+	# sorted columns of the ones in each row
+	indices = np.empty((n_rows, n_ones_per_row), dtype=np.int32)
+	for start in xrange(0, n_rows, chunk_size):
+		end = min(start + chunk_size, n_rows)
+		indices[start:end] = np.random.randint(0, n_cols, size=(end - start, n_ones_per_row))
+	indices.sort(axis=1)
+	# drop repeated columns within rows
+	keep = np.ones(indices.shape, dtype=np.bool_)
+	keep[:, 1:] = indices[:, 1:] != indices[:, :-1]
+	indptr = np.zeros(n_rows + 1, dtype=np.int64)
+	np.cumsum(keep.sum(axis=1), out=indptr[1:])
+	indices = indices[keep]
+	mat = sp.csr_matrix((np.ones(len(indices), dtype=np.int8), indices, indptr), 
+		shape=(n_rows, n_cols))
 	if not sparse:
-		mat = np.zeros((n_rows, n_cols), dtype=np.int8)
-	else:
-		mat = sp.lil_matrix((n_rows, n_cols), dtype=np.int8)	
-	
-	for i in xrange(n_rows):
-		mat[i, np.random.choice(range(n_cols), n_ones_per_row)] = 1
-
-	if sparse: # convert lil_matrix to csr_matrix for efficient dot product
-		mat = mat.tocsr()
+		mat = mat.toarray()
 
 	vec = np.zeros(n_cols, dtype=np.int8)
-	vec[np.random.choice(range(n_cols), n_ones_per_row)] = 1
+	vec[np.random.randint(0, n_cols, n_ones_per_row)] = 1
 	return mat, vec
 
 
@@ -31,7 +41,8 @@ def fast_jaccard(mat, vec):
 	Return array 
 	'''
 	assert isinstance(mat, sp.csr_matrix)
-	intersections = mat.dot(vec) # number of intersections
+	# accumulate in int32: an int8 dot product overflows past 127 shared genes
+	intersections = mat.dot(vec.astype(np.int32)) # number of intersections
 	row_sums = mat.getnnz(axis=1).ravel()
 	unions = row_sums + vec.sum() - intersections
 	return intersections / unions
@@ -46,3 +57,411 @@ def fast_signed_jaccard(mat_up, mat_dn, vec_up, vec_dn):
 	j4 = fast_jaccard(mat_up, vec_dn)
 	return (j1 + j2 - j3 - j4) / 2
 
+
+## Packed bitsets: rows of a binary matrix are stored as uint64 words and 
+## intersections are counted with AND + popcount. At the density of signatures
+## (hundreds of genes out of tens of thousands) the packed words take more 
+## memory and time than the csr matrices, so they are only benchmarked against
+## fast_signed_jaccard by benchmark_scoring.py and not used to serve queries.
+
+def n_words(n_cols):
+	'''Number of uint64 words needed to hold `n_cols` bits.'''
+	return (n_cols + 63) // 64
+
+
+def _pack_indices(rows, cols, n_rows, n_cols):
+	'''Pack (row, col) positions of ones, sorted by row then col, 
+	into a (n_words, n_rows) uint64 array.'''
+	w = n_words(n_cols)
+	bits = np.zeros(w * n_rows, dtype=np.uint64)
+	if len(cols) > 0:
+		flat = (cols >> 6).astype(np.int64) * n_rows + rows
+		bitvals = np.left_shift(np.uint64(1), (cols & 63).astype(np.uint64))
+		# positions are unique and sorted by row then word, so adding the 
+		# bits of a word equals OR-ing them
+		starts = np.flatnonzero(np.concatenate(([True], flat[1:] != flat[:-1])))
+		bits[flat[starts]] = np.add.reduceat(bitvals, starts)
+	return bits.reshape(w, n_rows)
+
+
+def pack_rows(mat):
+	'''Pack the rows of a binary csr_matrix into a (n_words, n_rows) uint64 
+	array, word-major so the words of all rows at a position are contiguous.
+	'''
+	assert isinstance(mat, sp.csr_matrix)
+	mat = mat.copy()
+	mat.sum_duplicates() # also sorts the indices
+	mat.eliminate_zeros()
+	n_rows, n_cols = mat.shape
+	rows = np.repeat(np.arange(n_rows), np.diff(mat.indptr))
+	return _pack_indices(rows, mat.indices, n_rows, n_cols)
+
+
+def pack_vector(vec):
+	'''Pack a dense binary vector into a 1-d uint64 array.'''
+	cols = np.flatnonzero(vec)
+	rows = np.zeros(len(cols), dtype=np.int64)
+	return _pack_indices(rows, cols, 1, len(vec))[:, 0]
+
+
+_M1 = np.uint64(0x5555555555555555)
+_M2 = np.uint64(0x3333333333333333)
+_M4 = np.uint64(0x0f0f0f0f0f0f0f0f)
+_H01 = np.uint64(0x0101010101010101)
+
+def popcount(words):
+	'''Number of set bits in each element of a uint64 array (SWAR popcount).'''
+	x = words - ((words >> np.uint64(1)) & _M1)
+	x = (x & _M2) + ((x >> np.uint64(2)) & _M2)
+	x = (x + (x >> np.uint64(4))) & _M4
+	return (x * _H01) >> np.uint64(56)
+
+
+def bitset_signed_jaccard(bits_up, bits_dn, sizes_up, sizes_dn, vec_up, vec_dn):
+	'''Compute row-wise signed Jaccard between packed (bits_up, bits_dn) from
+	pack_rows and vec. `sizes_up`, `sizes_dn` are the number of ones in each row.
+	Gives the same scores as fast_signed_jaccard. Only the words where the query
+	has bits set are visited, each as a contiguous view of all the rows AND-ed 
+	into a buffer and counted into the intersections in place.
+	'''
+	q_up = pack_vector(vec_up)
+	q_dn = pack_vector(vec_dn)
+	n_up = popcount(q_up).sum(dtype=np.int64)
+	n_dn = popcount(q_dn).sum(dtype=np.int64)
+
+	n_rows = bits_up.shape[1]
+	# up vs up, dn vs dn, dn vs up, up vs dn
+	intersections = np.zeros((4, n_rows), dtype=np.uint64)
+	pairs = ((bits_up, q_up), (bits_dn, q_dn), (bits_dn, q_up), (bits_up, q_dn))
+	buf = np.empty(n_rows, dtype=np.uint64)
+	for w in np.flatnonzero(q_up | q_dn):
+		for counts, (bits, q) in zip(intersections, pairs):
+			if q[w]:
+				np.bitwise_and(bits[w], q[w], out=buf)
+				counts += popcount(buf)
+
+	i1, i2, i3, i4 = intersections.astype(np.int64)
+	j1 = i1 / (sizes_up + n_up - i1)
+	j2 = i2 / (sizes_dn + n_dn - i2)
+	j3 = i3 / (sizes_dn + n_up - i3)
+	j4 = i4 / (sizes_up + n_dn - i4)
+	return (j1 + j2 - j3 - j4) / 2
+
+
+## Batch scoring of many query signatures with sparse matrix-matrix products.
+
+def _sparse_jaccard(intersections, row_sums, col_sums):
+	'''Convert a sparse matrix of intersection counts to Jaccard indices, 
+	given the sizes of the row sets and column sets. 
+	Only non-zero intersections have non-zero Jaccard indices, so the result
+	stays sparse.
+	'''
+	intersections = intersections.tocsr()
+	rows = np.repeat(np.arange(intersections.shape[0]), np.diff(intersections.indptr))
+	cols = intersections.indices
+	data = intersections.data.astype(np.float64)
+	data /= row_sums[rows] + col_sums[cols] - data
+	return sp.csr_matrix((data, cols, intersections.indptr), shape=intersections.shape)
+
+
+def batch_signed_jaccard(mat_up, mat_dn, qmat_up, qmat_dn):
+	'''Compute signed Jaccard between every row of (mat_up, mat_dn) and every row
+	of the query matrices (qmat_up, qmat_dn). All inputs are binary csr_matrix.
+	Returns a sparse (n_rows, n_queries) matrix of scores.
+	'''
+	n_queries = qmat_up.shape[0]
+	# stack the queries as columns of a (n_cols, 2 * n_queries) int32 matrix
+	# so each DB matrix takes part in a single sparse product
+	qmat = sp.vstack([qmat_up, qmat_dn]).T.tocsc().astype(np.int32)
+	q_sums = qmat.getnnz(axis=0)
+	inter_up = mat_up.dot(qmat).tocsc()
+	inter_dn = mat_dn.dot(qmat).tocsc()
+	j_up = _sparse_jaccard(inter_up, mat_up.getnnz(axis=1), q_sums)
+	j_dn = _sparse_jaccard(inter_dn, mat_dn.getnnz(axis=1), q_sums)
+
+	j1 = j_up[:, :n_queries] # up vs up
+	j2 = j_dn[:, n_queries:] # dn vs dn
+	j3 = j_dn[:, :n_queries] # dn vs up
+	j4 = j_up[:, n_queries:] # up vs dn
+	return (j1 + j2 - j3 - j4) / 2
+
+
+def top_k_indices(scores, k=None):
+	'''Indices of the `k` largest values in `scores` in descending order. 
+	A partial selection is used so the cost is O(n + k*log(k)) instead of 
+	sorting all the scores. Returns all indices sorted if `k` is None.
+	'''
+	n = len(scores)
+	if k is None or k >= n:
+		return scores.argsort()[::-1]
+	if k <= 0:
+		return np.array([], dtype=np.int64)
+	idx = np.argpartition(-scores, k - 1)[:k]
+	return idx[(-scores[idx]).argsort()]
+
+
+## Inverted index scoring: intersections are accumulated over the postings 
+## (rows containing a gene) of the query genes only.
+
+def postings_rows(mat_csc, cols):
+	'''Concatenate the row indices of the non-zeros in columns `cols` of a 
+	csc_matrix, i.e. the postings lists of these columns.'''
+	starts = mat_csc.indptr[cols]
+	lengths = mat_csc.indptr[cols + 1] - starts
+	# positions of all postings in mat_csc.indices
+	offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+	offsets += np.arange(lengths.sum())
+	return mat_csc.indices[offsets]
+
+
+def postings_jaccard(mat_csc, row_sums, cols):
+	'''Compute row-wise Jaccard index between a binary csc_matrix and the set of 
+	columns `cols` (unique column indexes). The cost is proportional to the 
+	total length of the postings of `cols` rather than the nnz of the matrix.
+	'''
+	n_rows = mat_csc.shape[0]
+	intersections = np.bincount(postings_rows(mat_csc, cols), minlength=n_rows)
+	unions = row_sums + len(cols) - intersections
+	return intersections / unions
+
+
+def postings_signed_jaccard(csc_up, csc_dn, sizes_up, sizes_dn, up_idx, dn_idx):
+	'''Compute row-wise signed Jaccard between (csc_up, csc_dn) and the query 
+	given as column indexes of the up and down genes. 
+	Gives the same scores as fast_signed_jaccard.
+	'''
+	j1 = postings_jaccard(csc_up, sizes_up, up_idx)
+	j2 = postings_jaccard(csc_dn, sizes_dn, dn_idx)
+	j3 = postings_jaccard(csc_dn, sizes_dn, up_idx)
+	j4 = postings_jaccard(csc_up, sizes_up, dn_idx)
+	return (j1 + j2 - j3 - j4) / 2
+
+
+## Approximate search of rows with high Jaccard index using MinHash and LSH.
+
+class MinHashLSH(object):
+	'''
+	MinHash sketches of the rows of a binary csr_matrix with LSH banding tables. 
+	A query set becomes a candidate match of a row if their sketches agree on 
+	all the `band_size` hashes of at least one band, which happens with 
+	probability `lsh_collision_probability(jaccard, band_size, n_bands)`.
+	More bands give a higher recall at the cost of more candidates.
+	'''
+	prime = 2147483647 # 2**31 - 1, hash values fit in uint32
+
+	def __init__(self, n_hashes=128, n_bands=64, seed=0):
+		assert n_hashes % n_bands == 0
+		self.n_hashes = n_hashes
+		self.n_bands = n_bands
+		self.band_size = n_hashes // n_bands
+		rs = np.random.RandomState(seed)
+		# universal hash functions h(x) = (a*x + b) mod prime
+		self.a = rs.randint(1, self.prime, n_hashes).astype(np.int64)
+		self.b = rs.randint(0, self.prime, n_hashes).astype(np.int64)
+		# odd multipliers to combine the hashes of a band into one key
+		self.band_mult = rs.randint(1, 2**62, self.band_size).astype(np.uint64) | np.uint64(1)
+
+	def sketch_rows(self, mat):
+		'''MinHash sketches of the rows of a csr_matrix, 
+		empty rows get `prime` for all hashes.'''
+		n_rows = mat.shape[0]
+		sketches = np.empty((n_rows, self.n_hashes), dtype=np.uint32)
+		empty = np.diff(mat.indptr) == 0
+		# reduce over the non-empty rows only, so each reduction ends where
+		# the next non-empty row starts
+		starts = mat.indptr[:-1][~empty]
+		indices = mat.indices[:mat.indptr[-1]].astype(np.int64)
+		for i in xrange(self.n_hashes):
+			if len(starts) > 0:
+				h = (self.a[i] * indices + self.b[i]) % self.prime
+				sketches[~empty, i] = np.minimum.reduceat(h, starts)
+			sketches[empty, i] = self.prime
+		return sketches
+
+	def sketch_set(self, cols):
+		'''MinHash sketch of a set of column indexes.'''
+		if len(cols) == 0:
+			return np.repeat(np.uint32(self.prime), self.n_hashes)
+		cols = np.asarray(cols, dtype=np.int64)
+		h = (self.a[:, None] * cols[None, :] + self.b[:, None]) % self.prime
+		return h.min(axis=1).astype(np.uint32)
+
+	def band_keys(self, sketches):
+		'''Combine the hashes in each band into a uint64 key, 
+		returns a (n_bands, n_rows) array.'''
+		n_rows = sketches.shape[0]
+		bands = sketches.astype(np.uint64).reshape(n_rows, self.n_bands, self.band_size)
+		return (bands * self.band_mult).sum(axis=2, dtype=np.uint64).T
+
+	def fit(self, mat):
+		'''Build the banding tables as sorted keys for each band.'''
+		keys = self.band_keys(self.sketch_rows(mat))
+		self.sorted_rows = keys.argsort(axis=1).astype(np.int32)
+		self.sorted_keys = keys[np.arange(self.n_bands)[:, None], self.sorted_rows]
+		self.empty = np.flatnonzero(np.diff(mat.indptr) == 0)
+		return self
+
+	def query(self, cols, n_bands=None):
+		'''Candidate rows sharing at least one band with the set `cols`.
+		Only the first `n_bands` bands are used if given, to trade recall 
+		for speed.'''
+		if n_bands is None or n_bands > self.n_bands:
+			n_bands = self.n_bands
+		if len(cols) == 0 or n_bands <= 0:
+			return np.array([], dtype=np.int32)
+		q_keys = self.band_keys(self.sketch_set(cols)[None, :])[:, 0]
+		candidates = []
+		for i in xrange(n_bands):
+			lo = np.searchsorted(self.sorted_keys[i], q_keys[i], side='left')
+			hi = np.searchsorted(self.sorted_keys[i], q_keys[i], side='right')
+			candidates.append(self.sorted_rows[i, lo:hi])
+		candidates = np.unique(np.concatenate(candidates))
+		# empty rows never match a non-empty set
+		return np.setdiff1d(candidates, self.empty, assume_unique=True)
+
+	def save(self, prefix):
+		'''Save the banding tables to `prefix`-{sorted_rows,sorted_keys,empty}.npy,
+		the hash functions are recreated from the parameters.'''
+		for key in ('sorted_rows', 'sorted_keys', 'empty'):
+			np.save('%s-%s.npy' % (prefix, key), getattr(self, key))
+		return
+
+	def load(self, prefix, mmap_mode='r'):
+		'''Load the banding tables saved by `save`.'''
+		for key in ('sorted_rows', 'sorted_keys', 'empty'):
+			setattr(self, key, np.load('%s-%s.npy' % (prefix, key), mmap_mode=mmap_mode))
+		return self
+
+	@property
+	def nbytes(self):
+		return self.sorted_rows.nbytes + self.sorted_keys.nbytes
+
+
+def lsh_collision_probability(jaccard, band_size, n_bands):
+	'''Probability for sets with a given Jaccard index to share at least one 
+	band, i.e. the expected recall of MinHashLSH.query.'''
+	return 1 - (1 - np.asarray(jaccard, dtype=np.float64) ** band_size) ** n_bands
+
+
+## Similarity using the values of genes rather than binary memberships.
+
+def row_norms(mat):
+	'''L2 norms of the rows of a sparse matrix.'''
+	return np.sqrt(np.asarray(mat.multiply(mat).sum(axis=1)).ravel())
+
+
+def row_max_abs(mat):
+	'''Max absolute values of the rows of a sparse matrix.'''
+	return np.asarray(abs(mat).max(axis=1).todense()).ravel().astype(np.float64)
+
+
+def sparse_cosine(mat, norms, vec, vec_norm=None):
+	'''Compute row-wise cosine similarity between a sparse matrix, 
+	given its row norms, and a dense vector with a single sparse mat-vec. 
+	`vec_norm` is the L2 norm of the query, computed from `vec` if None.
+	Rows with a zero norm get 0.
+	'''
+	vec = vec.astype(np.float64)
+	dots = mat.dot(vec)
+	if vec_norm is None:
+		vec_norm = np.sqrt(np.dot(vec, vec))
+	denoms = norms * vec_norm
+	scores = np.zeros(mat.shape[0])
+	mask = denoms > 0
+	scores[mask] = dots[mask] / denoms[mask]
+	return scores
+
+
+def weighted_signed_overlap(mat, max_abs, vec, vec_l1=None):
+	'''Compute row-wise weighted signed overlap between a sparse matrix of 
+	signed values, given the max absolute values of its rows, and a dense 
+	vector of signed weights: the sum of the query weights times the values
+	of each row scaled to [-1, 1], divided by the L1 norm of the query.
+	`vec_l1` is the L1 norm of the query, computed from `vec` if None.
+	With values of 1 for up and -1 for down genes, it is the sum of the query
+	weights of up genes minus those of down genes. Scores are within [-1, 1].
+	'''
+	vec = vec.astype(np.float64)
+	if vec_l1 is None:
+		vec_l1 = np.abs(vec).sum()
+	scores = np.zeros(mat.shape[0])
+	mask = max_abs > 0
+	if vec_l1 == 0 or not mask.any():
+		return scores
+	scores[mask] = mat.dot(vec)[mask] / (max_abs[mask] * vec_l1)
+	return scores
+
+
+def max_abs_merge_columns(mat, col_map, n_cols):
+	'''Map the columns of a sparse matrix to the `n_cols` columns given by 
+	`col_map` (-1 to drop a column). Where several columns of a row map to 
+	the same column, the value with the largest absolute value is kept 
+	rather than their sum. Return a csr_matrix.
+	'''
+	mat = mat.tocoo()
+	cols = col_map[mat.col]
+	mask = cols >= 0
+	rows, cols, vals = mat.row[mask], cols[mask], mat.data[mask]
+	# within each (row, col), the value with the largest abs comes first
+	order = np.lexsort((-np.abs(vals), cols, rows))
+	rows, cols, vals = rows[order], cols[order], vals[order]
+	first = np.ones(len(rows), dtype=np.bool_)
+	first[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+	return sp.csr_matrix((vals[first], (rows[first], cols[first])), 
+		shape=(mat.shape[0], n_cols), dtype=mat.dtype)
+
+
+def binary_csr(rows, cols, shape):
+	## binary csr_matrix with ones at (rows, cols), which may be repeated
+	mat = sp.csr_matrix((np.ones(len(rows), dtype=np.int8), (rows, cols)), shape=shape)
+	mat.data[:] = 1
+	return mat
+
+
+def gene_index_matrices(gene_indexes, n_genes_cs, n_genes_i):
+	'''Assemble the matrices of a collection from `gene_indexes`, a list of
+	(idx_cs, idx_i, vals) of each signature where missing genes have index -1.
+	Return the binary matrices of up and down genes over the `n_genes_i` case
+	insensitive genes and the matrix of CD values over the `n_genes_cs` genes,
+	the rows are in the order of `gene_indexes`.
+	'''
+	n_rows = len(gene_indexes)
+	lengths = [len(vals) for _, _, vals in gene_indexes]
+	rows = np.repeat(np.arange(n_rows), lengths)
+	if n_rows > 0:
+		idx_cs = np.concatenate([idx_cs for idx_cs, _, _ in gene_indexes])
+		idx_i = np.concatenate([idx_i for _, idx_i, _ in gene_indexes])
+		vals = np.concatenate([vals for _, _, vals in gene_indexes])
+	else:
+		idx_cs = idx_i = np.array([], dtype=np.int64)
+		vals = np.array([], dtype=np.float32)
+
+	# CD values of all signatures for weighted metrics
+	mask = idx_cs >= 0
+	mat_cs = sp.csr_matrix((vals[mask], (rows[mask], idx_cs[mask])), 
+		shape=(n_rows, n_genes_cs), dtype=np.float32)
+	mat_cs.eliminate_zeros()
+
+	# binary matrices of up/down genes, case variants of a gene share a column
+	shape_i = (n_rows, n_genes_i)
+	mask_up = (idx_i >= 0) & (vals > 0)
+	mask_dn = (idx_i >= 0) & (vals < 0)
+	mat_up = binary_csr(rows[mask_up], idx_i[mask_up], shape_i)
+	mat_dn = binary_csr(rows[mask_dn], idx_i[mask_dn], shape_i)
+	return mat_up, mat_dn, mat_cs
+
+
+def save_csr(prefix, mat):
+	'''Save the arrays of a csr_matrix to `<prefix>-{data,indices,indptr}.npy`.
+	'''
+	for name in ('data', 'indices', 'indptr'):
+		np.save('%s-%s.npy' % (prefix, name), getattr(mat, name))
+
+
+def load_csr(prefix, shape, mmap_mode='r'):
+	'''Load a csr_matrix saved by `save_csr`, with its arrays memory-mapped
+	unless `mmap_mode` is None.
+	'''
+	arrays = [np.load('%s-%s.npy' % (prefix, name), mmap_mode=mmap_mode)
+		for name in ('data', 'indices', 'indptr')]
+	return sp.csr_matrix(tuple(arrays), shape=shape, copy=False)
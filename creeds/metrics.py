@@ -0,0 +1,187 @@
+'''
+In-process metrics of the app: latency histograms, counters and gauges
+collected at scrape time, rendered in the Prometheus text format.
+'''
+import time
+import threading
+from contextlib import contextmanager
+
+# upper bounds (seconds) of the latency buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram(object):
+	'''
+	Cumulative histogram of observed values with fixed bucket upper bounds.
+	'''
+	def __init__(self, buckets=DEFAULT_BUCKETS):
+		self.buckets = tuple(buckets)
+		self.counts = [0] * len(self.buckets)
+		self.count = 0
+		self.sum = 0.
+		self._lock = threading.Lock()
+
+	def observe(self, value):
+		with self._lock:
+			for i, bound in enumerate(self.buckets):
+				if value <= bound:
+					self.counts[i] += 1
+					break
+			self.count += 1
+			self.sum += value
+		return
+
+	def cumulative_counts(self):
+		## counts of values <= each bound, as in Prometheus buckets
+		counts = []
+		total = 0
+		for count in self.counts:
+			total += count
+			counts.append(total)
+		return counts
+
+
+def format_labels(labels):
+	if not labels:
+		return ''
+	return '{%s}' % ','.join('%s="%s"' % (key, str(val).replace('\\', '\\\\')
+		.replace('"', '\\"').replace('\n', '\\n')) for key, val in sorted(labels))
+
+
+def format_value(value):
+	if value == float('inf'):
+		return '+Inf'
+	return repr(float(value))
+
+
+class _NullTimer(object):
+	## the context returned by Metrics.stage when metrics are disabled
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		return False
+
+NULL_TIMER = _NullTimer()
+
+
+class Metrics(object):
+	'''
+	Registry of the metrics of the app. Durations of named stages are
+	recorded in histograms and, for the current request, in a thread local
+	list of (stage, seconds). Nothing is recorded when not `enabled`.
+	'''
+	def __init__(self, enabled=True, prefix='creeds', buckets=DEFAULT_BUCKETS):
+		self.enabled = enabled
+		self.prefix = prefix
+		self.buckets = buckets
+		self.histograms = {} # {(name, labels): Histogram}
+		self.counters = {} # {(name, labels): value}
+		self.helps = {} # {name: (type, help)}
+		self.collectors = []
+		self._local = threading.local()
+		self._lock = threading.Lock()
+
+	def describe(self, name, type_, help_):
+		self.helps[self.prefix + '_' + name] = (type_, help_)
+		return
+
+	def observe(self, name, value, **labels):
+		if not self.enabled:
+			return
+		key = (self.prefix + '_' + name, tuple(sorted(labels.items())))
+		histogram = self.histograms.get(key)
+		if histogram is None:
+			with self._lock:
+				histogram = self.histograms.setdefault(key, Histogram(self.buckets))
+		histogram.observe(value)
+		return
+
+	def inc(self, name, value=1, **labels):
+		if not self.enabled:
+			return
+		key = (self.prefix + '_' + name, tuple(sorted(labels.items())))
+		with self._lock:
+			self.counters[key] = self.counters.get(key, 0) + value
+		return
+
+	@contextmanager
+	def _timer(self, name):
+		start = time.time()
+		try:
+			yield
+		finally:
+			seconds = time.time() - start
+			self.observe('stage_seconds', seconds, stage=name)
+			stages = getattr(self._local, 'stages', None)
+			if stages is not None:
+				stages.append((name, seconds))
+
+	def stage(self, name):
+		'''Context manager timing a stage of handling a request.
+		'''
+		if not self.enabled:
+			return NULL_TIMER
+		return self._timer(name)
+
+	def start_request(self):
+		## start collecting the stages of the request handled by this thread
+		if self.enabled:
+			self._local.stages = []
+			self._local.start = time.time()
+		return
+
+	def end_request(self, endpoint):
+		'''Record the latency of the request handled by this thread,
+		return its [(stage, seconds)].
+		'''
+		if not self.enabled or getattr(self._local, 'stages', None) is None:
+			return []
+		self.observe('request_seconds', time.time() - self._local.start,
+			endpoint=endpoint)
+		stages = self._local.stages
+		self._local.stages = None
+		return stages
+
+	def register_collector(self, collector):
+		'''Add a function called at scrape time, returning a list of
+		(name, type, help, [(labels dict, value)]).
+		'''
+		self.collectors.append(collector)
+		return
+
+	def render(self):
+		'''Render all the metrics in the Prometheus text exposition format.
+		'''
+		lines = []
+		def header(name, type_, help_):
+			lines.append('# HELP %s %s' % (name, help_))
+			lines.append('# TYPE %s %s' % (name, type_))
+
+		seen = set()
+		for (name, labels), histogram in sorted(self.histograms.items()):
+			if name not in seen:
+				seen.add(name)
+				header(name, 'histogram', self.helps.get(name, (None, name))[1])
+			for bound, count in zip(histogram.buckets + (float('inf'),),
+				histogram.cumulative_counts() + [histogram.count]):
+				lines.append('%s_bucket%s %d' % (name,
+					format_labels(labels + (('le', format_value(bound)),)), count))
+			lines.append('%s_sum%s %s' % (name, format_labels(labels),
+				format_value(histogram.sum)))
+			lines.append('%s_count%s %d' % (name, format_labels(labels), histogram.count))
+
+		for (name, labels), value in sorted(self.counters.items()):
+			if name not in seen:
+				seen.add(name)
+				header(name, 'counter', self.helps.get(name, (None, name))[1])
+			lines.append('%s%s %s' % (name, format_labels(labels), format_value(value)))
+
+		for collector in self.collectors:
+			for name, type_, help_, samples in collector():
+				name = self.prefix + '_' + name
+				header(name, type_, help_)
+				for labels, value in samples:
+					lines.append('%s%s %s' % (name, format_labels(labels.items()),
+						format_value(value)))
+		return '\n'.join(lines) + '\n'
@@ -0,0 +1,92 @@
+'''
+In-memory n-gram index of names for case-insensitive substring and prefix
+search, used instead of unanchored $regex queries on the DB.
+'''
+from collections import defaultdict
+
+import numpy as np
+
+
+class NameIndex(object):
+	'''
+	Index of the names of items, each item may have several names.
+	Every name is split into overlapping n-grams, a query is answered by
+	intersecting the postings of its n-grams and verifying the candidates.
+	'''
+	def __init__(self, items, names_list, n=3):
+		'''
+		`items`: a list of objects returned by `search`
+		`names_list`: a list of names (strings) of each item
+		'''
+		self.n = n
+		self.items = items
+		self.names = [] # lower case names
+		self.name_items = [] # index of the item of each name
+		postings = defaultdict(list)
+		for i, names in enumerate(names_list):
+			for name in set(name.lower() for name in names if name):
+				name_id = len(self.names)
+				self.names.append(name)
+				self.name_items.append(i)
+				for gram in self.ngrams(name):
+					postings[gram].append(name_id)
+		self.name_items = np.array(self.name_items, dtype=np.int64)
+		# sorted unique name ids for each n-gram
+		self.postings = {gram: np.unique(ids) for gram, ids in postings.items()}
+
+	def __len__(self):
+		return len(self.items)
+
+	def ngrams(self, name):
+		return set(name[i:i+self.n] for i in xrange(len(name) - self.n + 1))
+
+	def candidates(self, query):
+		## ids of names which may contain `query`
+		grams = self.ngrams(query)
+		if len(grams) == 0: # query shorter than n, check all the names
+			return np.arange(len(self.names))
+		ids = None
+		# intersect the shortest postings first
+		for gram in sorted(grams, key=lambda gram: len(self.postings.get(gram, ()))):
+			if gram not in self.postings:
+				return np.array([], dtype=np.int64)
+			if ids is None:
+				ids = self.postings[gram]
+			else:
+				ids = np.intersect1d(ids, self.postings[gram], assume_unique=True)
+			if len(ids) == 0:
+				break
+		return ids
+
+	@staticmethod
+	def rank(name, query):
+		## lower is better: exact match, prefix, prefix of a word, substring
+		if name == query:
+			return 0
+		elif name.startswith(query):
+			return 1
+		elif (' ' + name).find(' ' + query) != -1:
+			return 2
+		return 3
+
+	def search(self, query, limit=None, prefix=False):
+		'''
+		Find the items having a name containing `query` (or starting with it
+		if `prefix`), case-insensitively. Return at most `limit` items ranked
+		by how well their best name matches, then by the length of the name.
+		'''
+		query = query.lower()
+		best = {} # {item index: (rank, name length)}
+		for name_id in self.candidates(query):
+			name = self.names[name_id]
+			if prefix:
+				if not name.startswith(query):
+					continue
+			elif query not in name:
+				continue
+			i = self.name_items[name_id]
+			score = (self.rank(name, query), len(name))
+			if i not in best or score < best[i]:
+				best[i] = score
+		ranked = sorted(best, key=lambda i: best[i] + (i,))[:limit]
+		return [self.items[i] for i in ranked]
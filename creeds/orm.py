@@ -2,20 +2,34 @@
 ORMs for signature, signatures in the MongoDB and collection of signatures.
 '''
 import os, sys, json
+import csv, gzip
+import shutil
+import threading
 import hashlib
-from collections import Counter
+from collections import Counter, OrderedDict
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
-import pandas as pd
 import scipy.sparse as sp
 import requests
+from requests.packages.urllib3.util.retry import Retry
 from joblib import Parallel, delayed
+from bson import json_util
+from pymongo.errors import PyMongoError
 
 from .gene_converter import *
-from .matrix_ops import (fast_jaccard, fast_signed_jaccard)
+from .cache import LRUCache
+from .name_index import NameIndex
+from .metrics import Metrics
+from . import executor
+from .matrix_ops import (fast_jaccard, fast_signed_jaccard, 
+	batch_signed_jaccard,
+	postings_signed_jaccard, MinHashLSH, lsh_collision_probability,
+	row_norms, row_max_abs, sparse_cosine, weighted_signed_overlap, save_csr, load_csr,
+	gene_index_matrices, max_abs_merge_columns)
 
 ## connect to mongodb via pymongo.MongoClient imported from the module
-from creeds import conn
+from creeds import app, conn
 
 ################################ Global variables ################################
 COLL = conn['microtask_signatures'].signatures
@@ -23,18 +37,76 @@ COLL_GENES = conn['microtask_signatures'].genes
 COLL_USER_SIGS = conn['microtask_signatures'].userSignatures
 COLL_USER_SIGS.create_index('id', unique=True, sparse=False)
 
+def _result_size(value):
+	## size of a page of results serialized as JSON or of its (rows, scores) arrays
+	if type(value) == tuple:
+		return sum(arr.nbytes for arr in value)
+	return len(value)
+
+## cache of query results of saved signatures, serialized as JSON:
+## {(hash, (name, generation) of collections, (top_k, min_abs_score, offset)): json}
+## and of the selected rows and scores, shared with streamed results:
+## {(hash, (name, generation) of collections, (top_k, min_abs_score, offset), 'rows'): 
+## (rows, scores)}
+RESULT_CACHE = LRUCache(app.config.get('RESULT_CACHE_SIZE', 2e8), sizeof=_result_size)
+## cache of serialized signatures for /api: 
+## {(uid, cutoff, name, generation of the collection holding it): json}
+API_CACHE = LRUCache(app.config.get('API_CACHE_SIZE', 5e7), sizeof=len)
+## cache of urls of signatures posted to PAEA and L1000CDS2:
+## {(uid, app, name, generation of the collection holding it): url}
+APP_URL_CACHE = LRUCache(app.config.get('APP_URL_CACHE_SIZE', 1e7), sizeof=len)
+## number of requests of the url of each signature
+APP_URL_HITS = Counter()
+APP_URL_HITS_LOCK = threading.Lock()
+
+## latency of the stages of handling requests, sizes of caches and collections
+METRICS = Metrics(enabled=app.config.get('METRICS_ENABLED', True))
+
+## pooled HTTP connections with timeouts and retries for posting to other apps,
+## posts are not idempotent so only failed connections are retried
+HTTP_SESSION = requests.Session()
+for prefix in ('http://', 'https://'):
+	HTTP_SESSION.mount(prefix, requests.adapters.HTTPAdapter(
+		pool_maxsize=app.config.get('HTTP_POOL_SIZE', 10),
+		max_retries=Retry(total=app.config.get('HTTP_RETRIES', 2), read=0,
+			backoff_factor=0.5)
+		))
+
 ALL_GENES = COLL_GENES.find_one({'case_sensitive': {'$exists':True}})['case_sensitive']
 ALL_GENES = np.array(ALL_GENES)
 ALL_GENES_I = COLL_GENES.find_one({'case_insensitive': {'$exists':True}})['case_insensitive']
 ALL_GENES_I = np.array(ALL_GENES_I)
-
-ALL_UIDS = COLL.find(
-	{'$and': [
-		{'chdir_sva_exp2': {'$exists': True}}, 
-		{'version': {'$in':['1.0', '1.1', '1.2', '2.0']}},
-		{"incorrect": {"$ne": True}}
-	]},
-	{'id': True}).distinct('id')
+# case insensitive gene symbol to its index in ALL_GENES_I
+GENE_I_IDX = dict(zip(ALL_GENES_I, xrange(len(ALL_GENES_I))))
+# case sensitive gene symbol to its index in ALL_GENES
+GENE_CS_IDX = dict(zip(ALL_GENES, xrange(len(ALL_GENES))))
+# index in ALL_GENES_I for each gene in ALL_GENES, -1 if missing
+ALL_GENES_CS2I = np.array([GENE_I_IDX.get(gene.upper(), -1) for gene in ALL_GENES])
+
+def load_all_uids():
+	## uids of all the signatures in the DB, including those in no collection
+	return COLL.find(
+		{'$and': [
+			{'chdir_sva_exp2': {'$exists': True}}, 
+			{'version': {'$in':['1.0', '1.1', '1.2', '2.0']}},
+			{"incorrect": {"$ne": True}}
+		]},
+		{'id': True}).distinct('id')
+
+ALL_UIDS = load_all_uids()
+ALL_UIDS_SET = set(ALL_UIDS)
+
+def refresh_all_uids():
+	## update ALL_UIDS and ALL_UIDS_SET in place, so that every module 
+	## importing them sees the signatures added to or removed from the DB. 
+	## New uids are added before the removed ones are discarded, so uids 
+	## in both generations are never missing
+	all_uids = load_all_uids()
+	all_uids_set = set(all_uids)
+	ALL_UIDS_SET.update(all_uids_set)
+	ALL_UIDS_SET.intersection_update(all_uids_set)
+	ALL_UIDS[:] = all_uids
+	return
 
 
 
@@ -75,9 +147,273 @@ def find_name(doc):
 	return name
 
 
+def find_search_names(doc):
+	## all the gene, disease and drug names of a doc for string search,
+	## including names in the lists of v2.0 signatures
+	names = []
+	for field in ['hs_gene_symbol', 'mm_gene_symbol', 'disease_name', 'drug_name']:
+		value = doc.get(field, None)
+		if type(value) == list:
+			names.extend(item.get('name', None) for item in value)
+		else:
+			names.append(value)
+	return [name for name in names if name]
+
+
+def find_url(meta, name):
+	## get the url of the gene, disease or drug of a signature 
+	## from its meta data and name
+	url = ''
+	uid = meta['id']
+	if ':P' not in uid: # not v2.0 signature
+		if uid.startswith('gene:'):
+			organism = meta['organism']
+			if organism == 'human':
+				gene_symbol = meta['hs_gene_symbol']
+				if gene_symbol is None:
+					gene_symbol = meta['mm_gene_symbol']
+			else:
+				gene_symbol = meta['mm_gene_symbol']
+				if gene_symbol is None:
+					gene_symbol = meta['hs_gene_symbol']
+					
+			gene_id = GENE_SYMBOLS.get(gene_symbol, '')
+			url = 'http://www.ncbi.nlm.nih.gov/gene/%s' % gene_id
+
+		elif uid.startswith('dz:'):
+			do_id = meta.get('do_id', None)
+			if do_id is not None:
+				url = 'http://disease-ontology.org/term/%s' % do_id
+			else:
+				url = 'https://www.google.com/search?q=%s' % name.replace(' ', '+')
+		else:
+			db_id = meta.get('drugbank_id', None)
+			pubchem_cid = meta.get('pubchem_cid', None)
+			if db_id is not None:
+				url = 'http://www.drugbank.ca/drugs/%s' % db_id
+			elif pubchem_cid is not None:
+				url = 'https://pubchem.ncbi.nlm.nih.gov/compound/%s' % pubchem_cid
+			else:
+				url = 'https://www.google.com/search?q=%s' % name.replace(' ', '+')
+
+	else: # v2.0 signature
+		if uid.startswith('gene:'): key = 'hs_gene_symbol'
+		elif uid.startswith('dz:'): key = 'disease_name'
+		else: key = 'drug_name'
+		# becas concept ids
+		cids = [':'.join(item.get('cid', ':').split(':')[:2]) for item in meta.get(key, [])]
+		url_root = 'http://bioinformatics.ua.pt/becas/api/concept/redirect/'
+		url = [url_root + cid for cid in cids]
+
+	return url
+
+
+def _object_array(values):
+	## 1-d object array of values, which may be lists
+	arr = np.empty(len(values), dtype=object)
+	for i, value in enumerate(values):
+		arr[i] = value
+	return arr
+
+
+def genes_fingerprint(all_genes, all_genes_i):
+	## fingerprint of the genes indexing the columns of the matrices
+	return hashlib.md5(u'\t'.join([u'\n'.join(all_genes), 
+		u'\n'.join(all_genes_i)]).encode('utf-8')).hexdigest()
+
+GENES_FINGERPRINT = genes_fingerprint(ALL_GENES, ALL_GENES_I)
+
+
+def genes_changed():
+	## whether the genes in the DB differ from the ones loaded in ALL_GENES(_I)
+	all_genes = COLL_GENES.find_one({'case_sensitive': {'$exists':True}})['case_sensitive']
+	all_genes_i = COLL_GENES.find_one({'case_insensitive': {'$exists':True}})['case_insensitive']
+	return genes_fingerprint(all_genes, all_genes_i) != GENES_FINGERPRINT
+
+
+def genes_to_index(genes):
+	## convert gene symbols to sorted unique indexes in ALL_GENES_I
+	idx = set()
+	for gene in genes:
+		i = GENE_I_IDX.get(gene.upper(), None)
+		if i is not None:
+			idx.add(i)
+	return np.array(sorted(idx), dtype=np.int32)
+
+
+def genes_to_matrix(gene_lists):
+	## convert lists of gene symbols to a binary csr_matrix over ALL_GENES_I
+	indexes = [genes_to_index(genes) for genes in gene_lists]
+	indptr = np.cumsum([0] + map(len, indexes))
+	if len(indexes) > 0:
+		indices = np.concatenate(indexes)
+	else:
+		indices = np.array([], dtype=np.int32)
+	data = np.ones(len(indices), dtype=np.int8)
+	return sp.csr_matrix((data, indices, indptr), 
+		shape=(len(indexes), len(ALL_GENES_I)))
+
+
+def _results_fields(generations, page):
+	## keys of the cached query results in a doc of COLL_USER_SIGS
+	results_key = hashlib.md5(json.dumps(generations)).hexdigest()
+	page_key = hashlib.md5(json.dumps(page)).hexdigest()
+	return results_key, page_key
+
+
+def load_saved_results(h, generations, page):
+	## retrieve the query results saved with a user signature, 
+	## None if missing or computed from other generations of the collections
+	results_key, page_key = _results_fields(generations, page)
+	try:
+		doc = COLL_USER_SIGS.find_one({'id': h, 'results_key': results_key}, 
+			{'_id': False, 'results.' + page_key: True})
+	except PyMongoError as e:
+		app.logger.warning('Failed to load results of %s: %r' % (h, e))
+		return None
+	if doc is None:
+		return None
+	return doc.get('results', {}).get(page_key, None)
+
+
+def save_results(h, generations, page, uid_data):
+	## save the query results with a user signature, replacing the results 
+	## from previous generations of the collections. To bound the size of 
+	## the doc, pages longer than RESULT_PERSIST_MAX_ROWS are not saved and
+	## at most RESULT_PERSIST_MAX_PAGES pages are saved for each generation,
+	## other pages are scored again when not in RESULT_CACHE
+	if len(uid_data) > app.config.get('RESULT_PERSIST_MAX_ROWS', 1000):
+		return
+	max_pages = app.config.get('RESULT_PERSIST_MAX_PAGES', 20)
+	results_key, page_key = _results_fields(generations, page)
+	try:
+		COLL_USER_SIGS.update_one({'id': h, 'results_key': results_key, 
+			'results_pages.%d' % (max_pages - 1): {'$exists': False}}, 
+			{'$set': {'results.' + page_key: uid_data}, 
+			'$addToSet': {'results_pages': page_key}})
+		COLL_USER_SIGS.update_one({'id': h, 'results_key': {'$ne': results_key}}, 
+			{'$set': {'results_key': results_key, 'results': {page_key: uid_data}, 
+			'results_pages': [page_key]}})
+	except PyMongoError as e:
+		app.logger.warning('Failed to save results of %s: %r' % (h, e))
+	return
+
+
+def build_uid_index(d_dbsc):
+	## {uid: (DBSignatureCollection instance, row)} over all the collections
+	uid_index = {}
+	for dbsc in d_dbsc.values():
+		for row, uid in enumerate(dbsc.uids):
+			uid_index[uid] = (dbsc, row)
+	return uid_index
+
+
+def build_name_index(d_dbsc):
+	## NameIndex of (DBSignatureCollection instance, row) over all the collections
+	items = []
+	names_list = []
+	for dbsc in d_dbsc.values():
+		items.extend((dbsc, row) for row in xrange(len(dbsc.uids)))
+		names_list.extend(dbsc.meta_columns['search_names'])
+	return NameIndex(items, names_list)
+
+
+def signature_json(uid, cutoff, uid_index):
+	## serialize a signature with its top `cutoff` genes, from the collection
+	## in `uid_index` holding it if it stores enough genes, otherwise from the DB.
+	## Return None for unknown uids
+	dbsc, row = uid_index.get(uid, (None, None))
+	if dbsc is not None and cutoff <= dbsc.n_genes_stored:
+		key = (uid, cutoff, dbsc.name, dbsc.generation)
+	elif uid in ALL_UIDS_SET:
+		key = (uid, cutoff, None, None)
+	else:
+		return None
+
+	json_str = API_CACHE.get(key)
+	if json_str is None:
+		if dbsc is not None and cutoff <= dbsc.n_genes_stored:
+			json_str = dbsc[uid].to_json(meta_only=False, cutoff=cutoff)
+		else:
+			sig = DBSignature(uid) # Signature instance
+			sig.init_cs_vectors(cutoff)
+			json_str = sig.to_json(meta_only=False)
+		API_CACHE.set(key, json_str)
+	return json_str
+
+
+def get_app_url(uid, app_name, uid_index):
+	## get the url of a signature posted to PAEA ('paea') or L1000CDS2 ('cds2'), 
+	## the url is cached until the collection holding the signature changes.
+	## Return None for unknown uids or if posting failed
+	if uid not in ALL_UIDS_SET or app_name not in ('paea', 'cds2'):
+		return None
+	dbsc, _ = uid_index.get(uid, (None, None))
+	if dbsc is not None:
+		key = (uid, app_name, dbsc.name, dbsc.generation)
+	else:
+		key = (uid, app_name, None, None)
+
+	url = APP_URL_CACHE.get(key)
+	if url is None:
+		sig = DBSignature(uid) # Signature instance
+		sig.init_cs_vectors(cutoff=2000)
+		try:
+			if app_name == 'paea':
+				url = sig.post_to_paea(cutoff=2000)
+			else:
+				url = sig.post_to_cds2(cutoff=2000)
+		except (requests.RequestException, ValueError, KeyError) as e:
+			app.logger.warning('Failed to post %s to %s: %r' % (uid, app_name, e))
+			return None
+		if url is not None:
+			APP_URL_CACHE.set(key, url)
+	return url
+
+
+def prefetch_app_urls(uids, uid_index, app_names=('paea', 'cds2'), n_threads=4):
+	## post signatures to the apps in a pool of threads to warm APP_URL_CACHE
+	pool = ThreadPool(n_threads)
+	try:
+		urls = pool.map(lambda args: get_app_url(args[0], args[1], uid_index), 
+			[(uid, app_name) for uid in uids for app_name in app_names])
+	finally:
+		pool.close()
+		pool.join()
+	return urls
+
+
+def top_genes(idx, vals, cutoff=None):
+	## get [(gene, val)] of up/dn genes from indexes in ALL_GENES and CD values,
+	## sorted by abs(vals) in descending order, only the top `cutoff` if given
+	# get mask of non zero values
+	mask_non_zero = vals != 0
+	# retrieve CD vals and genes
+	vals = vals[mask_non_zero]
+	genes = ALL_GENES[idx[mask_non_zero]]
+	# sort CD vals on abs(vals)
+	srt_idx = np.abs(vals).argsort()[::-1][:cutoff]
+
+	up_genes = []
+	dn_genes = []
+	for gene, val in zip(genes[srt_idx].tolist(), vals[srt_idx].tolist()):
+		if val > 0: 
+			up_genes.append( (gene, val) )
+		else: 
+			dn_genes.append( (gene, val) )
+	return up_genes, dn_genes
+
+
+def invalidate_query_results(dbsc):
+	## drop cached query results from previous generations of a collection
+	RESULT_CACHE.invalidate(lambda key: any(name == dbsc.name and 
+		generation != dbsc.generation for name, generation in key[1]))
+	return
+
+
 def sparse_matrix_size(mat):
 	## get size of a sparse matrix
-	if type(mat) == sp.csr_matrix:
+	if type(mat) in (sp.csr_matrix, sp.csc_matrix):
 		nbytes = mat.data.nbytes + mat.indptr.nbytes + mat.indices.nbytes
 	elif type(mat) == sp.lil_matrix:
 		nbytes = mat.data.nbytes + mat.rows.nbytes
@@ -86,19 +422,30 @@ def sparse_matrix_size(mat):
 
 ################################ Classes ################################
 class Signature(object):
+	# metrics for querying the DB, the weighted ones use `gene_vals`
+	metrics = ['signed_jaccard', 'cosine', 'weighted_signed_overlap']
+	# signs of the scores of the query results
+	directions = ['similar', 'opposite']
+
 	def __init__(self, name=None, meta=None, up_genes=None, dn_genes=None, 
-		query_params={'direction': 'similar', 'db_version':'v1.0'}):
+		query_params={'direction': 'similar', 'db_version':'v1.0'}, gene_vals=None):
 		## defaults:
 		if name is None: name = ''
 		if meta is None: meta = {}
 		if up_genes is None: up_genes = []
 		if dn_genes is None: dn_genes = []
+		if gene_vals and not (up_genes or dn_genes):
+			# [(gene, value)] of a weighted signature
+			up_genes = [gene for gene, val in gene_vals if val > 0]
+			dn_genes = [gene for gene, val in gene_vals if val < 0]
 
 		self.name = name
 		self.meta = meta
 		self.up_genes = up_genes
 		self.dn_genes = dn_genes
+		self.gene_vals = gene_vals
 		self.query_params = query_params
+		self.hash = None # set when saved or retrieved from COLL_USER_SIGS
 
 	def save(self):
 		'''Hash the attributes associate with self as well as query params,
@@ -107,10 +454,13 @@ class Signature(object):
 		d = {'name': self.name, 'meta': self.meta, 
 			'up_genes': self.up_genes, 'dn_genes': self.dn_genes,
 			'query_params': self.query_params}
+		if self.gene_vals:
+			d['gene_vals'] = self.gene_vals
 
 		h = hashlib.md5(json.dumps(d)).hexdigest()
 		d['id'] = h
 		COLL_USER_SIGS.update_one({'id': h}, {'$set': d}, upsert=True)
+		self.hash = h
 		return h
 
 	def init_vectors(self):	
@@ -127,91 +477,237 @@ class Signature(object):
 		self.v_up = v_up
 		self.v_dn = v_dn
 
+		if self.gene_vals:
+			# vector of values for weighted metrics
+			v_w = np.zeros(len(ALL_GENES_I), dtype=np.float64)
+			for gene, val in self.gene_vals:
+				i = GENE_I_IDX.get(gene.upper(), None)
+				if i is not None:
+					v_w[i] = val
+			self.v_w = v_w
+
+	def calc_scores(self, db_sig_collection):
+		'''
+		Calcuated signed jaccard score (or the weighted `metric` in query_params) 
+		for this signatures against a DBSignatureCollection instance or 
+		a list of DBSignatureCollection instances.
+		Return arrays of uids and scores.
+		'''
+		if type(db_sig_collection) == list: 
+			# a list of DBSignatureCollection instances, 
+			# use the cached group with stacked matrices
+			db_sig_collection = DBSignatureCollectionGroup.get(db_sig_collection)
+
+		metric = self.query_params.get('metric', 'signed_jaccard')
+		if metric == 'signed_jaccard':
+			# approximate query mode using LSH
+			mode = self.query_params.get('mode', 'exact')
+			n_bands = self.query_params.get('approx_bands', None)
+			scores = db_sig_collection.signed_jaccard(self.v_up, self.v_dn, 
+				mode=mode, n_bands=n_bands)
+		else:
+			scores = db_sig_collection.weighted_similarity(self.v_w, metric)
+		uids = db_sig_collection.uids
+
+		return np.asarray(uids), scores
+
 	def calc_all_scores(self, db_sig_collection):
 		'''
 		Calcuated signed jaccard score for this signatures against 
 		a DBSignatureCollection instance or a list of DBSignatureCollection instances.
+		Return a dict of {uid: score}.
 		'''
-		uid_scores = []
-		if type(db_sig_collection) != list: 
-			# a single DBSignatureCollection instance
-			scores = fast_signed_jaccard(db_sig_collection.mat_up, db_sig_collection.mat_dn, 
-				self.v_up, self.v_dn)
-			uids = db_sig_collection.uids
-
-		else:
-			# a list of DBSignatureCollection instances
-			# stack sparse matrices first
-			mat_up = sp.vstack([dbsc.mat_up for dbsc in db_sig_collection])
-			mat_dn = sp.vstack([dbsc.mat_dn for dbsc in db_sig_collection])
-			scores = fast_signed_jaccard(mat_up, mat_dn, 
-				self.v_up, self.v_dn)
-			uids = []
-			for dbsc in db_sig_collection:
-				uids.extend(dbsc.uids)
-		
+		uids, scores = self.calc_scores(db_sig_collection)
 		uid_scores = zip(uids, scores)
 		return dict(uid_scores)
 
-	def _get_query_results(self, db_sig_collection):
+	def _select_results(self, db_sig_collection, top_k=None, min_abs_score=0, 
+		offset=0):
 		'''
-		Handle querying signatures from the DB with custom up/down genes,
-		return a list of objects
+		Score the signatures in the DB with custom up/down genes, return the 
+		collection, rows and scores of the page of results starting at `offset` 
+		with at most `top_k` signatures having abs(score) >= `min_abs_score`.
 		'''
 		direction = self.query_params['direction']
-
-		d_uid_score = self.calc_all_scores(db_sig_collection)
-
-		scores = np.array(d_uid_score.values())
-		uids = np.array(d_uid_score.keys())
-		uid_data = [] # a list of meta data {} sorted by score
-
-		# mask for signs of scores
-		if direction == 'similar':
-			score_sign_mask = scores > 0
-		elif direction == 'opposite':
-			score_sign_mask = scores < 0
-		# sort uids by abs(scores) in descending order
-		srt_idx = np.abs(scores[score_sign_mask]).argsort()[::-1]
-		scores = scores[score_sign_mask][srt_idx]
-		uids = uids[score_sign_mask][srt_idx]
-
-		# retrieve meta-data for all uids
-		projection ={'geo_id':True, 'id':True, '_id':False,
-			'hs_gene_symbol':True, 'mm_gene_symbol':True, 'organism':True, 
-			'disease_name':True, 'drug_name':True, 'do_id':True,
-			'drugbank_id':True, 'pubchem_cid':True}
-		uid_docs = COLL.find({'id': {'$in': uids.tolist()}}, projection)
-
-		uid_docs = list(uid_docs)
-		# make uid_docs have the same order of id with uids
-		uids = uids.tolist()
-		uid_docs_ = [None] * len(uid_docs)
-		for uid_doc in uid_docs:
-			idx = uids.index(uid_doc['id'])
-			uid_docs_[idx] = uid_doc
-		uid_docs = uid_docs_
-
-		for doc, score in zip(uid_docs, scores):
-			sig_ = DBSignature(None, doc=doc)
-			meta = {
-				'id': sig_.meta['id'],
-				'geo_id': sig_.meta['geo_id'],
-				'name': [sig_.name, sig_.get_url()], # [name, url]
-				'signed_jaccard': float('%.5f'%score)
-			}
-			uid_data.append(meta)
+		metric = self.query_params.get('metric', 'signed_jaccard')
+		mode = self.query_params.get('mode', 'exact')
+		if type(db_sig_collection) == list: 
+			db_sig_collection = DBSignatureCollectionGroup.get(db_sig_collection)
+		# only partially sort the scores when top_k is given
+		if top_k is None:
+			k = None
+		else:
+			k = offset + top_k
+
+		scorer = executor.SCORER
+		top = None
+		if scorer is not None and metric == 'signed_jaccard' and mode == 'exact' and \
+			not db_sig_collection.use_postings(np.flatnonzero(self.v_up), 
+				np.flatnonzero(self.v_dn)):
+			# score the shards of the collections in parallel processes, small
+			# queries are faster with the inverted index in this process.
+			# None if the generations of the collections are not registered
+			with METRICS.stage('score'):
+				top = scorer.top_signed_jaccard(db_sig_collection, 
+					self.v_up, self.v_dn, direction, k, min_abs_score)
+		if top is not None:
+			rows, scores = top
+		else:
+			with METRICS.stage('score'):
+				_, scores = self.calc_scores(db_sig_collection)
+			# select rows by abs(scores) in descending order
+			with METRICS.stage('select'):
+				rows = executor.select_scores(scores, direction, k, min_abs_score)
+				scores = scores[rows]
+		return db_sig_collection, rows[offset:], scores[offset:]
+
+	def _cached_select_results(self, db_sig_collection, key, top_k=None, 
+		min_abs_score=0, offset=0):
+		'''
+		Like _select_results, the rows and scores selected for saved 
+		signatures are cached in RESULT_CACHE under `key` + ('rows',).
+		'''
+		rows_key = key + ('rows',)
+		if self.hash is not None:
+			selected = RESULT_CACHE.get(rows_key)
+			if selected is not None:
+				if type(db_sig_collection) == list: 
+					db_sig_collection = DBSignatureCollectionGroup.get(db_sig_collection)
+				rows, scores = selected
+				return db_sig_collection, rows, scores
+
+		if not hasattr(self, 'v_up'):
+			with METRICS.stage('init_vectors'):
+				self.init_vectors()
+		db_sig_collection, rows, scores = self._select_results(db_sig_collection, 
+			top_k=top_k, min_abs_score=min_abs_score, offset=offset)
+		if self.hash is not None:
+			# copy the page out of the arrays of all the selected rows
+			RESULT_CACHE.set(rows_key, (np.array(rows), np.array(scores)))
+		return db_sig_collection, rows, scores
+
+	def _get_query_results(self, db_sig_collection, key, top_k=None, min_abs_score=0, 
+		offset=0):
+		'''
+		Handle querying signatures from the DB with custom up/down genes,
+		return a list of objects for the page of results.
+		'''
+		metric = self.query_params.get('metric', 'signed_jaccard')
+		db_sig_collection, rows, scores = self._cached_select_results(db_sig_collection, 
+			key, top_k=top_k, min_abs_score=min_abs_score, offset=offset)
+		# format only the results in this page
+		with METRICS.stage('format'):
+			uid_data = db_sig_collection.result_meta(rows, scores, score_name=metric)
 		return uid_data
 
-	def get_query_results(self, d_dbsc):
-		'''Wrapper for _get_query_results handling db_version
-		'''
+	def _results_key(self, d_dbsc, page):
+		## the collection(s) of db_version, their generations and the key of 
+		## a page of results in RESULT_CACHE
 		db_version = self.query_params['db_version']
 		if type(db_version) != list:
-			uid_data = self._get_query_results(d_dbsc[db_version])
+			db_sig_collection = d_dbsc[db_version]
+			generations = DBSignatureCollectionGroup.make_key([db_sig_collection])
 		else:
-			uid_data = self._get_query_results([d_dbsc[v] for v in db_version])
-		return uid_data
+			db_sig_collection = [d_dbsc[v] for v in db_version]
+			generations = DBSignatureCollectionGroup.make_key(db_sig_collection)
+		return db_sig_collection, generations, (self.hash, generations, page)
+
+	def _cached_query_results(self, generations, key):
+		## get a page of results as JSON from RESULT_CACHE or the DB, None if missing
+		if self.hash is None:
+			return None
+		json_str = RESULT_CACHE.get(key)
+		if json_str is None and app.config.get('RESULT_CACHE_PERSIST', False):
+			uid_data = load_saved_results(self.hash, generations, key[2])
+			if uid_data is not None:
+				json_str = json.dumps(uid_data)
+				RESULT_CACHE.set(key, json_str)
+		return json_str
+
+	def get_query_results_json(self, d_dbsc, top_k=None, min_abs_score=0, offset=0):
+		'''Wrapper for _get_query_results handling db_version, returning the
+		page of results serialized as JSON. Results of saved signatures are 
+		cached as JSON by their hash and the generations of the collections, 
+		in RESULT_CACHE and optionally (RESULT_CACHE_PERSIST) in COLL_USER_SIGS.
+		'''
+		page = (top_k, min_abs_score, offset)
+		db_sig_collection, generations, key = self._results_key(d_dbsc, page)
+		with METRICS.stage('result_cache'):
+			json_str = self._cached_query_results(generations, key)
+		if json_str is not None:
+			return json_str
+
+		uid_data = self._get_query_results(db_sig_collection, key,
+			top_k=top_k, min_abs_score=min_abs_score, offset=offset)
+		with METRICS.stage('serialize'):
+			json_str = json.dumps(uid_data)
+		if self.hash is not None:
+			if app.config.get('RESULT_CACHE_PERSIST', False):
+				with METRICS.stage('save_results'):
+					save_results(self.hash, generations, page, uid_data)
+			RESULT_CACHE.set(key, json_str)
+		return json_str
+
+	def iter_query_results(self, d_dbsc, top_k=None, min_abs_score=0, offset=0, 
+		chunk_size=1000):
+		'''Like get_query_results_json, but return an iterator of the results in 
+		lists of at most `chunk_size` objects. The results are selected when 
+		called, only formatting them from the meta data columns of the 
+		collection is deferred to the iteration, so that large results are 
+		never held in memory as a whole. The formatted results are not cached.
+		'''
+		page = (top_k, min_abs_score, offset)
+		db_sig_collection, generations, key = self._results_key(d_dbsc, page)
+		with METRICS.stage('result_cache'):
+			json_str = self._cached_query_results(generations, key)
+		if json_str is not None:
+			uid_data = json.loads(json_str)
+			return (uid_data[start:start+chunk_size] 
+				for start in xrange(0, len(uid_data), chunk_size))
+
+		metric = self.query_params.get('metric', 'signed_jaccard')
+		db_sig_collection, rows, scores = self._cached_select_results(db_sig_collection, 
+			key, top_k=top_k, min_abs_score=min_abs_score, offset=offset)
+		return (db_sig_collection.result_meta(rows[start:start+chunk_size], 
+			scores[start:start+chunk_size], score_name=metric)
+			for start in xrange(0, len(rows), chunk_size))
+
+	@classmethod
+	def batch_query_results(cls, signatures, d_dbsc, top_k=50, chunk_size=100):
+		'''
+		Query the DB with many Signature instances at once. Signatures sharing 
+		the same db_version are stacked into sparse query matrices, which are 
+		scored against the (stacked) DBSignatureCollection with sparse matrix 
+		products.
+		Return a list of the top_k query results for each signature, in the
+		same order as `signatures`.
+		'''
+		# group signatures by db_version
+		d_version_idx = {}
+		for i, sig in enumerate(signatures):
+			db_version = sig.query_params['db_version']
+			if type(db_version) != list:
+				db_version = [db_version]
+			d_version_idx.setdefault(tuple(db_version), []).append(i)
+
+		results = [None] * len(signatures)
+		for db_version, sig_idx in d_version_idx.items():
+			# a single collection or the cached group of stacked collections
+			dbsc = DBSignatureCollectionGroup.get([d_dbsc[v] for v in db_version])
+			for start in xrange(0, len(sig_idx), chunk_size):
+				chunk_idx = sig_idx[start:start+chunk_size]
+				sigs = [signatures[i] for i in chunk_idx]
+				qmat_up = genes_to_matrix([sig.up_genes for sig in sigs])
+				qmat_dn = genes_to_matrix([sig.dn_genes for sig in sigs])
+
+				scores = batch_signed_jaccard(dbsc.mat_up, dbsc.mat_dn, 
+					qmat_up, qmat_dn).tocsc()
+				for j, (i, sig) in enumerate(zip(chunk_idx, sigs)):
+					rows = scores.indices[scores.indptr[j]:scores.indptr[j+1]]
+					col = scores.data[scores.indptr[j]:scores.indptr[j+1]]
+					srt_idx = executor.select_scores(col, sig.query_params['direction'], top_k)
+					results[i] = dbsc.result_meta(rows[srt_idx], col[srt_idx])
+		return results
 
 	@classmethod
 	def from_hash(cls, h):
@@ -219,12 +715,58 @@ class Signature(object):
 		if h is None:
 			return None
 		else:
-			doc = COLL_USER_SIGS.find_one({'id': h}, {'_id': False, 'id': False})
+			doc = COLL_USER_SIGS.find_one({'id': h}, 
+				{'_id': False, 'id': False, 'results_key': False, 'results': False, 
+				'results_pages': False})
 			signature = Signature(**doc)
+			signature.hash = h
 			return signature
 
 
-class DBSignature(Signature):
+class SignatureExport(object):
+	'''
+	Methods to export a signature from the mongodb, shared by DBSignature and 
+	CollectionSignature which provide `name`, `meta` and `get_cd_values`.
+	'''
+	__slots__ = ()
+
+	def fill_top_genes(self, cutoff=None):
+		'''Get top up/dn genes from the CD values, 
+		only the top `cutoff` genes by abs(vals) if given
+		'''
+		idx, vals = self.get_cd_values()
+		return top_genes(idx, vals, cutoff=cutoff)
+
+
+	def to_json(self, meta_only=False, cutoff=None):
+		## to export the document into json
+		json_data = self.meta
+		if not meta_only:
+			up_genes, dn_genes = self.fill_top_genes(cutoff=cutoff)
+			json_data['up_genes'] = up_genes
+			json_data['down_genes'] = dn_genes
+
+		return json.dumps(json_data)
+
+	def to_dict(self, format='gmt'):
+		## method to generate files for downloading
+		if format == 'gmt':
+			dict_data = {'name': self.name, 'id': self.meta['id']}			
+		else:
+			dict_data = self.meta
+
+		up_genes, dn_genes = self.fill_top_genes()
+		dict_data['up_genes'] = up_genes
+		dict_data['down_genes'] = dn_genes
+		return dict_data
+
+
+	def get_url(self):
+		## get the url of the signature's gene, disease or drug
+		return find_url(self.meta, self.name)
+
+
+class DBSignature(Signature, SignatureExport):
 	'''
 	Signature instance from the mongodb.
 	'''
@@ -248,41 +790,26 @@ class DBSignature(Signature):
 		if hasattr(self, 'chdir'): return True
 		else: return False
 
-	def get_vectors_and_clear(self, cutoff=600):
-		v_cs = np.zeros(len(ALL_GENES), dtype=np.float32)
-
-
-		genes = self.chdir['genes'][:cutoff]
-
-		genes, uniq_idx = np.unique(genes, return_index=True)
-		vals = np.array(self.chdir['vals'][:cutoff])[uniq_idx]
-
-		v_cs[np.in1d(ALL_GENES, genes)] = vals
-
-		self.v_cs = sp.lil_matrix(v_cs)
-
-		up_genes_i = map(lambda x: x.upper(), genes[vals > 0])
-		dn_genes_i = map(lambda x: x.upper(), genes[vals < 0])
-
-		up_idx = np.in1d(ALL_GENES_I, up_genes_i, assume_unique=True)
-		dn_idx = np.in1d(ALL_GENES_I, dn_genes_i, assume_unique=True)
+	def get_gene_indexes_and_clear(self, cutoff=600):
+		'''
+		Get the indexes in ALL_GENES and ALL_GENES_I (-1 if missing) of the 
+		top `cutoff` unique genes and their CD values, then clear `chdir`.
+		Used for construction of the matrices in DBSignatureCollection.
+		'''
+		genes = []
+		vals = []
+		seen = set()
+		for gene, val in zip(self.chdir['genes'][:cutoff], self.chdir['vals'][:cutoff]):
+			if gene not in seen:
+				seen.add(gene)
+				genes.append(gene)
+				vals.append(val)
+
+		idx_cs = np.array([GENE_CS_IDX.get(gene, -1) for gene in genes], dtype=np.int64)
+		idx_i = np.array([GENE_I_IDX.get(gene.upper(), -1) for gene in genes], dtype=np.int64)
 		del self.chdir
-		return up_idx, dn_idx
-
+		return idx_cs, idx_i, np.array(vals, dtype=np.float32)
 
-	def get_vector_indexes(self, cutoff=600):
-		'''
-		Get indexes of up and down genes in ALL_GENES_I
-		Used for construction of sparse matices in DBSignatureCollection.mat_*
-		'''	
-		genes_i = np.array(map(lambda x:x.upper(), self.chdir['genes'][:cutoff]))
-		genes_i, uniq_idx = np.unique(genes_i, return_index=True)
-		vals = np.array(self.chdir['vals'][:cutoff])[uniq_idx]
-		up_genes_i = genes_i[vals > 0]
-		dn_genes_i = genes_i[vals < 0]
-		up_idx = np.in1d(ALL_GENES_I, up_genes_i, assume_unique=True)
-		dn_idx = np.in1d(ALL_GENES_I, dn_genes_i, assume_unique=True)
-		return up_idx, dn_idx
 
 	def init_cs_vectors(self, cutoff=600):
 		'''Init case sensitive vectors with CD values. 
@@ -294,69 +821,32 @@ class DBSignature(Signature):
 			genes, uniq_idx = np.unique(genes, return_index=True)
 			vals = np.array(self.chdir['vals'][:cutoff])[uniq_idx]
 
-			v_cs[np.in1d(ALL_GENES, genes)] = vals
+			idx = np.array([GENE_CS_IDX.get(gene, -1) for gene in genes], dtype=np.int64)
+			mask = idx >= 0
+			v_cs[idx[mask]] = vals[mask]
 			self.v_cs = sp.lil_matrix(v_cs)
 
-	def fill_top_genes(self):
-		'''Get top up/dn genes from `v_cs`
-		'''
-		# get mask of non zero index
-		mask_non_zero = (self.v_cs != 0).toarray().ravel()
-		# retrieve CD vals and genes
-		vals = self.v_cs[0, mask_non_zero].toarray().ravel()
-		genes = ALL_GENES[mask_non_zero]
-		# sort CD vals on abs(vals)
-		srt_idx = np.abs(vals).argsort()[::-1]
-
-		up_genes = []
-		dn_genes = []
-		for gene, val in zip(genes[srt_idx].tolist(), vals[srt_idx].tolist()):
-			if val > 0: 
-				up_genes.append( (gene, val) )
-			else: 
-				dn_genes.append( (gene, val) )
-		return up_genes, dn_genes
-
-
 	def clear(self, cutoff=600):
 		'''Clear unnecessary fields to reduce RAM usage.
 		'''
 		self.init_cs_vectors(cutoff=cutoff)
 		del self.chdir
 
+	def get_cd_values(self):
+		## indexes in ALL_GENES and CD values of the genes in `v_cs`
+		v_cs = self.v_cs.tocsr()
+		return v_cs.indices, v_cs.data
+
 	def __sizeof__(self):
 		size = sum(map(sys.getsizeof, [self.name, self.meta]))
 		size += sparse_matrix_size(self.v_cs)
 		return size
 
-	def to_json(self, meta_only=False):
-		## to export the document into json
-		json_data = self.meta
-		if not meta_only:
-			up_genes, dn_genes = self.fill_top_genes()
-			json_data['up_genes'] = up_genes
-			json_data['down_genes'] = dn_genes
-
-		return json.dumps(json_data)
-
-	def to_dict(self, format='gmt'):
-		## method to generate files for downloading
-		if format == 'gmt':
-			dict_data = {'name': self.name, 'id': self.meta['id']}			
-		else:
-			dict_data = self.meta
-
-		up_genes, dn_genes = self.fill_top_genes()
-		dict_data['up_genes'] = up_genes
-		dict_data['down_genes'] = dn_genes
-		return dict_data
-
-
 	def post_to_paea(self, cutoff=2000):
 		## post top n genes to PAEA and return a PAEA url
 		## return None if instance has no chdir
-		post_url = 'http://amp.pharm.mssm.edu/Enrichr/addList'
-		base_url = 'http://amp.pharm.mssm.edu/PAEA?id='
+		post_url = app.config.get('PAEA_POST_URL', 'http://amp.pharm.mssm.edu/Enrichr/addList')
+		base_url = app.config.get('PAEA_BASE_URL', 'http://amp.pharm.mssm.edu/PAEA?id=')
 		paea_url = None
 		if self.has_chdir():
 			up_genes, dn_genes = self.fill_top_genes()
@@ -365,13 +855,15 @@ class DBSignature(Signature):
 				gene_list.append( '%s,%s\n'% (gene, coef) )
 			gene_list = ''.join(gene_list)
 			data = {'list': gene_list, 'inputMethod': "PAEA", 'description': self.name}
-			r = requests.post(post_url, files=data)
+			r = HTTP_SESSION.post(post_url, files=data, 
+				timeout=app.config.get('HTTP_TIMEOUT', 10))
+			r.raise_for_status()
 			paea_url = base_url + str(json.loads(r.text)['userListId'])
 		return paea_url
 
 	def post_to_cds2(self, cutoff=2000):
 		## post top n genes to L1000CDS2 API and return a CDS2 url
-		url = 'http://amp.pharm.mssm.edu/L1000CDS2/query'
+		url = app.config.get('CDS2_POST_URL', 'http://amp.pharm.mssm.edu/L1000CDS2/query')
 		cds2_url = None
 		if self.has_chdir():
 			up_genes, dn_genes = self.fill_top_genes()
@@ -386,77 +878,362 @@ class DBSignature(Signature):
 					metadata.append({"key":key, "value":val})
 			payload = {"data":data,"config":config,"meta":metadata}
 			headers = {'content-type':'application/json'}
-			r = requests.post(url,data=json.dumps(payload),headers=headers)
+			r = HTTP_SESSION.post(url,data=json.dumps(payload),headers=headers, 
+				timeout=app.config.get('HTTP_TIMEOUT', 10))
+			r.raise_for_status()
 			resCD = r.json()
 			shareId = resCD['shareId']
-			cds2_url = 'http://amp.pharm.mssm.edu/L1000CDS2/#/result/' + shareId
+			cds2_url = app.config.get('CDS2_BASE_URL', 
+				'http://amp.pharm.mssm.edu/L1000CDS2/#/result/') + shareId
 		return cds2_url
 
-	def get_url(self):
-		## get the url of the signature's gene, disease or drug
-		url = ''
-		meta = self.meta
-		uid = meta['id']
-		if ':P' not in uid: # not v2.0 signature
-			if uid.startswith('gene:'):
-				organism = meta['organism']
-				if organism == 'human':
-					gene_symbol = meta['hs_gene_symbol']
-					if gene_symbol is None:
-						gene_symbol = meta['mm_gene_symbol']
-				else:
-					gene_symbol = meta['mm_gene_symbol']
-					if gene_symbol is None:
-						gene_symbol = meta['hs_gene_symbol']
-						
-				gene_id = GENE_SYMBOLS.get(gene_symbol, '')
-				url = 'http://www.ncbi.nlm.nih.gov/gene/%s' % gene_id
-
-			elif uid.startswith('dz:'):
-				do_id = meta.get('do_id', None)
-				if do_id is not None:
-					url = 'http://disease-ontology.org/term/%s' % do_id
-				else:
-					url = 'https://www.google.com/search?q=%s' % self.name.replace(' ', '+')
-			else:
-				db_id = meta.get('drugbank_id', None)
-				pubchem_cid = meta.get('pubchem_cid', None)
-				if db_id is not None:
-					url = 'http://www.drugbank.ca/drugs/%s' % db_id
-				elif pubchem_cid is not None:
-					url = 'https://pubchem.ncbi.nlm.nih.gov/compound/%s' % pubchem_cid
-				else:
-					url = 'https://www.google.com/search?q=%s' % self.name.replace(' ', '+')
-
-		else: # v2.0 signature
-			if uid.startswith('gene:'): key = 'hs_gene_symbol'
-			elif uid.startswith('dz:'): key = 'disease_name'
-			else: key = 'drug_name'
-			# becas concept ids
-			cids = [':'.join(item.get('cid', ':').split(':')[:2]) for item in meta.get(key, [])]
-			url_root = 'http://bioinformatics.ua.pt/becas/api/concept/redirect/'
-			url = [url_root + cid for cid in cids]
-
-		return url	
-
-
-def wrapper_func(i, doc):
+
+class CollectionSignature(SignatureExport):
+	'''
+	A lightweight view of the signature in a row of a DBSignatureCollection, 
+	reading its meta data and CD values from the arrays of the collection.
+	'''
+	__slots__ = ('collection', 'row')
+
+	def __init__(self, collection, row):
+		self.collection = collection
+		self.row = row
+
+	@property
+	def meta(self):
+		## a new dict parsed from the meta data stored as JSON in the collection
+		return json_util.loads(self.collection.metas[self.row])
+
+	@property
+	def name(self):
+		return find_name(self.meta)
+
+	def get_cd_values(self):
+		## indexes in ALL_GENES and CD values from the row of mat_cs
+		mat_cs = self.collection.mat_cs
+		start, end = mat_cs.indptr[self.row], mat_cs.indptr[self.row + 1]
+		return mat_cs.indices[start:end], mat_cs.data[start:end]
+
+
+def wrapper_func(i, doc, cutoff=600):
 	sig = DBSignature(None, doc=doc)
-	# sig.fill_top_genes()
-	# fill the sparse matrices
-	# up_idx, dn_idx = sig.get_vector_indexes()
-	# mat_up[i, up_idx] = 1
-	# mat_dn[i, dn_idx] = 1
-	# clear `chdir` field and add `v_cs` for exporting
-	# sig.clear(cutoff=600)
-	# if i % 5 == 0:
-	# 	print i
-	up_idx, dn_idx = sig.get_vectors_and_clear()
+	idx_cs, idx_i, vals = sig.get_gene_indexes_and_clear(cutoff=cutoff)
 
 	uid = doc['id']
-	return uid, sig, up_idx, dn_idx
+	return uid, sig, idx_cs, idx_i, vals
+
+
+def signatures_to_matrices(tuple_list):
+	## build uids and matrices from the outputs of wrapper_func, 
+	## the rows of the matrices are in the same order as the uids
+	uids = [uid for uid, _, _, _, _ in tuple_list]
+	mat_up, mat_dn, mat_cs = gene_index_matrices(
+		[(idx_cs, idx_i, vals) for _, _, idx_cs, idx_i, vals in tuple_list],
+		len(ALL_GENES), len(ALL_GENES_I))
+	return uids, mat_up, mat_dn, mat_cs
+
+
+def _csv_value(val):
+	## format a value of meta data for a cell in download csv files
+	if val is None:
+		return ''
+	elif type(val) == list:
+		return '|'.join(map(unicode, filter(None, val))).encode('utf-8')
+	return unicode(val).encode('utf-8')
+
+
+def write_download_file(format, outfn, uids, metas, mat_cs):
+	'''
+	Write the signatures of a category into a download file, a row at a time 
+	from their `metas` (JSON) and CD values in the rows of `mat_cs`, 
+	along with a gzipped copy of the file. 
+	Return the filename and the number of signatures.
+	'''
+	tmpfn = outfn + '.tmp'
+	with open(tmpfn, 'wb') as out:
+		if format == 'gmt':
+			for i, uid in enumerate(uids):
+				name = find_name(json_util.loads(metas[i]))
+				if type(name) == list: # join list to string for v2.0
+					name = '|'.join(filter(None, name))
+				start, end = mat_cs.indptr[i], mat_cs.indptr[i+1]
+				up_genes, dn_genes = top_genes(mat_cs.indices[start:end], 
+					mat_cs.data[start:end])
+				line_up = [ name + '-up', uid ] + [gene for gene, _ in up_genes]
+				line_dn = [ name + '-dn', uid ] + [gene for gene, _ in dn_genes]
+				out.write('\t'.join(line_up).encode('utf-8') + '\n')
+				out.write('\t'.join(line_dn).encode('utf-8') + '\n')
+
+		elif format == 'csv': # annotations only
+			docs = (json_util.loads(meta) for meta in metas)
+			# columns from a first pass over the meta data
+			columns = set()
+			for doc in docs:
+				columns.update(doc.keys())
+			columns = ['id'] + sorted(columns - set(['id', 'entities']))
+			writer = csv.writer(out)
+			writer.writerow(columns)
+			for meta in metas:
+				doc = json_util.loads(meta)
+				if 'entities' in doc: # predicted signatures
+					# need to unpack fields that are dict
+					for field in ['hs_gene_symbol', 'disease_name', 'drug_name', 'cell_type']:
+						if field in doc:
+							doc[field] = [item.get('name', None) for item in doc[field]]
+				writer.writerow([_csv_value(doc.get(col, None)) for col in columns])
+
+		else:
+			out.write('[')
+			for i, meta in enumerate(metas):
+				doc = json_util.loads(meta)
+				start, end = mat_cs.indptr[i], mat_cs.indptr[i+1]
+				doc['up_genes'], doc['down_genes'] = top_genes(
+					mat_cs.indices[start:end], mat_cs.data[start:end])
+				if i > 0:
+					out.write(', ')
+				out.write(json.dumps(doc))
+			out.write(']')
+
+	with open(tmpfn, 'rb') as f_in, gzip.open(tmpfn + '.gz', 'wb') as f_out:
+		shutil.copyfileobj(f_in, f_out)
+	os.rename(tmpfn + '.gz', outfn + '.gz')
+	os.rename(tmpfn, outfn)
+	return (outfn, len(uids))
+
+
+class SignatureMatrices(object):
+	'''
+	Binary matrices of up/down genes of signatures (rows) over ALL_GENES_I 
+	(columns) computing signed jaccard against them, and the matrix of CD 
+	values of signatures over ALL_GENES, merged over ALL_GENES_I for weighted
+	metrics.
+	Subclasses set `uids`, `mat_up`, `mat_dn`, `mat_cs`, `meta_columns` 
+	then call `init_scoring`.
+	'''
+	# kwargs of init_lsh if LSH tables are built for approximate queries
+	lsh_params = None
+	# queries whose genes have postings shorter than this fraction of 
+	# the nnz of the matrices are scored using the inverted index instead
+	postings_max_ratio = 0.5
+
+	def init_scoring(self):
+		'''Prepare the inverted index (gene -> signatures) for small queries
+		and the matrix of CD values over ALL_GENES_I with its norms for 
+		weighted metrics.
+		'''
+		self.sizes_up = self.mat_up.getnnz(axis=1)
+		self.sizes_dn = self.mat_dn.getnnz(axis=1)
+		# CSC views of the matrices are the postings lists of each gene
+		self.csc_up = self.mat_up.tocsc()
+		self.csc_dn = self.mat_dn.tocsc()
+		# one value for each gene: the case variant with the largest abs(value),
+		# so that genes with several variants in a signature count once
+		self.mat_ci = max_abs_merge_columns(self.mat_cs, ALL_GENES_CS2I, len(ALL_GENES_I))
+		self.norms_ci = row_norms(self.mat_ci)
+		self.max_abs_ci = row_max_abs(self.mat_ci)
+		return
+
+	def init_lsh(self, n_hashes=128, n_bands=64, seed=0):
+		'''Build MinHash sketches and LSH tables of the up and down gene sets
+		used by the approximate query mode.
+		'''
+		self.lsh_params = dict(n_hashes=n_hashes, n_bands=n_bands, seed=seed)
+		# the same hash functions for up and down sets, so one query sketch 
+		# can be looked up in both tables
+		self.lsh_up = MinHashLSH(**self.lsh_params).fit(self.mat_up)
+		self.lsh_dn = MinHashLSH(**self.lsh_params).fit(self.mat_dn)
+		return
+
+	def approx_signed_jaccard(self, v_up, v_dn, n_bands=None):
+		'''Compute signed jaccard only for the candidate signatures sharing an
+		LSH band with the query up or down genes, other signatures get 0. 
+		Using fewer `n_bands` lowers the recall and the latency.
+		'''
+		up_idx = np.flatnonzero(v_up)
+		dn_idx = np.flatnonzero(v_dn)
+		candidates = [lsh.query(idx, n_bands) for lsh in (self.lsh_up, self.lsh_dn) 
+			for idx in (up_idx, dn_idx)]
+		rows = np.unique(np.concatenate(candidates))
+
+		scores = np.zeros(self.mat_up.shape[0])
+		if len(rows) > 0:
+			scores[rows] = fast_signed_jaccard(self.mat_up[rows], self.mat_dn[rows], 
+				v_up, v_dn)
+		return scores
+
+	def lsh_recall(self, jaccard, n_bands=None):
+		'''Expected probability for a signature with the given jaccard index of
+		up (or down) genes with the query to be a candidate in approx mode.
+		'''
+		lsh = self.lsh_up
+		if n_bands is None or n_bands > lsh.n_bands:
+			n_bands = lsh.n_bands
+		return lsh_collision_probability(jaccard, lsh.band_size, n_bands)
+
+	def postings_length(self, up_idx, dn_idx):
+		'''Total length of the postings visited to score a query.
+		'''
+		length_up = np.diff(self.csc_up.indptr)
+		length_dn = np.diff(self.csc_dn.indptr)
+		return length_up[up_idx].sum() + length_dn[up_idx].sum() + \
+			length_up[dn_idx].sum() + length_dn[dn_idx].sum()
+
+	def use_postings(self, up_idx, dn_idx):
+		'''Whether a query with genes `up_idx`, `dn_idx` is scored faster 
+		with the inverted index than with the matrices.
+		'''
+		nnz = self.mat_up.nnz + self.mat_dn.nnz
+		return self.postings_length(up_idx, dn_idx) < self.postings_max_ratio * nnz
+
+	def init_generation(self):
+		'''Fingerprint the content of the signatures: the uids, the genes and 
+		CD values in the matrices and the meta data, which changes whenever 
+		the signatures are reloaded with different content. The matrices are
+		hashed in a canonical layout, so the same content always gets the
+		same generation.
+		'''
+		h = hashlib.md5('\n'.join(self.uids))
+		for mat, values in ((self.mat_up, False), (self.mat_dn, False), (self.mat_cs, True)):
+			if not mat.has_sorted_indices:
+				mat = mat.sorted_indices()
+			h.update(mat.indptr.astype(np.int64).tostring())
+			h.update(mat.indices.astype(np.int64).tostring())
+			if values: # the binary matrices only hold ones
+				h.update(mat.data.astype(np.float32).tostring())
+		# metas are dumped with sorted keys, so the same meta data has the same json
+		h.update('\n'.join(self.metas))
+		self.generation = h.hexdigest()
+		return
+
+	def signed_jaccard(self, v_up, v_dn, mode='exact', n_bands=None):
+		'''Compute signed jaccard between all signatures in this collection 
+		and binary vectors (v_up, v_dn) using the inverted index for small 
+		queries, otherwise sparse dot products on the csr matrices.
+		With mode='approx', only candidates found by LSH are scored if the
+		LSH tables were built.
+		'''
+		if mode == 'approx' and self.lsh_params is not None:
+			return self.approx_signed_jaccard(v_up, v_dn, n_bands=n_bands)
+
+		up_idx = np.flatnonzero(v_up)
+		dn_idx = np.flatnonzero(v_dn)
+		if self.use_postings(up_idx, dn_idx):
+			scores = postings_signed_jaccard(self.csc_up, self.csc_dn, 
+				self.sizes_up, self.sizes_dn, up_idx, dn_idx)
+		else:
+			scores = fast_signed_jaccard(self.mat_up, self.mat_dn, v_up, v_dn)
+		return scores
+
+	def weighted_similarity(self, v_w, metric='cosine'):
+		'''Compute weighted similarity between all signatures in this collection
+		and a vector of gene values over ALL_GENES_I.
+		Both metrics use the CD values of the signatures in `mat_ci`.
+		'''
+		if metric not in ('cosine', 'weighted_signed_overlap'):
+			raise ValueError('Unknown metric: %s' % metric)
+		if metric == 'cosine':
+			scores = sparse_cosine(self.mat_ci, self.norms_ci, v_w)
+		else:
+			scores = weighted_signed_overlap(self.mat_ci, self.max_abs_ci, v_w)
+		return scores
+
+	def result_meta(self, rows, scores, score_name='signed_jaccard'):
+		'''Format the signatures in `rows` and their scores as query results, 
+		from the columns of meta data aligned with the rows of the matrices.
+		'''
+		columns = self.meta_columns
+		# round all the scores at once
+		scores = np.round(np.asarray(scores, dtype=np.float64), 5).tolist()
+		uid_data = []
+		for uid, geo_id, name, url, score in zip(columns['id'][rows], 
+			columns['geo_id'][rows], columns['name'][rows], columns['url'][rows], scores):
+			uid_data.append({
+				'id': uid,
+				'geo_id': geo_id,
+				'name': [name, url], # [name, url]
+				score_name: score
+				})
+		return uid_data
 
-class DBSignatureCollection(dict):
+	def matrices_size(self):
+		'''Get the size of the matrices in bytes
+		'''
+		size = sparse_matrix_size(self.mat_up) + sparse_matrix_size(self.mat_dn)
+		size += sparse_matrix_size(self.mat_cs) + sparse_matrix_size(self.mat_ci)
+		size += self.norms_ci.nbytes + self.max_abs_ci.nbytes
+		size += sparse_matrix_size(self.csc_up) + sparse_matrix_size(self.csc_dn)
+		if self.lsh_params is not None:
+			size += self.lsh_up.nbytes + self.lsh_dn.nbytes
+		return size
+
+
+class DBSignatureCollectionGroup(SignatureMatrices):
+	'''
+	A read-only union of several DBSignatureCollection instances with their 
+	matrices and uids stacked, used to query multiple db_versions at once.
+	Instances are cached by `get` for each distinct combination of collections.
+	'''
+	cache = LRUCache(app.config.get('STACKED_CACHE_SIZE', 2e9))
+
+	def __init__(self, db_sig_collections):
+		self.members = db_sig_collections
+		self.name = '+'.join(dbsc.name for dbsc in db_sig_collections)
+		self.uids = np.concatenate([dbsc.uids for dbsc in db_sig_collections])
+		self.mat_up = sp.vstack([dbsc.mat_up for dbsc in db_sig_collections]).tocsr()
+		self.mat_dn = sp.vstack([dbsc.mat_dn for dbsc in db_sig_collections]).tocsr()
+		self.mat_cs = sp.vstack([dbsc.mat_cs for dbsc in db_sig_collections]).tocsr()
+		self.meta_columns = {field: np.concatenate([dbsc.meta_columns[field] 
+			for dbsc in db_sig_collections]) for field in db_sig_collections[0].meta_columns}
+		self.init_scoring()
+		# build LSH tables only if all the members have the same ones
+		lsh_params = [dbsc.lsh_params for dbsc in db_sig_collections]
+		if lsh_params[0] is not None and lsh_params.count(lsh_params[0]) == len(lsh_params):
+			self.init_lsh(**lsh_params[0])
+		self.key = self.make_key(db_sig_collections)
+
+	def __len__(self):
+		return len(self.uids)
+
+	def __sizeof__(self):
+		return self.matrices_size() + sys.getsizeof(self.uids)
+
+	@staticmethod
+	def make_key(db_sig_collections):
+		return tuple((dbsc.name, dbsc.generation) for dbsc in db_sig_collections)
+
+	@classmethod
+	def get(cls, db_sig_collections):
+		'''Get the cached group of `db_sig_collections`, build it if needed.
+		'''
+		if len(db_sig_collections) == 1:
+			return db_sig_collections[0]
+		key = cls.make_key(db_sig_collections)
+		group = cls.cache.get(key)
+		if group is None:
+			# drop groups built from previous generations of these collections
+			current = dict(key)
+			cls.cache.invalidate(lambda k: any(name in current and generation != current[name] 
+				for name, generation in k))
+			group = cls(db_sig_collections)
+			cls.cache.set(key, group)
+		return group
+
+	@classmethod
+	def rebuild(cls, d_dbsc):
+		'''Build the groups of the current generations of the collections in
+		`d_dbsc` replacing the cached groups of previous generations, so that
+		queries after a refresh do not build them.
+		'''
+		for key in cls.cache.keys():
+			names = [name for name, _ in key]
+			if all(name in d_dbsc for name in names):
+				db_sig_collections = [d_dbsc[name] for name in names]
+				if cls.make_key(db_sig_collections) not in cls.cache:
+					cls.get(db_sig_collections)
+		return
+
+
+class DBSignatureCollection(dict, SignatureMatrices):
 	'''
 	A collection of DBSignature from the mongodb
 	'''
@@ -468,69 +1245,252 @@ class DBSignatureCollection(dict):
 		}
 
 	outfn_path = os.path.dirname(os.path.realpath(__file__)) + '/static/downloads/'
-
-	def __init__(self, filter_=None, name=None, limit=None, name_prefix=None):
+	# number of top genes of each signature stored in the matrices
+	n_genes_stored = 600
+	# fields of meta data held in columns, in addition to 'name', 'url' and 'search_names'
+	meta_fields = ['id', 'geo_id', 'organism', 'cell_type', 'platform', 'version']
+	# bumped when the layout of snapshots changes
+	snapshot_version = 3
+
+	def __init__(self, filter_=None, name=None, limit=None, name_prefix=None, 
+		lsh=None):
 		'''
 		`filter_` should be a mongo query
+		`lsh` is an optional dict of kwargs for init_lsh to enable approximate queries
+		The signatures are loaded from the snapshot in app.config['SNAPSHOT_DIR'] 
+		if it is up to date with the DB, otherwise from the DB and then saved
+		as a new snapshot.
 		'''
 		self.filter_ = filter_
 		self.name = name # 'v1.0', 'v1.1', 'p1.0'
 		self.name_prefix = name_prefix # 'Mannual', 'Drug Matrix', 'Automatated'
+		self.limit = limit
+
+		snapshot_dir = app.config.get('SNAPSHOT_DIR', None)
+		# the state of the documents before loading them, for `refresh`
+		self.source_state = self.scan_source()
+		fingerprint = self.source_fingerprint(self.source_state)
+		if snapshot_dir is None or not self.load_snapshot(snapshot_dir, fingerprint):
+			self.load_from_db()
+			if snapshot_dir is not None:
+				self.save_snapshot(snapshot_dir, fingerprint)
+
+		self.init_indexes(lsh, snapshot_dir=snapshot_dir)
+
+	def init_indexes(self, lsh=None, snapshot_dir=None):
+		'''Build the inverted index, LSH tables, generation and categories
+		from the loaded signatures and matrices. The LSH tables are loaded from
+		the snapshot in `snapshot_dir` if saved there, otherwise built and saved.
+		'''
+		self.init_scoring()
+		if lsh is not None:
+			if snapshot_dir is None or not self.load_lsh(snapshot_dir, lsh):
+				self.init_lsh(**lsh)
+				if snapshot_dir is not None:
+					self.save_lsh(snapshot_dir)
+		self.init_generation()
 
+		categories = map(lambda x:x.split(':')[0], self.keys())
+		self.categories = set(categories)
+		self.category_count = dict(Counter(categories))
+		self.get_download_file_meta()
+		return
 
-		if not limit:
+	def load_from_db(self):
+		'''Load the signatures and build the matrices from the documents
+		matching `filter_` in the DB.
+		'''
+		if not self.limit:
 			cur = COLL.find(self.filter_, PROJECTION_EXCLUDE, no_cursor_timeout=True)
 		else:
-			cur = COLL.find(self.filter_, PROJECTION_EXCLUDE, no_cursor_timeout=True).limit(limit)
-		# to preserve orders
-		self.uids = cur.distinct('id')
-		
-		# sparse matrices
-		sparse_mat_shape = (len(self.uids), len(ALL_GENES_I))
-		mat_up = sp.lil_matrix(sparse_mat_shape, dtype=np.int8)
-		mat_dn = sp.lil_matrix(sparse_mat_shape, dtype=np.int8)
-
+			cur = COLL.find(self.filter_, PROJECTION_EXCLUDE, no_cursor_timeout=True).limit(self.limit)
 
 		# Load signatures 
 		tuple_list = Parallel(n_jobs=-1, backend='threading', verbose=10)(
-			delayed(wrapper_func)(i, doc) for i, doc in enumerate(cur))
-
-		for i, (uid, sig, up_idx, dn_idx) in enumerate(tuple_list):
-			self[uid] = sig
-			mat_up[i, up_idx] = 1
-			mat_dn[i, dn_idx] = 1
-
-		# for i, doc in enumerate(cur):
-		# 	sig = DBSignature(None, doc=doc)
-		# 	# sig.fill_top_genes()
-		# 	# fill the sparse matrices
-		# 	up_idx, dn_idx = sig.get_vector_indexes()
-		# 	mat_up[i, up_idx] = 1
-		# 	mat_dn[i, dn_idx] = 1
-		# 	# clear `chdir` field and add `v_cs` for exporting
-		# 	sig.clear(cutoff=600)
-		# 	if i % 5 == 0:
-		# 		print i
-
-		# 	uid = doc['id']
-		# 	self[uid] = sig
-
-		# convert to CSR format for fast compuatation
-		self.mat_up = mat_up.tocsr()
-		self.mat_dn = mat_dn.tocsr()
-		del mat_up, mat_dn
+			delayed(wrapper_func)(i, doc, self.n_genes_stored) for i, doc in enumerate(cur))
 
-		categories = map(lambda x:x.split(':')[0], self.keys())
-		self.categories = set(categories)
-		self.category_count = dict(Counter(categories))
-		self.get_download_file_meta()
+		self.uids, self.mat_up, self.mat_dn, self.mat_cs = signatures_to_matrices(tuple_list)
+		self.metas = [json_util.dumps(sig.meta, sort_keys=True) 
+			for _, sig, _, _, _ in tuple_list]
+		self.init_signatures()
+		return
+
+	def init_signatures(self):
+		## views of the signatures in the rows of the matrices, and 
+		## columns of meta data with precomputed names and urls
+		self.clear()
+		columns = {field: [] for field in self.meta_fields + ['name', 'url', 'search_names']}
+		for i, (uid, meta) in enumerate(zip(self.uids, self.metas)):
+			self[uid] = CollectionSignature(self, i)
+			meta = json_util.loads(meta)
+			for field in self.meta_fields:
+				columns[field].append(meta.get(field, None))
+			name = find_name(meta)
+			columns['name'].append(name)
+			columns['url'].append(find_url(meta, name))
+			columns['search_names'].append(find_search_names(meta))
+		self.meta_columns = {field: _object_array(values) 
+			for field, values in columns.items()}
+		return
+
+	def scan_source(self):
+		'''Get {uid: (_id, time)} of the documents matching `filter_`.
+		'''
+		cur = COLL.find(self.filter_, {'id': True, '_id': True, 'time': True})
+		if self.limit:
+			cur = cur.limit(self.limit)
+		return {doc['id']: (doc['_id'], doc.get('time', None)) for doc in cur}
+
+	def refresh(self):
+		'''
+		Find the documents matching `filter_` that were added, changed (with
+		a new `_id` or `time`) or removed since this collection was loaded.
+		Return a new DBSignatureCollection made of the unchanged rows of this 
+		one and rows built from the added and changed documents, or None if 
+		nothing changed. This collection is not modified, so queries in flight
+		are not affected.
+		'''
+		source_state = self.scan_source()
+		fingerprint = self.source_fingerprint(source_state)
+		changed = [uid for uid, state in source_state.items() 
+			if self.source_state.get(uid, None) != state]
+		removed = [uid for uid in self.source_state if uid not in source_state]
+		if len(changed) == 0 and len(removed) == 0:
+			return None
+
+		changed_set = set(changed)
+		keep_idx = np.array([i for i, uid in enumerate(self.uids) 
+			if uid in source_state and uid not in changed_set], dtype=np.int64)
+		# the documents found by the scan, which is limited like the initial load
+		filter_delta = {'_id': {'$in': [source_state[uid][0] for uid in changed]}}
+		cur = COLL.find(filter_delta, PROJECTION_EXCLUDE, no_cursor_timeout=True)
+		if self.limit:
+			cur = cur.limit(self.limit)
+		tuple_list = [wrapper_func(i, doc, self.n_genes_stored) for i, doc in enumerate(cur)]
+		uids_delta, mat_up_delta, mat_dn_delta, mat_cs_delta = signatures_to_matrices(tuple_list)
+
+		new = self.__class__.__new__(self.__class__)
+		new.filter_ = self.filter_
+		new.name = self.name
+		new.name_prefix = self.name_prefix
+		new.limit = self.limit
+		new.source_state = source_state
+		new.uids = [self.uids[i] for i in keep_idx] + uids_delta
+		new.metas = [self.metas[i] for i in keep_idx] + \
+			[json_util.dumps(sig.meta, sort_keys=True) 
+			for _, sig, _, _, _ in tuple_list]
+		new.mat_up = sp.vstack([self.mat_up[keep_idx], mat_up_delta]).tocsr()
+		new.mat_dn = sp.vstack([self.mat_dn[keep_idx], mat_dn_delta]).tocsr()
+		new.mat_cs = sp.vstack([self.mat_cs[keep_idx], mat_cs_delta]).tocsr()
+		new.init_signatures()
+
+		snapshot_dir = app.config.get('SNAPSHOT_DIR', None)
+		if snapshot_dir is not None:
+			new.save_snapshot(snapshot_dir, fingerprint)
+		new.init_indexes(self.lsh_params, snapshot_dir=snapshot_dir)
+		return new
+
+	def source_fingerprint(self, source_state):
+		'''A hash of the (_id, time) of the documents matching `filter_` in
+		`source_state` from scan_source, and of the genes indexing the 
+		matrices, used to tell whether a snapshot is outdated. Documents 
+		edited in place get a new `time`, which changes the fingerprint.
+		'''
+		state = [self.filter_, self.limit, sorted(source_state.items()), GENES_FINGERPRINT]
+		return hashlib.md5(json_util.dumps(state, sort_keys=True)).hexdigest()
+
+	def save_snapshot(self, snapshot_dir, fingerprint):
+		'''Save the matrices, uids and meta data of the signatures to 
+		`snapshot_dir`/`name`, replacing the previous snapshot.
+		'''
+		path = os.path.join(snapshot_dir, self.name)
+		tmp_path = '%s.tmp-%d' % (path, os.getpid())
+		if os.path.isdir(tmp_path):
+			shutil.rmtree(tmp_path)
+		os.makedirs(tmp_path)
+
+		for key in ('up', 'dn', 'cs'):
+			save_csr(os.path.join(tmp_path, key), getattr(self, 'mat_' + key))
+		np.save(os.path.join(tmp_path, 'uids.npy'), np.array(self.uids, dtype=np.unicode_))
+		with open(os.path.join(tmp_path, 'signatures.jsonl'), 'wb') as out:
+			for meta in self.metas:
+				out.write(meta + '\n')
+		# written last, a snapshot without it is incomplete
+		with open(os.path.join(tmp_path, 'snapshot.json'), 'wb') as out:
+			json.dump({'version': self.snapshot_version, 'fingerprint': fingerprint,
+				'n_genes_i': len(ALL_GENES_I), 'n_genes': len(ALL_GENES)}, out)
+
+		if os.path.isdir(path):
+			shutil.rmtree(path)
+		os.rename(tmp_path, path)
+		return
+
+	def load_snapshot(self, snapshot_dir, fingerprint):
+		'''Load the matrices (memory-mapped), uids and signatures from the 
+		snapshot in `snapshot_dir`/`name`. 
+		Return False if there is no snapshot matching the version and `fingerprint`.
+		'''
+		path = os.path.join(snapshot_dir, self.name)
+		try:
+			with open(os.path.join(path, 'snapshot.json')) as f:
+				snapshot_meta = json.load(f)
+		except (IOError, ValueError):
+			return False
+		if snapshot_meta['version'] != self.snapshot_version or \
+			snapshot_meta['fingerprint'] != fingerprint:
+			return False
+
+		self.uids = np.load(os.path.join(path, 'uids.npy')).tolist()
+		shape_i = (len(self.uids), snapshot_meta['n_genes_i'])
+		self.mat_up = load_csr(os.path.join(path, 'up'), shape_i)
+		self.mat_dn = load_csr(os.path.join(path, 'dn'), shape_i)
+		self.mat_cs = load_csr(os.path.join(path, 'cs'), 
+			(len(self.uids), snapshot_meta['n_genes']))
+
+		with open(os.path.join(path, 'signatures.jsonl')) as f:
+			self.metas = [line.rstrip('\n') for line in f]
+		self.init_signatures()
+		return True
+
+	def save_lsh(self, snapshot_dir):
+		'''Save the LSH tables to the snapshot in `snapshot_dir`/`name`, 
+		which is replaced along with them by save_snapshot.
+		'''
+		path = os.path.join(snapshot_dir, self.name)
+		self.lsh_up.save(os.path.join(path, 'lsh-up'))
+		self.lsh_dn.save(os.path.join(path, 'lsh-dn'))
+		# written last, tables without it are incomplete
+		with open(os.path.join(path, 'lsh.json'), 'wb') as out:
+			json.dump(dict(self.lsh_params, n_rows=len(self.uids)), out)
+		return
+
+	def load_lsh(self, snapshot_dir, lsh):
+		'''Load the LSH tables (memory-mapped) from the snapshot in 
+		`snapshot_dir`/`name`. Return False if they are missing or were built
+		with other kwargs of init_lsh than `lsh`.
+		'''
+		path = os.path.join(snapshot_dir, self.name)
+		lsh_params = dict(n_hashes=128, n_bands=64, seed=0)
+		lsh_params.update(lsh)
+		try:
+			with open(os.path.join(path, 'lsh.json')) as f:
+				saved_params = json.load(f)
+		except (IOError, ValueError):
+			return False
+		if saved_params != dict(lsh_params, n_rows=len(self.uids)):
+			return False
+		self.lsh_params = lsh_params
+		self.lsh_up = MinHashLSH(**lsh_params).load(os.path.join(path, 'lsh-up'))
+		self.lsh_dn = MinHashLSH(**lsh_params).load(os.path.join(path, 'lsh-dn'))
+		return True
 
 	def __sizeof__(self):
 		'''Get the approximate size of this object in MBs
 		'''
-		size = sparse_matrix_size(self.mat_up) + sparse_matrix_size(self.mat_dn)
+		size = self.matrices_size()
 		size_buildins = sum(map(sys.getsizeof, [self.categories, self.category_count, self.uids]))
-		size_sigs = sum(map(sys.getsizeof, self.values()))
+		size_sigs = sum(map(sys.getsizeof, self.values())) + sum(map(sys.getsizeof, self.metas))
+		size_sigs += sum(map(sys.getsizeof, self.meta_columns.values()))
 
 		size += size_buildins + size_sigs
 		return size
@@ -555,61 +1515,67 @@ class DBSignatureCollection(dict):
 		return
 
 
+	def download_file_args(self, category, format, outfn):
+		## arguments of write_download_file for the signatures of a category
+		rows = np.array([i for i, uid in enumerate(self.uids) 
+			if uid.startswith(category + ':')], dtype=np.int64)
+		return (format, outfn, [self.uids[i] for i in rows], 
+			[self.metas[i] for i in rows], self.mat_cs[rows])
+
 	def make_download_file(self, category, format, outfn):
 		'''to generate files for downloading
 		'''
-		sigs_this_category = [sig.to_dict(format=format) for uid, sig in self.items() if uid.startswith(category)]
-		if format == 'gmt':
-			with open (outfn, 'w') as out:
-				for dict_data in sigs_this_category:
-					if type(dict_data['name']) == list: # join list to string for v2.0
-						names = filter(None, dict_data['name'])
-						term_up = '|'.join(names) + '-up'
-						term_dn = '|'.join(names) + '-dn'
-					else:
-						term_up = dict_data['name'] + '-up'
-						term_dn = dict_data['name'] + '-dn'
-
-					line_up = [ term_up, dict_data['id'] ] + map(lambda x:x[0], dict_data['up_genes'])
-					line_dn = [ term_dn, dict_data['id'] ] + map(lambda x:x[0], dict_data['down_genes'])
-					out.write('\t'.join(line_up) + '\n')
-					out.write('\t'.join(line_dn) + '\n')
-		
-		elif format == 'csv': # annotations only
-			if 'entities' in sigs_this_category[0]:
-				# predicted signatures
-				# need to unpack fields that are dict
-				sigs_this_category_ = []
-				for doc in sigs_this_category:
-					del doc['entities']
-					for field in ['hs_gene_symbol', 'disease_name', 'drug_name', 'cell_type']:
-						if field in doc:
-							doc[field] = '|'.join(filter(None, [item.get('name', None) for item in doc[field]]))
-					sigs_this_category_.append(doc)
-				sigs_this_category = sigs_this_category_ 
-
-			df = pd.DataFrame.from_records(sigs_this_category)\
-				.drop(['up_genes', 'down_genes'], axis=1)\
-				.set_index('id')
-			df['pert_ids'] = df['pert_ids'].map(lambda x: '|'.join(x))
-			df['ctrl_ids'] = df['ctrl_ids'].map(lambda x: '|'.join(x))
-			df.to_csv(outfn, encoding='utf-8')
-
-		else:
-			json.dump(sigs_this_category, open(outfn, 'wb'))
-		return (outfn, len(sigs_this_category))
+		return write_download_file(*self.download_file_args(category, format, outfn))
 
-	def make_all_download_files(self):
-		'''to generate all 3 formats of files for each category
+	def make_all_download_files(self, n_jobs=None):
+		'''to generate all 3 formats of files for each category in parallel 
+		processes, unless the files were generated from this generation
 		'''
+		if n_jobs is None:
+			n_jobs = app.config.get('DOWNLOAD_FILE_WORKERS', 1)
+		jobs = []
 		for category in self.categories:
 			for format in self.formats:
 				outfn = '%s/%s-%s.%s' % (self.outfn_path, 
 					self.category2name[category], self.name, format)
-				if not os.path.isfile(outfn):
-					(filename, num_sigs) = self.make_download_file(category, format, outfn)
-					print filename, num_sigs
-				print outfn, 'finished'
+				jobs.append((category, format, outfn))
+
+		# the generation of the collection the files were generated from,
+		# which fingerprints the genes, CD values and meta data written in them
+		stamp_fn = '%s/%s.generation' % (self.outfn_path, self.name)
+		if os.path.isfile(stamp_fn) and open(stamp_fn).read() == self.generation \
+			and all(os.path.isfile(outfn) and os.path.isfile(outfn + '.gz') 
+				for _, _, outfn in jobs):
+			return
+
+		results = Parallel(n_jobs=n_jobs, backend='multiprocessing')(
+			delayed(write_download_file)(*self.download_file_args(category, format, outfn)) 
+			for category, format, outfn in jobs)
+		for filename, num_sigs in results:
+			app.logger.info('%s\t%d' % (filename, num_sigs))
+		with open(stamp_fn, 'w') as out:
+			out.write(self.generation)
 		return
 
 
+## LRU caches reported by METRICS: {name: LRUCache}
+CACHES = OrderedDict([('result', RESULT_CACHE), ('api', API_CACHE), 
+	('app_url', APP_URL_CACHE), ('stacked', DBSignatureCollectionGroup.cache)])
+
+def cache_metrics():
+	## hits, misses and sizes of the LRU caches, collected by METRICS
+	caches = CACHES.items()
+	return [
+		('cache_hits_total', 'counter', 'Number of cache hits', 
+			[({'cache': name}, cache.hits) for name, cache in caches]),
+		('cache_misses_total', 'counter', 'Number of cache misses', 
+			[({'cache': name}, cache.misses) for name, cache in caches]),
+		('cache_size_bytes', 'gauge', 'Total size of the cached values', 
+			[({'cache': name}, cache.size) for name, cache in caches]),
+		('cache_items', 'gauge', 'Number of cached values', 
+			[({'cache': name}, len(cache)) for name, cache in caches]),
+		]
+
+METRICS.register_collector(cache_metrics)
+METRICS.describe('stage_seconds', 'histogram', 'Seconds spent in stages of handling requests')
+METRICS.describe('request_seconds', 'histogram', 'Seconds spent handling requests by endpoint')
@@ -0,0 +1,91 @@
+'''
+Blocked, parallel computation of all-vs-all signed Jaccard matrices between
+signatures, written into memory-mapped .npy files so that the result does
+not need to fit in RAM. An interrupted computation resumes from the blocks
+not yet finished.
+'''
+import os
+import multiprocessing
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from .matrix_ops import batch_signed_jaccard
+
+
+## globals of the worker processes, set by _init_worker
+_MATRICES = None
+_OUT = None
+
+def _init_worker(mat_up, mat_dn, other_up, other_dn, outfn):
+	global _MATRICES, _OUT
+	_MATRICES = (mat_up, mat_dn, other_up, other_dn)
+	_OUT = open_memmap(outfn, mode='r+')
+
+
+def _compute_block(start, end):
+	## compute signed jaccard of rows [start, end) against all the other rows
+	mat_up, mat_dn, other_up, other_dn = _MATRICES
+	# the block is the (small) query side of the sparse products
+	block = batch_signed_jaccard(other_up, other_dn,
+		mat_up[start:end], mat_dn[start:end]).T
+	_OUT[start:end] = block.toarray()
+	_OUT.flush()
+	return start, end
+
+
+def _compute_block_star(args):
+	return _compute_block(*args)
+
+
+def progress_filename(outfn):
+	return outfn + '.done.npy'
+
+
+def signed_jaccard_matrix(mat_up, mat_dn, outfn, other_up=None, other_dn=None,
+	block_size=500, n_jobs=None, verbose=True):
+	'''
+	Compute the signed Jaccard matrix between the rows of (mat_up, mat_dn) and
+	the rows of (other_up, other_dn), or themselves if the others are not given.
+	The float32 matrix is written to `outfn` as a .npy file in blocks of
+	`block_size` rows computed by `n_jobs` processes. Finished blocks are
+	recorded in a progress file, so calling this again with the same arguments
+	only computes the remaining blocks.
+	Returns the result as a read-only memmap.
+	'''
+	if other_up is None:
+		other_up, other_dn = mat_up, mat_dn
+	shape = (mat_up.shape[0], other_up.shape[0])
+	n_blocks = (shape[0] + block_size - 1) // block_size
+
+	progress_fn = progress_filename(outfn)
+	if os.path.isfile(outfn) and os.path.isfile(progress_fn):
+		out = open_memmap(outfn, mode='r+')
+		done = open_memmap(progress_fn, mode='r+')
+		if out.shape != shape or done.shape != (n_blocks,):
+			raise ValueError('%s was made with different inputs or block_size' % outfn)
+	else:
+		out = open_memmap(outfn, mode='w+', dtype=np.float32, shape=shape)
+		done = open_memmap(progress_fn, mode='w+', dtype=np.bool_, shape=(n_blocks,))
+	del out
+
+	todo = [(i * block_size, min((i + 1) * block_size, shape[0]))
+		for i in np.flatnonzero(~done)]
+	if verbose:
+		print '%d of %d blocks to compute' % (len(todo), n_blocks)
+
+	pool = multiprocessing.Pool(n_jobs, initializer=_init_worker,
+		initargs=(mat_up, mat_dn, other_up, other_dn, outfn))
+	try:
+		results = pool.imap_unordered(_compute_block_star, todo)
+		for i, (start, end) in enumerate(results):
+			# mark the block as finished only after it was flushed to disk
+			done[start // block_size] = True
+			done.flush()
+			if verbose:
+				print 'block %d/%d finished' % (i + 1, len(todo))
+		pool.close()
+	finally:
+		pool.terminate()
+		pool.join()
+	return open_memmap(outfn, mode='r')
@@ -0,0 +1,39 @@
+'''
+Generators serializing chunks of objects into the pieces of a streamed
+response body, as one JSON array or as newline delimited JSON, optionally
+compressed with gzip.
+'''
+import json
+import zlib
+
+
+def json_array_pieces(chunks):
+	## serialize lists of objects into the pieces of a single JSON array
+	yield '['
+	first = True
+	for chunk in chunks:
+		if len(chunk) == 0:
+			continue
+		if not first:
+			yield ','
+		yield json.dumps(chunk)[1:-1]
+		first = False
+	yield ']'
+
+
+def ndjson_pieces(chunks):
+	## serialize lists of objects into lines of JSON objects
+	for chunk in chunks:
+		if len(chunk) > 0:
+			yield '\n'.join(json.dumps(obj) for obj in chunk) + '\n'
+
+
+def gzip_pieces(pieces, level=6):
+	## compress the pieces into a gzip stream, flushing after each piece
+	## so that clients can decode the response as it arrives
+	compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+	for piece in pieces:
+		data = compressor.compress(piece) + compressor.flush(zlib.Z_SYNC_FLUSH)
+		if data:
+			yield data
+	yield compressor.flush()
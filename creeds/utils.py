@@ -1,18 +1,59 @@
 '''
 Utils for computing similarity and etc.
 '''
+import bisect
 from itertools import chain
+from collections import OrderedDict
 
 from .orm import *
+from . import clustergram
 
-def get_matrix(uids, genes, na_val=0):
-	## retrieve a matrix based on uids of signatures and genes
-	mat = np.zeros((len(genes), len(uids)))
+def _genes_i2cs():
+	## binary matrix mapping genes in ALL_GENES_I (rows) to their 
+	## case sensitive variants in ALL_GENES (columns)
+	cs_idx = np.flatnonzero(ALL_GENES_CS2I >= 0)
+	return sp.csr_matrix((np.ones(len(cs_idx), dtype=np.float32), 
+		(ALL_GENES_CS2I[cs_idx], cs_idx)), shape=(len(ALL_GENES_I), len(ALL_GENES)))
 
+GENES_I2CS = _genes_i2cs()
+
+
+def get_matrix(uids, genes, uid_index, na_val=0):
+	## retrieve a gene x signature matrix of CD values based on uids of signatures 
+	## and (case insensitive) genes from the collections in `uid_index`,
+	## with `na_val` for genes or uids missing in the signatures. When a signature
+	## has values for several case variants of a gene, the one with the largest
+	## abs(value) is taken
+	mat = np.empty((len(genes), len(uids)))
+	mat.fill(na_val)
+
+	gene_idx = np.array([GENE_I_IDX.get(gene.upper(), -1) for gene in genes], dtype=np.int64)
+	known = np.flatnonzero(gene_idx >= 0)
+	if len(known) > 0:
+		known = known[np.diff(GENES_I2CS[gene_idx[known]].indptr) > 0]
+	if len(known) == 0:
+		return mat
+	# the case sensitive variants in ALL_GENES of each known gene
+	variants = GENES_I2CS[gene_idx[known]]
+
+	# group the signatures by the collections holding them
+	d_dbsc_rows = OrderedDict() # {name: (DBSignatureCollection, rows, columns in mat)}
 	for j, uid in enumerate(uids):
-		sig = DBSignature(uid, projection=PROJECTION_EXCLUDE)
-		vals = sig.get_gene_vals(genes, na_val=na_val)
-		mat[:, j] = vals
+		if uid in uid_index:
+			dbsc, row = uid_index[uid]
+			_, rows, cols = d_dbsc_rows.setdefault(dbsc.name, (dbsc, [], []))
+			rows.append(row)
+			cols.append(j)
+
+	starts = variants.indptr[:-1]
+	for dbsc, rows, cols in d_dbsc_rows.values():
+		# signatures x variants of the known genes
+		vals = dbsc.mat_cs[rows][:, variants.indices].toarray()
+		max_vals = np.maximum.reduceat(vals, starts, axis=1)
+		min_vals = np.minimum.reduceat(vals, starts, axis=1)
+		vals = np.where(-min_vals > max_vals, min_vals, max_vals).T
+		# zeros are not stored in mat_cs, they are missing values
+		mat[np.ix_(known, cols)] = np.where(vals != 0, vals, na_val)
 	return mat
 
 
@@ -22,17 +63,67 @@ def make_autocomplete(db_collections):
 	`db_collections`: a list of DBSignatureCollection instances
 	'''
 	d_cat_names = {}
-	for uid, sig in chain(*[dbc.iteritems() for dbc in db_collections]):
-		if sig.has_chdir():
+	for dbsc in db_collections:
+		for uid, name in zip(dbsc.uids, dbsc.meta_columns['name']):
 			cat = uid.split(':')[0]
-			if cat not in d_cat_names:
-				d_cat_names[cat] = []
-			name = sig.name
-			d_cat_names[cat].append(name)
+			if type(name) != list: # v2.0 signatures have lists of names
+				name = [name]
+			d_cat_names.setdefault(cat, set()).update(filter(None, name))
 
 	for cat, names in d_cat_names.items():
-		d_cat_names[cat] = list(set(names))
+		d_cat_names[cat] = sorted(names)
 
 	return d_cat_names
 
 
+class Autocomplete(object):
+	'''
+	The autocomplete object of a generation of DBSignatureCollection instances,
+	serialized once with its ETag, and the sorted names for prefix lookups.
+	'''
+	def __init__(self, db_collections):
+		d_cat_names = make_autocomplete(db_collections)
+		self.json = json.dumps(d_cat_names, sort_keys=True)
+		self.etag = hashlib.md5(self.json).hexdigest()
+		self.names = sorted(set(chain(*d_cat_names.values())), key=lambda name: name.lower())
+		self.keys = [name.lower() for name in self.names]
+
+	def complete(self, prefix, limit=10):
+		'''Get the `limit` shortest names starting with `prefix`, case insensitively.
+		'''
+		prefix = prefix.lower()
+		start = bisect.bisect_left(self.keys, prefix)
+		end = bisect.bisect_left(self.keys, prefix + u'\uffff', lo=start)
+		return sorted(self.names[start:end], key=len)[:limit]
+
+
+## Autocomplete objects of the latest generations of collections
+AUTOCOMPLETE_CACHE = LRUCache(1e8, max_items=2, sizeof=lambda ac: sys.getsizeof(ac.json))
+
+def get_autocomplete(db_collections):
+	## get the Autocomplete object of the collections, build it if needed
+	key = tuple((dbsc.name, dbsc.generation) for dbsc in db_collections)
+	autocomplete = AUTOCOMPLETE_CACHE.get(key)
+	if autocomplete is None:
+		autocomplete = Autocomplete(db_collections)
+		AUTOCOMPLETE_CACHE.set(key, autocomplete)
+	return autocomplete
+
+CACHES['autocomplete'] = AUTOCOMPLETE_CACHE
+
+
+## JSON strings of clustergrams keyed by the hash of their inputs
+CLUSTERGRAM_CACHE = LRUCache(app.config.get('CLUSTERGRAM_CACHE_SIZE', 1e8), sizeof=len)
+
+def get_clustergram_json(mat, rids, cids, **kwargs):
+	## get the clustergram of mat as a JSON string, cluster it if needed
+	key = clustergram.clustergram_key(mat, rids, cids, **kwargs)
+	json_str = CLUSTERGRAM_CACHE.get(key)
+	if json_str is None:
+		with METRICS.stage('cluster'):
+			json_data = clustergram.clustergram(mat, rids, cids, **kwargs)
+		json_str = json.dumps(json_data)
+		CLUSTERGRAM_CACHE.set(key, json_str)
+	return json_str
+
+CACHES['clustergram'] = CLUSTERGRAM_CACHE
@@ -0,0 +1,39 @@
+## Compute the all-vs-all signed Jaccard matrix of a DBSignatureCollection,
+## or between two collections, into a memory-mapped .npy file.
+## Usage: python make_signed_jaccard_matrix.py v1.0 [DM] -o signed_jaccard.npy
+import os, sys
+import argparse
+
+parser = argparse.ArgumentParser(
+	description='Compute the all-vs-all signed Jaccard matrix of DBSignatureCollections')
+parser.add_argument('collection', help='name of a collection in DBSC_PARAMS')
+parser.add_argument('other', nargs='?', default=None,
+	help='name of the collection for the columns, defaults to `collection`')
+parser.add_argument('-o', '--out', required=True, help='output .npy file')
+parser.add_argument('--block-size', type=int, default=500)
+parser.add_argument('--n-jobs', type=int, default=None)
+parser.add_argument('--config', default='config.ProductionConfig')
+args = parser.parse_args()
+
+os.environ['CONFIG_OBJ'] = args.config
+from creeds import app
+from creeds.orm import DBSignatureCollection
+from creeds.pairwise import signed_jaccard_matrix
+
+d_params = {params['name']: params for params in app.config['DBSC_PARAMS']}
+dbsc = DBSignatureCollection(**d_params[args.collection])
+if args.other is None or args.other == args.collection:
+	other = dbsc
+else:
+	other = DBSignatureCollection(**d_params[args.other])
+
+# ids of the rows and columns of the matrix
+with open(args.out + '.rows.txt', 'w') as out:
+	out.write('\n'.join(dbsc.uids) + '\n')
+with open(args.out + '.cols.txt', 'w') as out:
+	out.write('\n'.join(other.uids) + '\n')
+
+signed_jaccard_matrix(dbsc.mat_up, dbsc.mat_dn, args.out,
+	other_up=other.mat_up, other_dn=other.mat_dn,
+	block_size=args.block_size, n_jobs=args.n_jobs)
+print args.out, 'finished'
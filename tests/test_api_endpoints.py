@@ -1,5 +1,6 @@
-import os, json
+import os, json, urllib
 import unittest
+import numpy as np
 import pandas as pd
 from flask import (request, Response)
 # Assumes env var for config is set
@@ -27,6 +28,46 @@ class TestApiRequests(unittest.TestCase):
 
 
 
+class TestAutocomplete(unittest.TestCase):
+	'''
+	Test the API of autocomplete of signature names
+	'''
+	def setUp(self):
+		self.app = app.test_client()
+
+	def test_autocomplete(self):
+		resp = self.app.get(ENTRY_POINT + '/autoCompleteList')
+		self.assertEquals(resp.status_code, 200)
+		d_cat_names = json.loads(resp.data.decode())
+		self.assertEquals(type(d_cat_names), dict)
+		self.assertTrue(all(type(names) == list for names in d_cat_names.values()))
+
+		# Cached by clients using the ETag
+		etag = resp.headers['ETag']
+		resp = self.app.get(ENTRY_POINT + '/autoCompleteList', 
+			headers={'If-None-Match': etag})
+		self.assertEquals(resp.status_code, 304)
+
+	def test_prefix(self):
+		resp = self.app.get(ENTRY_POINT + '/autoCompleteList')
+		names = sum(json.loads(resp.data.decode()).values(), [])
+		prefix = names[0][:2]
+		resp = self.app.get(ENTRY_POINT + '/autoCompleteList?prefix=%s&limit=3' % 
+			urllib.quote(prefix.encode('utf-8')))
+		completions = json.loads(resp.data.decode())
+		self.assertTrue(0 < len(completions) <= 3)
+		self.assertTrue(all(name.lower().startswith(prefix.lower()) for name in completions))
+
+		for limit in ['ten', '0', '-1']:
+			resp = self.app.get(ENTRY_POINT + '/autoCompleteList?prefix=%s&limit=%s' % 
+				(urllib.quote(prefix.encode('utf-8')), limit))
+			self.assertEquals(resp.status_code, 400)
+		resp = self.app.get(ENTRY_POINT + '/autoCompleteList?prefix=%s&limit=100000' % 
+			urllib.quote(prefix.encode('utf-8')))
+		self.assertTrue(len(json.loads(resp.data.decode())) <= 
+			app.config['AUTOCOMPLETE_MAX_LIMIT'])
+
+
 class TestStringSearch(unittest.TestCase):
 	'''
 	Test the API of search the DB using string
@@ -52,6 +93,14 @@ class TestStringSearch(unittest.TestCase):
 		expected_keys = set(['id', 'geo_id', 'pert_ids', 'ctrl_ids', 'platform', 'version'])
 		self.assertTrue(shared_keys.issuperset(expected_keys))
 
+	def test_search_limit(self):
+		resp = self.app.get(ENTRY_POINT + '/search?q=TP53&limit=1')
+		self.assertEquals(resp.status_code, 200)
+		self.assertEquals(len(json.loads(resp.data.decode())), 1)
+		for limit in ['abc', '0', '-1']:
+			resp = self.app.get(ENTRY_POINT + '/search?q=TP53&limit=%s' % limit)
+			self.assertEquals(resp.status_code, 400)
+
 
 class TestQueryUsingGeneLists(unittest.TestCase):
 	'''
@@ -107,6 +156,448 @@ class TestQueryUsingGeneLists(unittest.TestCase):
 		# Make sure db_version = ['v1.0','DM'] has more results than v1.0
 		self.assertTrue(signatures2.shape[0] > signatures.shape[0])
 
+	def test_approx_mode(self):
+		payload = self.payload.copy()
+		payload['db_version'] = 'p1.0'
+		resp, signatures = self.post_and_parse_resp(payload)
+		payload['mode'] = 'approx'
+		resp = self.app.post(ENTRY_POINT + '/search', 
+			data=json.dumps(payload),
+			content_type = 'application/json')
+		self.assertEquals(resp.status_code, 200)
+		# Candidates found by LSH are scored exactly
+		for sig in json.loads(resp.data.decode()):
+			self.assertEquals(sig['signed_jaccard'], 
+				signatures.loc[sig['id'], 'signed_jaccard'])
+
+		payload['approx_bands'] = 8
+		resp = self.app.post(ENTRY_POINT + '/search', 
+			data=json.dumps(payload),
+			content_type = 'application/json')
+		self.assertEquals(resp.status_code, 200)
+		for approx_bands in ['eight', 2.5, 0, -1]:
+			payload['approx_bands'] = approx_bands
+			resp = self.app.post(ENTRY_POINT + '/search', 
+				data=json.dumps(payload),
+				content_type = 'application/json')
+			self.assertEquals(resp.status_code, 400)
+
+	def test_weighted_query(self):
+		payload = self.payload.copy()
+		del payload['up_genes'], payload['dn_genes']
+		payload['genes'] = [[gene, 1.0] for gene in UP_GENES] + \
+			[[gene, -1.0] for gene in DN_GENES]
+		for metric in ['cosine', 'weighted_signed_overlap']:
+			payload['metric'] = metric
+			resp, signatures = self.post_and_parse_resp(payload)
+			self.assertEquals(resp.status_code, 200)
+			self.assertTrue(all(signatures[metric] < 0))
+			self.assertTrue(all(signatures[metric] >= -1))
+
+	def test_bad_weighted_query(self):
+		payload = self.payload.copy()
+		del payload['up_genes'], payload['dn_genes']
+		payload['metric'] = 'cosine'
+		for genes in [[['TP53', 'x']], ['TP53'], [['TP53']], [['TP53', 1.0, 2.0]], 
+			[[53, 1.0]], [['TP53', True]], [['TP53', None]], 'TP53']:
+			payload['genes'] = genes
+			resp = self.app.post(ENTRY_POINT + '/search', 
+				data=json.dumps(payload), content_type = 'application/json')
+			self.assertEquals(resp.status_code, 400)
+
+	def test_weighted_self_similarity(self):
+		# a signature queried with its own CD values
+		resp = self.app.get(ENTRY_POINT + '/api?id=gene:27')
+		signature = json.loads(resp.data.decode())
+		payload = {'genes': signature['up_genes'] + signature['down_genes'],
+			'direction': 'similar', 'db_version': 'v1.0', 'metric': 'cosine'}
+		resp, signatures = self.post_and_parse_resp(payload)
+		self.assertEquals(resp.status_code, 200)
+		self.assertAlmostEquals(signatures.loc['gene:27', 'cosine'], 1.0, places=4)
+
+	def test_pagination(self):
+		payload = self.payload.copy()
+		payload['db_version'] = ['v1.0','DM']
+		resp, signatures = self.post_and_parse_resp(payload)
+
+		payload['top_k'] = 2
+		payload['offset'] = 1
+		resp, page = self.post_and_parse_resp(payload)
+		self.assertEquals(resp.status_code, 200)
+		# The page should be a slice of the full results
+		self.assertEquals(page.index.tolist(), signatures.index[1:3].tolist())
+
+		del payload['top_k'], payload['offset']
+		min_abs_score = abs(signatures['signed_jaccard']).median()
+		payload['min_abs_score'] = min_abs_score
+		resp, page = self.post_and_parse_resp(payload)
+		self.assertTrue(all(abs(page['signed_jaccard']) >= min_abs_score))
+
+	def test_bad_page_params(self):
+		for params in [{'top_k': 'ten'}, {'top_k': -1}, {'offset': -1}, 
+			{'offset': 'one'}, {'min_abs_score': 'high'}]:
+			payload = dict(self.payload, **params)
+			resp = self.app.post(ENTRY_POINT + '/search', 
+				data=json.dumps(payload), content_type = 'application/json')
+			self.assertEquals(resp.status_code, 400)
+
+	def test_bad_query(self):
+		for params in [{'direction': 'x'}, {'db_version': 'unknown'}, 
+			{'db_version': ['v1.0', 'unknown']}, {'db_version': []}]:
+			payload = dict(self.payload, **params)
+			resp = self.app.post(ENTRY_POINT + '/search', 
+				data=json.dumps(payload), content_type = 'application/json')
+			self.assertEquals(resp.status_code, 400)
+
+
+class TestBatchQuery(unittest.TestCase):
+	'''
+	Test the API handling query of DB using many up/down gene lists at once
+	'''
+	payload = {
+		'signatures': [
+			{'up_genes': UP_GENES, 'dn_genes': DN_GENES},
+			{'up_genes': DN_GENES, 'dn_genes': UP_GENES, 'direction': 'similar'},
+		],
+		'direction': 'opposite',
+		'db_version': ['v1.0', 'DM'],
+		'top_k': 5
+		}
+
+	def setUp(self):
+		self.app = app.test_client()
+
+	def test_batch_query(self):
+		resp = self.app.post(ENTRY_POINT + '/search/batch',
+			data=json.dumps(self.payload),
+			content_type = 'application/json')
+		self.assertEquals(resp.status_code, 200)
+		self.assertEquals(resp.mimetype, 'application/json')
+
+		results = json.loads(resp.data.decode())
+		self.assertEquals(len(results), 2)
+		for uid_data in results:
+			self.assertTrue(len(uid_data) <= 5)
+
+		# Batch results should match the top results of single queries
+		payload = {'up_genes': UP_GENES, 'dn_genes': DN_GENES,
+			'direction': 'opposite', 'db_version': ['v1.0', 'DM']}
+		resp = self.app.post(ENTRY_POINT + '/search',
+			data=json.dumps(payload),
+			content_type = 'application/json')
+		uid_data = json.loads(resp.data.decode())[:5]
+		self.assertEquals([d['signed_jaccard'] for d in uid_data],
+			[d['signed_jaccard'] for d in results[0]])
+		# Check all signed jaccard > 0 for the second signature
+		self.assertTrue(all(d['signed_jaccard'] > 0 for d in results[1]))
+
+	def test_bad_batch_query(self):
+		signature = self.payload['signatures'][0]
+		for payload in [
+			dict(self.payload, signatures=[{'up_genes': UP_GENES}]),
+			dict(self.payload, signatures=[{'dn_genes': DN_GENES}]),
+			dict(self.payload, signatures=[dict(signature, db_version='unknown')]),
+			dict(self.payload, db_version=['v1.0', 'unknown']),
+			dict(self.payload, top_k='five'),
+			dict(self.payload, top_k=-1),
+			dict(self.payload, signatures='not a list'),
+			dict(self.payload, signatures=[signature] * (app.config['BATCH_MAX_SIGNATURES'] + 1)),
+			dict(self.payload, direction='x'),
+			dict(self.payload, signatures=[dict(signature, direction='x')]),
+			dict(self.payload, signatures=[dict(signature, up_genes=[1, None])]),
+			dict(self.payload, signatures=[dict(signature, 
+				dn_genes=['TP53'] * (app.config['BATCH_MAX_GENES'] + 1))]),
+			[],
+			]:
+			resp = self.app.post(ENTRY_POINT + '/search/batch',
+				data=json.dumps(payload),
+				content_type = 'application/json')
+			self.assertEquals(resp.status_code, 400)
+		resp = self.app.post(ENTRY_POINT + '/search/batch',
+			data='not json', content_type = 'application/json')
+		self.assertEquals(resp.status_code, 400)
+
+
+class TestResultCache(unittest.TestCase):
+	'''
+	Test results of saved signatures are cached by their hash
+	'''
+	payload = {
+		'up_genes': UP_GENES,
+		'dn_genes': DN_GENES,
+		'direction': 'similar',
+		'db_version': ['v1.0', 'DM'],
+		'client': 'web'
+		}
+
+	def setUp(self):
+		self.app = app.test_client()
+
+	def test_result_cache(self):
+		from creeds.orm import RESULT_CACHE
+		resp = self.app.post(ENTRY_POINT + '/search', 
+			data=json.dumps(self.payload),
+			content_type = 'application/json')
+		h = json.loads(resp.data.decode())
+
+		resp1 = self.app.get(ENTRY_POINT + '/result?id=%s' % h)
+		hits = RESULT_CACHE.hits
+		resp2 = self.app.get(ENTRY_POINT + '/result?id=%s' % h)
+		self.assertEquals(resp2.status_code, 200)
+		self.assertEquals(RESULT_CACHE.hits, hits + 1)
+		self.assertEquals(json.loads(resp1.data.decode()), json.loads(resp2.data.decode()))
+
+		# Different pages are cached separately
+		resp3 = self.app.get(ENTRY_POINT + '/result?id=%s&top_k=1' % h)
+		self.assertEquals(json.loads(resp3.data.decode()), 
+			json.loads(resp1.data.decode())[:1])
+
+	def test_results_not_saved_by_default(self):
+		from creeds.orm import RESULT_CACHE, COLL_USER_SIGS
+		payload = dict(self.payload, direction='opposite')
+		resp = self.app.post(ENTRY_POINT + '/search', 
+			data=json.dumps(payload),
+			content_type = 'application/json')
+		h = json.loads(resp.data.decode())
+		resp = self.app.get(ENTRY_POINT + '/result?id=%s&top_k=2' % h)
+		self.assertEquals(resp.status_code, 200)
+		# pages are cached as the JSON served
+		self.assertIn(resp.data.decode(), [RESULT_CACHE.get(key) for key in RESULT_CACHE.keys()])
+		doc = COLL_USER_SIGS.find_one({'id': h}, {'_id': False, 'results': True})
+		self.assertNotIn('results', doc)
+
+	def test_streamed_results_cached(self):
+		from creeds.orm import RESULT_CACHE
+		resp = self.app.post(ENTRY_POINT + '/search', 
+			data=json.dumps(self.payload),
+			content_type = 'application/json')
+		h = json.loads(resp.data.decode())
+
+		resp1 = self.app.get(ENTRY_POINT + '/result?id=%s&top_k=3&stream=json' % h)
+		uid_data = json.loads(resp1.data.decode())
+		# the selected rows are shared by streamed and other requests
+		hits = RESULT_CACHE.hits
+		resp2 = self.app.get(ENTRY_POINT + '/result?id=%s&top_k=3&stream=ndjson' % h)
+		self.assertEquals(RESULT_CACHE.hits, hits + 1)
+		self.assertEquals([json.loads(line) for line in 
+			resp2.data.decode().splitlines()], uid_data)
+		resp3 = self.app.get(ENTRY_POINT + '/result?id=%s&top_k=3' % h)
+		self.assertEquals(RESULT_CACHE.hits, hits + 2)
+		self.assertEquals(json.loads(resp3.data.decode()), uid_data)
+
+	def test_saved_results_of_edited_collection(self):
+		from bson import json_util
+		from creeds.orm import RESULT_CACHE
+		payload = dict(self.payload, db_version='v1.0')
+		resp = self.app.post(ENTRY_POINT + '/search', 
+			data=json.dumps(payload),
+			content_type = 'application/json')
+		h = json.loads(resp.data.decode())
+		app.config['RESULT_CACHE_PERSIST'] = True
+		try:
+			uid_data = json.loads(self.app.get(ENTRY_POINT + '/result?id=%s' % h).data.decode())
+		finally:
+			app.config['RESULT_CACHE_PERSIST'] = False
+		uid = uid_data[0]['id']
+
+		# edit the meta data of a signature as if the collection was reloaded
+		from creeds import d_dbsc
+		dbsc = d_dbsc['v1.0']
+		i = dbsc.uids.index(uid)
+		meta_orig = dbsc.metas[i]
+		meta = json_util.loads(meta_orig)
+		meta['hs_gene_symbol'] = meta['mm_gene_symbol'] = 'EDITED'
+		app.config['RESULT_CACHE_PERSIST'] = True
+		try:
+			dbsc.metas[i] = json_util.dumps(meta, sort_keys=True)
+			dbsc.init_signatures()
+			dbsc.init_generation()
+			RESULT_CACHE.clear() # the saved results outlive the process
+			uid_data2 = json.loads(self.app.get(ENTRY_POINT + '/result?id=%s' % h).data.decode())
+		finally:
+			app.config['RESULT_CACHE_PERSIST'] = False
+			dbsc.metas[i] = meta_orig
+			dbsc.init_signatures()
+			dbsc.init_generation()
+			RESULT_CACHE.clear()
+		self.assertEquals(uid_data2[0]['id'], uid)
+		self.assertEquals(uid_data2[0]['name'][0], 'EDITED')
+
+	def test_saved_results_bounded(self):
+		from creeds.orm import save_results, load_saved_results
+		resp = self.app.post(ENTRY_POINT + '/search', 
+			data=json.dumps(self.payload),
+			content_type = 'application/json')
+		h = json.loads(resp.data.decode())
+		config = {key: app.config[key] for key in 
+			['RESULT_PERSIST_MAX_ROWS', 'RESULT_PERSIST_MAX_PAGES']}
+		app.config.update({'RESULT_PERSIST_MAX_ROWS': 2, 'RESULT_PERSIST_MAX_PAGES': 2})
+		generations = (('test', 'generation'),)
+		uid_data = [{'id': 'gene:27'}]
+		try:
+			for offset in range(3):
+				save_results(h, generations, (1, 0, offset), uid_data)
+			self.assertEquals(load_saved_results(h, generations, (1, 0, 0)), uid_data)
+			self.assertEquals(load_saved_results(h, generations, (1, 0, 1)), uid_data)
+			# at most 2 pages are saved
+			self.assertIsNone(load_saved_results(h, generations, (1, 0, 2)))
+			# pages longer than 2 results are not saved
+			save_results(h, (('test', 'other'),), (None, 0, 0), uid_data * 3)
+			self.assertIsNone(load_saved_results(h, (('test', 'other'),), (None, 0, 0)))
+			# results of a new generation replace the saved pages
+			save_results(h, (('test', 'other'),), (1, 0, 2), uid_data)
+			self.assertEquals(load_saved_results(h, (('test', 'other'),), (1, 0, 2)), uid_data)
+			self.assertIsNone(load_saved_results(h, generations, (1, 0, 0)))
+		finally:
+			app.config.update(config)
+
+
+class TestStreamedResults(unittest.TestCase):
+	'''
+	Test query results streamed as a JSON array or NDJSON
+	'''
+	payload = {
+		'up_genes': UP_GENES,
+		'dn_genes': DN_GENES,
+		'direction': 'similar',
+		'db_version': ['v1.0', 'DM'],
+		'client': 'api'
+		}
+
+	def setUp(self):
+		self.app = app.test_client()
+
+	def post(self, **params):
+		payload = dict(self.payload, **params)
+		return self.app.post(ENTRY_POINT + '/search', 
+			data=json.dumps(payload), content_type = 'application/json')
+
+	def test_stream(self):
+		uid_data = json.loads(self.post().data.decode())
+
+		resp = self.post(stream='json')
+		self.assertEquals(resp.status_code, 200)
+		self.assertEquals(json.loads(resp.data.decode()), uid_data)
+
+		resp = self.post(stream='ndjson')
+		self.assertEquals(resp.mimetype, 'application/x-ndjson')
+		lines = resp.data.decode().splitlines()
+		self.assertEquals([json.loads(line) for line in lines], uid_data)
+
+		resp = self.post(stream='json', top_k=2, offset=1)
+		self.assertEquals(json.loads(resp.data.decode()), uid_data[1:3])
+
+	def test_stream_gzip(self):
+		import zlib
+		uid_data = json.loads(self.post().data.decode())
+		resp = self.app.post(ENTRY_POINT + '/search', 
+			data=json.dumps(dict(self.payload, stream='json')), 
+			content_type = 'application/json',
+			headers={'Accept-Encoding': 'gzip'})
+		self.assertEquals(resp.headers['Content-Encoding'], 'gzip')
+		data = zlib.decompress(resp.data, 16 + zlib.MAX_WBITS)
+		self.assertEquals(json.loads(data.decode()), uid_data)
+
+
+class TestGeneSigClustergram(unittest.TestCase):
+	'''
+	Test the API making clustergram of genes x signatures
+	'''
+	uids = ['gene:27', 'gene:3046', 'drug:DM0', 'unknown']
+
+	def setUp(self):
+		self.app = app.test_client()
+
+	def test_get_matrix(self):
+		# the first request loads the globals
+		self.app.get(ENTRY_POINT + '/api?id=gene:27')
+		from creeds import uid_index
+		from creeds.utils import get_matrix
+		sig = uid_index['gene:27'][0]['gene:27']
+		up_genes, dn_genes = sig.fill_top_genes()
+		genes = [gene for gene, _ in up_genes[:3] + dn_genes[:3]] + ['NOT_A_GENE']
+		mat = get_matrix(self.uids, genes, uid_index, na_val=-99)
+		self.assertEquals(mat.shape, (7, 4))
+		self.assertTrue(np.allclose(mat[:6, 0], 
+			[val for _, val in up_genes[:3] + dn_genes[:3]]))
+		self.assertTrue(np.all(mat[6] == -99))
+		self.assertTrue(np.all(mat[:, 3] == -99))
+
+	def test_get_matrix_case_variants(self):
+		self.app.get(ENTRY_POINT + '/api?id=gene:27') # load the globals
+		import scipy.sparse as sp
+		from creeds.utils import get_matrix, GENES_I2CS
+		from creeds.orm import ALL_GENES_I
+		n_variants = np.diff(GENES_I2CS.indptr)
+		if not np.any(n_variants > 1):
+			self.skipTest('no gene with case variants')
+		i = np.flatnonzero(n_variants > 1)[0]
+		cs_cols = GENES_I2CS[i].indices[:2]
+
+		class Collection(object):
+			name = 'variants'
+			# values of two case variants of a gene in a single signature
+			mat_cs = sp.csr_matrix((np.array([0.5, -2.], dtype=np.float32), 
+				(np.zeros(2, dtype=np.int64), cs_cols)), shape=(1, GENES_I2CS.shape[1]))
+		mat = get_matrix(['sig:1'], [ALL_GENES_I[i]], {'sig:1': (Collection, 0)})
+		# one of the values is taken, not their sum
+		self.assertEquals(mat.tolist(), [[-2.]])
+
+	def test_clustergram(self):
+		resp = self.app.get(ENTRY_POINT + '/api?id=gene:27')
+		signature = json.loads(resp.data.decode())
+		genes = [gene for gene, _ in signature['up_genes'][:5] + signature['down_genes'][:5]]
+		resp = self.app.post(ENTRY_POINT + '/geneSigClustergram', 
+			data=json.dumps({'ids': self.uids[:3], 'genes': genes}),
+			content_type = 'application/json')
+		self.assertEquals(resp.status_code, 200)
+		links = json.loads(resp.data.decode())
+
+		resp = self.app.post(ENTRY_POINT + '/geneSigClustergram', 
+			data=json.dumps({'ids': self.uids[:3], 'genes': genes, 'format': 'compact'}),
+			content_type = 'application/json')
+		self.assertEquals(resp.status_code, 200)
+		compact = json.loads(resp.data.decode())
+		self.assertEquals(compact['values']['encoding'], 'float32')
+		values = np.array(compact['values']['data']).reshape(len(genes), 3)
+		# same ordering and values as the nodes and links
+		self.assertEquals([compact['row_names'][i] for i in compact['row_order']], 
+			[node['name'] for node in links['row_nodes']])
+		self.assertEquals([compact['col_names'][j] for j in compact['col_order']], 
+			[node['name'] for node in links['col_nodes']])
+		ordered = values[np.ix_(compact['row_order'], compact['col_order'])]
+		for link in links['links']:
+			self.assertAlmostEqual(ordered[link['source'], link['target']], link['value'], places=3)
+
+	def test_optimal_ordering(self):
+		from creeds.clustergram import cluster_order
+		# points on a line, average linkage leaves 2.5 after 4
+		data = np.array([[0.], [1.], [4.], [6.], [10.], [2.5]])
+		self.assertEquals(cluster_order(data).tolist(), [0, 1, 2, 5, 3, 4])
+		# adjacent leaves are the closest points
+		order = cluster_order(data, optimal_ordering=True)
+		self.assertEquals(order.tolist(), [0, 1, 5, 2, 3, 4])
+
+		resp = self.app.post(ENTRY_POINT + '/geneSigClustergram', 
+			data=json.dumps({'ids': self.uids[:3], 'genes': ['TP53', 'STAT3', 'MYC'],
+				'format': 'compact', 'optimal_ordering': True}),
+			content_type = 'application/json')
+		self.assertEquals(resp.status_code, 200)
+		compact = json.loads(resp.data.decode())
+		self.assertEquals(sorted(compact['col_order']), [0, 1, 2])
+
+	def test_clustergram_encodings(self):
+		from creeds.clustergram import encode_values
+		import base64
+		values = np.random.randn(20, 5)
+		encoded = encode_values(values, encoding='uint8')
+		levels = np.frombuffer(base64.b64decode(encoded['data']), dtype=np.uint8)
+		decoded = encoded['min'] + encoded['scale'] * levels
+		self.assertTrue(np.allclose(decoded, values.ravel(), atol=encoded['scale']))
+		encoded = encode_values(values, encoding='float16')
+		decoded = np.frombuffer(base64.b64decode(encoded['data']), dtype='<f2')
+		self.assertTrue(np.allclose(decoded, values.ravel(), atol=1e-2))
+
 
 class TestRetrieveUsingId(unittest.TestCase):
 	signature_id = 'gene:27'
@@ -126,6 +617,39 @@ class TestRetrieveUsingId(unittest.TestCase):
 		self.assertEquals(type(signature['ctrl_ids']), list)
 		self.assertEquals(type(signature['pert_ids']), list)
 
+	def test_retrieve_topn(self):
+		resp = self.app.get(ENTRY_POINT + '/api?id=%s&topn=10' % self.signature_id)
+		signature = json.loads(resp.data.decode())
+		self.assertEquals(len(signature['up_genes']) + len(signature['down_genes']), 10)
+
+	def test_retrieve_bulk(self):
+		resp = self.app.post(ENTRY_POINT + '/api', 
+			data=json.dumps({'ids': [self.signature_id, 'gene:3046', 'unknown']}),
+			content_type = 'application/json')
+		self.assertEquals(resp.status_code, 200)
+		self.assertEquals(resp.mimetype, 'application/json')
+		signatures = json.loads(resp.data.decode())
+		self.assertEquals(len(signatures), 3)
+		self.assertEquals([sig['id'] for sig in signatures[:2]], 
+			[self.signature_id, 'gene:3046'])
+		self.assertTrue(signatures[2] is None)
+
+		# Same as retrieving them one by one
+		resp = self.app.get(ENTRY_POINT + '/api?id=%s' % self.signature_id)
+		self.assertEquals(json.loads(resp.data.decode()), signatures[0])
+
+	def test_bad_retrieve(self):
+		for topn in ['abc', '0', '-1', '2.5']:
+			resp = self.app.get(ENTRY_POINT + '/api?id=%s&topn=%s' % (self.signature_id, topn))
+			self.assertEquals(resp.status_code, 400)
+		for data in [{'ids': [self.signature_id], 'topn': 'abc'}, 
+			{'ids': [self.signature_id], 'topn': 0}, {'ids': [{}]}, 
+			{'ids': self.signature_id}, [self.signature_id],
+			{'ids': [self.signature_id] * (app.config['API_MAX_IDS'] + 1)}]:
+			resp = self.app.post(ENTRY_POINT + '/api', 
+				data=json.dumps(data), content_type = 'application/json')
+			self.assertEquals(resp.status_code, 400)
+
 
 
 if __name__ == '__main__':
@@ -0,0 +1,132 @@
+import json
+import threading
+import unittest
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+from creeds import app
+
+ENTRY_POINT = '/CREEDS'
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+	'''
+	Stand-in for the PAEA and L1000CDS2 APIs, counting the posts received
+	'''
+	posts = []
+
+	def do_POST(self):
+		self.rfile.read(int(self.headers.getheader('content-length', 0)))
+		StandInHandler.posts.append(self.path)
+		if self.path == '/Enrichr/addList':
+			body = json.dumps({'userListId': 123})
+		elif self.path == '/L1000CDS2/query':
+			body = json.dumps({'shareId': 'abc'})
+		elif self.path == '/unavailable':
+			self.send_response(503)
+			self.end_headers()
+			return
+		else:
+			self.send_response(404)
+			self.end_headers()
+			return
+		self.send_response(200)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, *args):
+		pass
+
+
+class TestAppUrl(unittest.TestCase):
+	'''
+	Test urls of signatures posted to other apps are cached
+	'''
+	@classmethod
+	def setUpClass(cls):
+		cls.server = HTTPServer(('127.0.0.1', 0), StandInHandler)
+		thread = threading.Thread(target=cls.server.serve_forever)
+		thread.daemon = True
+		thread.start()
+		root = StandInHandler.root = 'http://127.0.0.1:%d' % cls.server.server_port
+		cls.config = {key: app.config[key] for key in ['PAEA_POST_URL', 'CDS2_POST_URL']}
+		app.config['PAEA_POST_URL'] = root + '/Enrichr/addList'
+		app.config['CDS2_POST_URL'] = root + '/L1000CDS2/query'
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.server.shutdown()
+		app.config.update(cls.config)
+
+	def setUp(self):
+		self.app = app.test_client()
+		from creeds.orm import APP_URL_CACHE
+		APP_URL_CACHE.clear()
+		del StandInHandler.posts[:]
+
+	def test_app_url(self):
+		resp = self.app.get(ENTRY_POINT + '/appUrl?id=gene:27&app=paea')
+		self.assertEquals(json.loads(resp.data.decode()),
+			app.config['PAEA_BASE_URL'] + '123')
+		resp = self.app.get(ENTRY_POINT + '/appUrl?id=gene:27&app=cds2')
+		self.assertEquals(json.loads(resp.data.decode()),
+			app.config['CDS2_BASE_URL'] + 'abc')
+		self.assertEquals(len(StandInHandler.posts), 2)
+		# repeated requests are served from the cache
+		resp = self.app.get(ENTRY_POINT + '/appUrl?id=gene:27&app=paea')
+		self.assertEquals(json.loads(resp.data.decode()),
+			app.config['PAEA_BASE_URL'] + '123')
+		self.assertEquals(len(StandInHandler.posts), 2)
+
+	def test_unknown(self):
+		resp = self.app.get(ENTRY_POINT + '/appUrl?id=unknown&app=paea')
+		self.assertEquals(json.loads(resp.data.decode()), None)
+		resp = self.app.get(ENTRY_POINT + '/appUrl?id=gene:27&app=unknown')
+		self.assertEquals(json.loads(resp.data.decode()), None)
+		self.assertEquals(len(StandInHandler.posts), 0)
+
+	def test_prefetch(self):
+		self.app.get(ENTRY_POINT + '/api?id=gene:27') # load the globals
+		from creeds import uid_index
+		from creeds.orm import prefetch_app_urls
+		urls = prefetch_app_urls(['gene:27', 'gene:3046'], uid_index)
+		self.assertEquals(len(urls), 4)
+		self.assertEquals(len(StandInHandler.posts), 4)
+		self.app.get(ENTRY_POINT + '/appUrl?id=gene:3046&app=cds2')
+		self.assertEquals(len(StandInHandler.posts), 4)
+
+	def test_refreshed_uid(self):
+		import creeds
+		from creeds.orm import ALL_UIDS_SET, APP_URL_HITS
+		self.app.get(ENTRY_POINT + '/api?id=gene:27') # load the globals
+		# pretend gene:27 was added to the DB and a removed uid is still known
+		dbsc = creeds.d_dbsc['v1.0']
+		del dbsc.source_state['gene:27']
+		ALL_UIDS_SET.discard('gene:27')
+		ALL_UIDS_SET.add('gene:removed')
+		creeds.refresh_collections()
+		self.assertIsNot(creeds.d_dbsc['v1.0'], dbsc)
+		self.assertNotIn('gene:removed', ALL_UIDS_SET)
+
+		hits = APP_URL_HITS['gene:27']
+		resp = self.app.get(ENTRY_POINT + '/appUrl?id=gene:27&app=paea')
+		self.assertEquals(json.loads(resp.data.decode()),
+			app.config['PAEA_BASE_URL'] + '123')
+		self.assertEquals(APP_URL_HITS['gene:27'], hits + 1)
+		# the cutoff is larger than the genes stored in the collection
+		resp = self.app.get(ENTRY_POINT + '/api?id=gene:27&topn=1000')
+		self.assertEquals(resp.status_code, 200)
+		self.assertEquals(json.loads(resp.data.decode())['id'], 'gene:27')
+		resp = self.app.get(ENTRY_POINT + '/api?id=gene:removed')
+		self.assertEquals(resp.status_code, 400)
+
+	def test_post_not_retried(self):
+		# posts reaching the app are not repeated on error responses
+		app.config['PAEA_POST_URL'] = StandInHandler.root + '/unavailable'
+		try:
+			resp = self.app.get(ENTRY_POINT + '/appUrl?id=gene:27&app=paea')
+		finally:
+			app.config['PAEA_POST_URL'] = StandInHandler.root + '/Enrichr/addList'
+		self.assertEquals(json.loads(resp.data.decode()), None)
+		self.assertEquals(StandInHandler.posts, ['/unavailable'])
@@ -0,0 +1,30 @@
+import unittest
+from creeds.cache import LRUCache
+
+class TestLRUCache(unittest.TestCase):
+	'''
+	Test the size bounded LRU cache.
+	'''
+	def setUp(self):
+		self.cache = LRUCache(10, sizeof=len)
+
+	def test_eviction(self):
+		self.cache.set('a', 'xxxx')
+		self.cache.set('b', 'xxxx')
+		# access 'a' so that 'b' is the least recently used
+		self.assertEquals(self.cache.get('a'), 'xxxx')
+		self.cache.set('c', 'xxxx')
+		self.assertTrue('a' in self.cache)
+		self.assertFalse('b' in self.cache)
+		self.assertEquals(self.cache.size, 8)
+		# values larger than the cache are not kept
+		self.cache.set('d', 'x' * 11)
+		self.assertFalse('d' in self.cache)
+		self.assertEquals(self.cache.get('d'), None)
+
+	def test_invalidate(self):
+		self.cache.set(('v1.0', 1), 'x')
+		self.cache.set(('DM', 1), 'x')
+		self.cache.invalidate(lambda key: key[0] == 'v1.0')
+		self.assertEquals(len(self.cache), 1)
+		self.assertEquals(self.cache.size, 1)
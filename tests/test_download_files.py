@@ -56,6 +56,64 @@ class TestDownloadFiles(unittest.TestCase):
 
 		self.assertEquals(len(d_gmt), 8)
 
+	def test_downloaded_gzip(self):
+		import gzip
+		plain = self.download_file('Single_gene_perturbations-v1.0.json')
+		resp = self.app.get(self.endpoint + 'Single_gene_perturbations-v1.0.json',
+			headers={'Accept-Encoding': 'gzip'})
+		self.assertEquals(resp.status_code, 200)
+		self.assertEquals(resp.headers['Content-Encoding'], 'gzip')
+		data = gzip.GzipFile(fileobj=StringIO(resp.data)).read()
+		self.assertEquals(json.loads(data), json.loads(plain.data))
+
+	def test_generation_stamp(self):
+		self.download_file('Single_gene_perturbations-v1.0.json') # load the globals
+		from creeds import d_dbsc
+		dbsc = d_dbsc['v1.0']
+		stamp_fn = '%s/%s.generation' % (dbsc.outfn_path, dbsc.name)
+		self.assertEquals(open(stamp_fn).read(), dbsc.generation)
+		# files of the same generation are not generated again
+		outfn = '%s/%s-%s.json' % (dbsc.outfn_path, dbsc.category2name['gene'], dbsc.name)
+		mtime = os.path.getmtime(outfn)
+		dbsc.make_all_download_files()
+		self.assertEquals(os.path.getmtime(outfn), mtime)
+
+	def test_make_all_download_files(self):
+		import shutil, tempfile
+		self.download_file('Single_gene_perturbations-v1.0.json') # load the globals
+		from creeds import d_dbsc
+		dbsc = d_dbsc['v1.0']
+		# generate the files into an empty dir without a stamp
+		mat_cs = dbsc.mat_cs
+		tmp_dir = tempfile.mkdtemp()
+		try:
+			dbsc.outfn_path = tmp_dir
+			dbsc.make_all_download_files(n_jobs=1)
+			for meta in dbsc.download_file_meta:
+				for filename in meta['filenames'].values():
+					self.assertTrue(os.path.isfile(os.path.join(tmp_dir, filename)))
+					self.assertTrue(os.path.isfile(os.path.join(tmp_dir, filename + '.gz')))
+			stamp_fn = '%s/%s.generation' % (tmp_dir, dbsc.name)
+			self.assertEquals(open(stamp_fn).read(), dbsc.generation)
+			outfn = '%s/%s-%s.json' % (tmp_dir, dbsc.category2name['gene'], dbsc.name)
+			docs = json.load(open(outfn))
+			self.assertEquals(len(docs), 4)
+
+			# files are generated again when only the CD values changed
+			dbsc.mat_cs = mat_cs * 2
+			dbsc.init_generation()
+			dbsc.make_all_download_files(n_jobs=1)
+			self.assertEquals(open(stamp_fn).read(), dbsc.generation)
+			docs2 = json.load(open(outfn))
+			self.assertEquals([val * 2 for _, val in docs[0]['up_genes']],
+				[val for _, val in docs2[0]['up_genes']])
+		finally:
+			if dbsc.mat_cs is not mat_cs:
+				dbsc.mat_cs = mat_cs
+				dbsc.init_generation()
+			del dbsc.outfn_path
+			shutil.rmtree(tmp_dir)
+
 
 
 if __name__ == '__main__':
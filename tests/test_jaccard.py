@@ -31,3 +31,195 @@ class TestJaccardIndex(unittest.TestCase):
 
 		self.assertEquals(j.shape, sj.shape)
 
+
+	def test_bitset_signed_jaccard(self):
+		bits_up = pack_rows(self.mat_up)
+		bits_dn = pack_rows(self.mat_dn)
+		# popcount of the packed rows should recover the row sums
+		self.assertTrue(np.array_equal(popcount(bits_up).sum(axis=0), 
+			self.mat_up.getnnz(axis=1)))
+
+		sj = fast_signed_jaccard(self.mat_up, self.mat_dn, 
+			self.vec_up, self.vec_dn)
+		sj_bitset = bitset_signed_jaccard(bits_up, bits_dn, 
+			self.mat_up.getnnz(axis=1), self.mat_dn.getnnz(axis=1),
+			self.vec_up, self.vec_dn)
+		# Assert the packed bitsets give the same scores as the csr matrices
+		self.assertTrue(np.allclose(sj, sj_bitset))
+
+	def test_jaccard_no_overflow(self):
+		## intersections > 127 should not overflow
+		mat = sp.csr_matrix(np.ones((2, 500), dtype=np.int8))
+		vec = np.ones(500, dtype=np.int8)
+		self.assertTrue(np.allclose(fast_jaccard(mat, vec), 1))
+
+	def test_batch_signed_jaccard(self):
+		qmat_up = sp.vstack([sp.csr_matrix(self.vec_up), self.mat_up[:3]]).tocsr()
+		qmat_dn = sp.vstack([sp.csr_matrix(self.vec_dn), self.mat_dn[:3]]).tocsr()
+		scores = batch_signed_jaccard(self.mat_up, self.mat_dn, qmat_up, qmat_dn)
+		self.assertEquals(scores.shape, (2000, 4))
+
+		# Assert each column equals scores of the single query
+		for j in range(4):
+			sj = fast_signed_jaccard(self.mat_up, self.mat_dn, 
+				qmat_up[j].toarray().ravel(), qmat_dn[j].toarray().ravel())
+			self.assertTrue(np.allclose(scores[:, j].toarray().ravel(), sj))
+
+	def test_top_k_indices(self):
+		scores = np.random.randn(1000)
+		srt_idx = scores.argsort()[::-1]
+		self.assertTrue(np.array_equal(top_k_indices(scores, 10), srt_idx[:10]))
+		self.assertTrue(np.array_equal(top_k_indices(scores), srt_idx))
+		self.assertEquals(len(top_k_indices(scores, 0)), 0)
+
+	def test_postings_signed_jaccard(self):
+		sj = fast_signed_jaccard(self.mat_up, self.mat_dn, 
+			self.vec_up, self.vec_dn)
+		sj_postings = postings_signed_jaccard(self.mat_up.tocsc(), self.mat_dn.tocsc(),
+			self.mat_up.getnnz(axis=1), self.mat_dn.getnnz(axis=1),
+			np.flatnonzero(self.vec_up), np.flatnonzero(self.vec_dn))
+		# Assert the inverted index gives the same scores as the matrix product
+		self.assertTrue(np.allclose(sj, sj_postings))
+
+	def test_minhash_lsh(self):
+		lsh = MinHashLSH(n_hashes=64, n_bands=32).fit(self.mat_up)
+		# A row is always a candidate for the set of its own genes
+		cols = self.mat_up[10].indices
+		self.assertTrue(10 in lsh.query(cols))
+		self.assertTrue(np.array_equal(lsh.sketch_rows(self.mat_up[10])[0], 
+			lsh.sketch_set(cols)))
+		self.assertEquals(len(lsh.query([])), 0)
+		self.assertTrue(len(lsh.query(cols, n_bands=1)) <= len(lsh.query(cols)))
+		self.assertTrue(np.allclose(lsh_collision_probability([0, 1], 2, 32), [0, 1]))
+
+	def test_minhash_trailing_empty_rows(self):
+		mat = sp.csr_matrix(np.array([[1,0,1,1,0,1], [0,1,0,0,1,1], 
+			[0,0,0,0,0,0], [0,0,0,0,0,0]], dtype=np.int8))
+		lsh = MinHashLSH(n_hashes=16, n_bands=8)
+		sketches = lsh.sketch_rows(mat)
+		for i in range(2):
+			self.assertTrue(np.array_equal(sketches[i], lsh.sketch_set(mat[i].indices)))
+		self.assertTrue(np.all(sketches[2:] == lsh.prime))
+		# empty rows in between and first
+		mat = sp.csr_matrix(np.array([[0,0,0], [0,1,1], [0,0,0], [1,0,1]], dtype=np.int8))
+		sketches = lsh.sketch_rows(mat)
+		self.assertTrue(np.array_equal(sketches[1], lsh.sketch_set([1, 2])))
+		self.assertTrue(np.array_equal(sketches[3], lsh.sketch_set([0, 2])))
+
+	def test_minhash_save_load(self):
+		import tempfile, shutil
+		lsh = MinHashLSH(n_hashes=64, n_bands=32).fit(self.mat_up)
+		tmpdir = tempfile.mkdtemp()
+		try:
+			lsh.save(os.path.join(tmpdir, 'up'))
+			lsh2 = MinHashLSH(n_hashes=64, n_bands=32).load(os.path.join(tmpdir, 'up'))
+			cols = self.mat_up[10].indices
+			self.assertTrue(np.array_equal(lsh.query(cols), lsh2.query(cols)))
+		finally:
+			shutil.rmtree(tmpdir)
+
+	def test_weighted_similarity(self):
+		from sklearn.metrics.pairwise import cosine_similarity
+		mat = (self.mat_up - self.mat_dn).astype(np.float32)
+		vec = np.random.randn(mat.shape[1])
+		cos = sparse_cosine(mat, row_norms(mat), vec)
+		self.assertTrue(np.allclose(cos, 
+			cosine_similarity(mat, vec.reshape(1, -1)).ravel()))
+
+		# with values of 1 and -1, the weights of up minus down genes
+		wso = weighted_signed_overlap(mat, row_max_abs(mat), vec)
+		self.assertTrue(np.all(np.abs(wso) <= 1))
+		self.assertTrue(np.allclose(wso, (self.mat_up.dot(vec) - self.mat_dn.dot(vec)) / 
+			np.abs(vec).sum()))
+		# values are scaled by the max absolute value of each row
+		mat_w = mat.multiply(np.random.rand(*mat.shape) + 1).tocsr()
+		wso = weighted_signed_overlap(mat_w, row_max_abs(mat_w), vec)
+		self.assertTrue(np.all(np.abs(wso) <= 1))
+		self.assertTrue(np.allclose(wso[:1], mat_w[0].dot(vec) / 
+			(np.abs(mat_w[0].data).max() * np.abs(vec).sum())))
+
+		# by hand: the values (2, -1, 0) with the query (1, 1, 1)
+		mat = sp.csr_matrix(np.array([[2, -1, 0], [0, 0, 0]], dtype=np.float32))
+		vec = np.ones(3)
+		self.assertTrue(np.allclose(weighted_signed_overlap(mat, row_max_abs(mat), vec),
+			[(2 - 1) / 2. / 3, 0]))
+		self.assertTrue(np.allclose(sparse_cosine(mat, row_norms(mat), vec), 
+			[1 / np.sqrt(5) / np.sqrt(3), 0]))
+		# the norm of the query can be given
+		self.assertTrue(np.allclose(sparse_cosine(mat, row_norms(mat), vec, vec_norm=1.), 
+			[1 / np.sqrt(5), 0]))
+
+	def test_max_abs_merge_columns(self):
+		# columns 0 and 2 are variants of the same column, column 3 is dropped
+		mat = sp.csr_matrix(np.array([[2, 0, -3, 1], [0, 5, 1, 0], [-1, 0, 0, 4]], 
+			dtype=np.float32))
+		merged = max_abs_merge_columns(mat, np.array([0, 1, 0, -1]), 2)
+		self.assertEquals(merged.shape, (3, 2))
+		self.assertTrue(np.array_equal(merged.toarray(), [[-3, 0], [1, 5], [-1, 0]]))
+
+	def test_signed_jaccard_matrix(self):
+		import tempfile, shutil
+		from creeds.pairwise import signed_jaccard_matrix
+		tmpdir = tempfile.mkdtemp()
+		try:
+			outfn = os.path.join(tmpdir, 'signed_jaccard.npy')
+			mat = signed_jaccard_matrix(self.mat_up[:100], self.mat_dn[:100], outfn,
+				block_size=30, n_jobs=2, verbose=False)
+			self.assertEquals(mat.shape, (100, 100))
+			sj = fast_signed_jaccard(self.mat_up[:100], self.mat_dn[:100], 
+				self.mat_up[5].toarray().ravel(), self.mat_dn[5].toarray().ravel())
+			self.assertTrue(np.allclose(mat[5], sj, atol=1e-6))
+			self.assertTrue(np.allclose(mat, mat.T, atol=1e-6))
+		finally:
+			shutil.rmtree(tmpdir)
+
+	def test_sharded_scorer(self):
+		import tempfile, shutil
+		from creeds.executor import ShardedScorer, select_scores
+		class Collection(object):
+			name = 'test'
+			generation = '0'
+		dbsc = Collection()
+		dbsc.mat_up, dbsc.mat_dn = self.mat_up, self.mat_dn
+		tmpdir = tempfile.mkdtemp()
+		scorer = ShardedScorer(2, tmpdir, shards_per_worker=2)
+		try:
+			scorer.register(dbsc)
+			self.assertTrue(scorer.has(dbsc))
+			scores = fast_signed_jaccard(self.mat_up, self.mat_dn, self.vec_up, self.vec_dn)
+			for direction in ['similar', 'opposite']:
+				idx = select_scores(scores, direction, 20)
+				rows, top_scores = scorer.top_signed_jaccard(dbsc, 
+					self.vec_up, self.vec_dn, direction, 20)
+				self.assertTrue(np.allclose(top_scores, scores[idx]))
+
+			# a new generation is registered without removing the old one
+			new_dbsc = Collection()
+			new_dbsc.generation = '1'
+			new_dbsc.mat_up, new_dbsc.mat_dn = self.mat_dn, self.mat_up
+			scorer.register(new_dbsc)
+			self.assertTrue(scorer.has(dbsc))
+			self.assertTrue(scorer.has(new_dbsc))
+			old_dirs = [shard_dir for shard_dir, _ in scorer.shards[('test', '0')]]
+			# shards left by a previous process are removed right away
+			stale_dir = os.path.join(tmpdir, 'test-stale-0')
+			os.makedirs(stale_dir)
+			# retired shards in use are only removed once released
+			scorer._acquire([dbsc])
+			scorer.retire('test', '1')
+			self.assertFalse(os.path.isdir(stale_dir))
+			self.assertTrue(all(os.path.isdir(shard_dir) for shard_dir in old_dirs))
+			scorer._release([dbsc])
+			self.assertFalse(scorer.has(dbsc))
+			self.assertFalse(any(os.path.isdir(shard_dir) for shard_dir in old_dirs))
+			self.assertEquals(set(old_dirs) - set(scorer.evicted), set())
+			# queries on unregistered generations fall back to the caller
+			self.assertIsNone(scorer.top_signed_jaccard(dbsc, 
+				self.vec_up, self.vec_dn, 'similar', 20))
+			rows, top_scores = scorer.top_signed_jaccard(new_dbsc, 
+				self.vec_up, self.vec_dn, 'similar', 20)
+			scores = fast_signed_jaccard(self.mat_dn, self.mat_up, self.vec_up, self.vec_dn)
+			self.assertTrue(np.allclose(top_scores, scores[select_scores(scores, 'similar', 20)]))
+		finally:
+			scorer.close()
+			shutil.rmtree(tmpdir)
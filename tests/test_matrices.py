@@ -0,0 +1,82 @@
+import copy
+import unittest
+import numpy as np
+import scipy.sparse as sp
+# Assumes env var for config is set
+from creeds import app
+from creeds.orm import (COLL, PROJECTION_EXCLUDE, ALL_GENES, ALL_GENES_I,
+	DBSignature, wrapper_func, signatures_to_matrices)
+from creeds.matrix_ops import binary_csr
+
+class TestSignaturesToMatrices(unittest.TestCase):
+	'''
+	Test the matrices assembled from the gene indexes of all signatures at once
+	are the same as those stacked from the vectors of each signature
+	'''
+	def setUp(self):
+		self.docs = [COLL.find_one({'id': uid}, PROJECTION_EXCLUDE)
+			for uid in ['gene:27', 'gene:3046', 'drug:DM0']]
+		# a signature with repeated genes, case variants and missing genes
+		doc = copy.deepcopy(self.docs[0])
+		doc['id'] = 'gene:test'
+		chdir = doc[DBSignature.chdir_field]
+		genes, vals = chdir['genes'][:20], chdir['vals'][:20]
+		chdir['genes'] = genes[:5] + genes[:2] + [genes[2].lower()] + \
+			['NOT_A_GENE', 'not_a_gene_either'] + genes[5:]
+		chdir['vals'] = vals[:5] + [-1., 1.] + [vals[2], 1., -1.] + vals[5:]
+		self.docs.append(doc)
+
+	def vector_indexes(self, chdir, cutoff=600):
+		## boolean vectors of the up and down genes over ALL_GENES_I,
+		## the first value of each case insensitive gene is taken
+		genes_i = np.array([gene.upper() for gene in chdir['genes'][:cutoff]])
+		genes_i, uniq_idx = np.unique(genes_i, return_index=True)
+		vals = np.array(chdir['vals'][:cutoff])[uniq_idx]
+		up_idx = np.in1d(ALL_GENES_I, genes_i[vals > 0], assume_unique=True)
+		dn_idx = np.in1d(ALL_GENES_I, genes_i[vals < 0], assume_unique=True)
+		return up_idx, dn_idx
+
+	def stacked_matrices(self, docs, cutoff=600):
+		## the matrices stacked from the vectors of each signature
+		rows_up, rows_dn, rows_cs = [], [], []
+		for doc in docs:
+			sig = DBSignature(None, doc=copy.deepcopy(doc))
+			up_idx, dn_idx = self.vector_indexes(sig.chdir, cutoff=cutoff)
+			sig.init_cs_vectors(cutoff=cutoff)
+			rows_up.append(up_idx)
+			rows_dn.append(dn_idx)
+			rows_cs.append(sig.v_cs)
+		mat_up = sp.csr_matrix(np.vstack(rows_up).astype(np.int8))
+		mat_dn = sp.csr_matrix(np.vstack(rows_dn).astype(np.int8))
+		mat_cs = sp.vstack(rows_cs, format='csr')
+		return mat_up, mat_dn, mat_cs
+
+	def test_matrices(self):
+		tuple_list = [wrapper_func(i, copy.deepcopy(doc))
+			for i, doc in enumerate(self.docs)]
+		uids, mat_up, mat_dn, mat_cs = signatures_to_matrices(tuple_list)
+		self.assertEquals(uids, [doc['id'] for doc in self.docs])
+		self.assertEquals(mat_up.shape, (len(self.docs), len(ALL_GENES_I)))
+		self.assertEquals(mat_cs.shape, (len(self.docs), len(ALL_GENES)))
+		# binary matrices even with repeated genes and case variants
+		self.assertTrue(np.all(mat_up.data == 1))
+		self.assertTrue(np.all(mat_dn.data == 1))
+
+		mat_up2, mat_dn2, mat_cs2 = self.stacked_matrices(self.docs)
+		self.assertEquals((mat_up != mat_up2).nnz, 0)
+		self.assertEquals((mat_dn != mat_dn2).nnz, 0)
+		self.assertTrue(np.allclose(mat_cs.toarray(), mat_cs2.toarray()))
+
+	def test_empty(self):
+		uids, mat_up, mat_dn, mat_cs = signatures_to_matrices([])
+		self.assertEquals(uids, [])
+		self.assertEquals(mat_up.shape, (0, len(ALL_GENES_I)))
+		self.assertEquals(mat_cs.nnz, 0)
+
+	def test_binary_csr(self):
+		mat = binary_csr(np.array([0, 0, 1]), np.array([2, 2, 0]), (2, 3))
+		self.assertEquals(mat.toarray().tolist(), [[0, 0, 1], [1, 0, 0]])
+
+
+if __name__ == '__main__':
+	unittest.main()
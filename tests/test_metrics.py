@@ -0,0 +1,52 @@
+import json
+import unittest
+
+from creeds import app
+from creeds.metrics import Metrics, NULL_TIMER
+
+ENTRY_POINT = '/CREEDS'
+
+
+class TestMetrics(unittest.TestCase):
+	'''
+	Test timing stages and rendering metrics in the Prometheus text format
+	'''
+	def test_stages(self):
+		metrics = Metrics()
+		metrics.start_request()
+		with metrics.stage('score'):
+			pass
+		stages = metrics.end_request('search')
+		self.assertEquals([name for name, _ in stages], ['score'])
+		text = metrics.render()
+		self.assertIn('creeds_stage_seconds_count{stage="score"} 1', text)
+		self.assertIn('creeds_request_seconds_bucket{endpoint="search",le="+Inf"} 1', text)
+
+	def test_disabled(self):
+		metrics = Metrics(enabled=False)
+		self.assertIs(metrics.stage('score'), NULL_TIMER)
+		metrics.start_request()
+		with metrics.stage('score'):
+			pass
+		self.assertEquals(metrics.end_request('search'), [])
+		self.assertEquals(metrics.render(), '\n')
+
+
+class TestMetricsEndpoint(unittest.TestCase):
+	def setUp(self):
+		self.app = app.test_client()
+
+	def test_metrics(self):
+		resp = self.app.get(ENTRY_POINT + '/api?id=gene:27')
+		resp = self.app.post(ENTRY_POINT + '/search', 
+			data=json.dumps({'up_genes': ['KIAA0907', 'KDM5A', 'CDC25A'], 
+				'dn_genes': ['LOC100130269', 'PTPRF', 'MTHFS'], 'client': 'api'}),
+			content_type = 'application/json')
+		self.assertIn('save_signature;dur=', resp.headers['Server-Timing'])
+		resp = self.app.get(ENTRY_POINT + '/metrics')
+		self.assertEquals(resp.status_code, 200)
+		self.assertEquals(resp.mimetype, 'text/plain')
+		text = resp.data.decode()
+		self.assertIn('creeds_request_seconds_count{endpoint="retrieve_signature"}', text)
+		self.assertIn('creeds_cache_hits_total{cache="api"}', text)
+		self.assertIn('creeds_collection_signatures{collection="v1.0"} 4.0', text)
@@ -0,0 +1,30 @@
+import unittest
+from creeds.name_index import NameIndex
+
+class TestNameIndex(unittest.TestCase):
+	'''
+	Test substring and prefix search of names
+	'''
+	def setUp(self):
+		self.items = ['gene:1', 'gene:2', 'dz:1', 'drug:1', 'drug:2']
+		names_list = [['TP53'], ['TP53BP1', 'Trp53bp1'], ['breast cancer'], 
+			['doxorubicin', 'Adriamycin'], []]
+		self.index = NameIndex(self.items, names_list)
+
+	def test_substring(self):
+		self.assertEquals(self.index.search('tp53'), ['gene:1', 'gene:2'])
+		self.assertEquals(self.index.search('53B'), ['gene:2'])
+		self.assertEquals(self.index.search('cancer'), ['dz:1'])
+		self.assertEquals(self.index.search('rubi'), ['drug:1'])
+		self.assertEquals(self.index.search('xyz'), [])
+		# queries shorter than the n-grams
+		self.assertEquals(self.index.search('tp'), ['gene:1', 'gene:2'])
+
+	def test_ranking(self):
+		# prefix of a word ranks before other substrings
+		self.assertEquals(self.index.search('c'), ['dz:1', 'drug:1'])
+		self.assertEquals(self.index.search('', limit=2), ['gene:1', 'gene:2'])
+
+	def test_prefix(self):
+		self.assertEquals(self.index.search('adria', prefix=True), ['drug:1'])
+		self.assertEquals(self.index.search('cancer', prefix=True), [])
@@ -0,0 +1,99 @@
+import unittest
+import numpy as np
+from bson import json_util
+# Assumes env var for config is set
+from creeds import app
+from creeds.orm import DBSignatureCollection, DBSignatureCollectionGroup
+
+class TestRefresh(unittest.TestCase):
+	'''
+	Test incremental refresh of DBSignatureCollection
+	'''
+	def setUp(self):
+		params = app.config['DBSC_PARAMS'][0].copy()
+		params['name'] = 'refresh_test'
+		self.dbsc = DBSignatureCollection(**params)
+
+	def assertSameRows(self, dbsc1, dbsc2):
+		for uid in dbsc1.uids:
+			i, j = dbsc1.uids.index(uid), dbsc2.uids.index(uid)
+			for key in ('mat_up', 'mat_dn', 'mat_cs'):
+				self.assertEquals((getattr(dbsc1, key)[i] != getattr(dbsc2, key)[j]).nnz, 0)
+
+	def test_no_change(self):
+		self.assertTrue(self.dbsc.refresh() is None)
+
+	def test_refresh(self):
+		dbsc = self.dbsc
+		# pretend one signature was added and another one changed since loading
+		added, changed = dbsc.uids[0], dbsc.uids[1]
+		del dbsc.source_state[added]
+		oid, _ = dbsc.source_state[changed]
+		dbsc.source_state[changed] = (oid, 'outdated')
+		new_dbsc = dbsc.refresh()
+
+		self.assertEquals(set(new_dbsc.uids), set(dbsc.uids))
+		self.assertEquals(set(new_dbsc.uids[-2:]), set([added, changed]))
+		self.assertNotEquals(new_dbsc.generation, dbsc.generation)
+		self.assertSameRows(dbsc, new_dbsc)
+		self.assertTrue(new_dbsc.refresh() is None)
+		# the old generation is left untouched
+		self.assertEquals(dbsc.uids[:2], [added, changed])
+
+	def test_refresh_limit(self):
+		params = dict(app.config['DBSC_PARAMS'][0], name='refresh_test_limit', limit=2)
+		dbsc = DBSignatureCollection(**params)
+		self.assertEquals(len(dbsc), 2)
+		# pretend all the signatures changed since loading
+		dbsc.source_state = {}
+		new_dbsc = dbsc.refresh()
+		self.assertEquals(sorted(new_dbsc.uids), sorted(dbsc.uids))
+
+	def test_rebuild_groups(self):
+		dbsc = self.dbsc
+		params = dict(app.config['DBSC_PARAMS'][1], name='refresh_test_dm')
+		other = DBSignatureCollection(**params)
+		DBSignatureCollectionGroup.get([dbsc, other])
+		dbsc.source_state[dbsc.uids[0]] = (dbsc.source_state[dbsc.uids[0]][0], 'outdated')
+		new_dbsc = dbsc.refresh()
+		d_dbsc = {dbsc.name: new_dbsc, other.name: other}
+		DBSignatureCollectionGroup.rebuild(d_dbsc)
+		cache = DBSignatureCollectionGroup.cache
+		# the group of the new generation replaced the old one
+		self.assertTrue(DBSignatureCollectionGroup.make_key([new_dbsc, other]) in cache)
+		self.assertFalse(DBSignatureCollectionGroup.make_key([dbsc, other]) in cache)
+
+	def test_generation(self):
+		dbsc = self.dbsc
+		generation = dbsc.generation
+		# the same content in another layout of the matrices
+		mat_cs = dbsc.mat_cs
+		dbsc.mat_cs = mat_cs.copy()
+		for i in xrange(dbsc.mat_cs.shape[0]):
+			start, end = dbsc.mat_cs.indptr[i:i+2]
+			dbsc.mat_cs.indices[start:end] = dbsc.mat_cs.indices[start:end][::-1]
+			dbsc.mat_cs.data[start:end] = dbsc.mat_cs.data[start:end][::-1]
+		dbsc.mat_cs.has_sorted_indices = False
+		dbsc.init_generation()
+		self.assertEquals(dbsc.generation, generation)
+
+		# only the CD values changed
+		dbsc.mat_cs = mat_cs.copy()
+		dbsc.mat_cs.data[0] *= 2
+		dbsc.init_generation()
+		self.assertNotEquals(dbsc.generation, generation)
+		dbsc.mat_cs = mat_cs
+		dbsc.init_generation()
+		self.assertEquals(dbsc.generation, generation)
+
+		# only the meta data changed
+		meta = json_util.loads(dbsc.metas[0])
+		meta['hs_gene_symbol'] = 'CHANGED'
+		dbsc.metas[0] = json_util.dumps(meta, sort_keys=True)
+		dbsc.init_signatures()
+		dbsc.init_generation()
+		self.assertNotEquals(dbsc.generation, generation)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,126 @@
+import os
+import json
+import datetime
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from bson import json_util
+# Assumes env var for config is set
+from creeds import app
+from creeds.orm import DBSignatureCollection, DBSignature
+
+class TestSnapshot(unittest.TestCase):
+	'''
+	Test DBSignatureCollection loaded from a snapshot is the same as from the DB
+	'''
+	def setUp(self):
+		self.snapshot_dir = tempfile.mkdtemp()
+		self.snapshot_dir_orig = app.config.get('SNAPSHOT_DIR')
+		app.config['SNAPSHOT_DIR'] = self.snapshot_dir
+		self.params = app.config['DBSC_PARAMS'][0]
+
+	def tearDown(self):
+		app.config['SNAPSHOT_DIR'] = self.snapshot_dir_orig
+		shutil.rmtree(self.snapshot_dir)
+
+	def test_snapshot(self):
+		dbsc = DBSignatureCollection(**self.params)
+		path = os.path.join(self.snapshot_dir, dbsc.name)
+		self.assertTrue(os.path.isfile(os.path.join(path, 'snapshot.json')))
+
+		dbsc2 = DBSignatureCollection(**self.params)
+		# matrices are memory-mapped from the snapshot
+		self.assertTrue(isinstance(dbsc2.mat_up.indices, np.memmap))
+		self.assertEquals(dbsc.uids, dbsc2.uids)
+		self.assertEquals(dbsc.generation, dbsc2.generation)
+		for key in ('mat_up', 'mat_dn', 'mat_cs'):
+			self.assertEquals((getattr(dbsc, key) != getattr(dbsc2, key)).nnz, 0)
+		for uid in dbsc.uids:
+			self.assertEquals(dbsc[uid].name, dbsc2[uid].name)
+			self.assertEquals(dbsc[uid].fill_top_genes(), dbsc2[uid].fill_top_genes())
+
+	def test_lsh_snapshot(self):
+		params = dict(app.config['DBSC_PARAMS'][2])
+		dbsc = DBSignatureCollection(**params)
+		path = os.path.join(self.snapshot_dir, dbsc.name)
+		self.assertTrue(os.path.isfile(os.path.join(path, 'lsh.json')))
+
+		dbsc2 = DBSignatureCollection(**params)
+		# LSH tables are memory-mapped from the snapshot
+		self.assertTrue(isinstance(dbsc2.lsh_up.sorted_keys, np.memmap))
+		self.assertEquals(dbsc.lsh_params, dbsc2.lsh_params)
+		for lsh, lsh2 in [(dbsc.lsh_up, dbsc2.lsh_up), (dbsc.lsh_dn, dbsc2.lsh_dn)]:
+			self.assertTrue(np.array_equal(lsh.sorted_keys, lsh2.sorted_keys))
+
+		# built again with other params
+		params['lsh'] = {'n_hashes': 64, 'n_bands': 32}
+		dbsc3 = DBSignatureCollection(**params)
+		self.assertFalse(isinstance(dbsc3.lsh_up.sorted_keys, np.memmap))
+		self.assertEquals(dbsc3.lsh_up.n_bands, 32)
+
+	def test_signature_views(self):
+		dbsc = DBSignatureCollection(**self.params)
+		for i, uid in enumerate(dbsc.uids):
+			sig = dbsc[uid]
+			self.assertFalse(hasattr(sig, '__dict__'))
+			self.assertEquals(sig.meta['id'], uid)
+			# same CD values as the signature retrieved from the DB
+			sig_db = DBSignature(uid)
+			sig_db.init_cs_vectors()
+			self.assertEquals(sig.fill_top_genes(), sig_db.fill_top_genes())
+			self.assertEquals(sig.get_url(), sig_db.get_url())
+			# query results are formatted from the columns of meta data
+			uid_data = dbsc.result_meta([i], [0.5])[0]
+			self.assertEquals(uid_data, {'id': uid, 'geo_id': sig_db.meta['geo_id'],
+				'name': [sig_db.name, sig_db.get_url()], 'signed_jaccard': 0.5})
+
+	def test_edited_snapshot(self):
+		dbsc = DBSignatureCollection(**self.params)
+		uid = dbsc.uids[0]
+		# the snapshot was saved before the document was edited in place 
+		# while the app was down, with its meta data and `time` back then
+		path = os.path.join(self.snapshot_dir, dbsc.name)
+		meta = json_util.loads(dbsc.metas[0])
+		meta['hs_gene_symbol'] = meta['mm_gene_symbol'] = 'EDITED'
+		meta_edited = json_util.dumps(meta, sort_keys=True)
+		with open(os.path.join(path, 'signatures.jsonl'), 'wb') as out:
+			for meta in [meta_edited] + dbsc.metas[1:]:
+				out.write(meta + '\n')
+		source_state = dict(dbsc.source_state)
+		source_state[uid] = (source_state[uid][0], datetime.datetime(2000, 1, 1))
+		with open(os.path.join(path, 'snapshot.json')) as f:
+			snapshot_meta = json.load(f)
+		snapshot_meta['fingerprint'] = dbsc.source_fingerprint(source_state)
+		with open(os.path.join(path, 'snapshot.json'), 'wb') as out:
+			json.dump(snapshot_meta, out)
+
+		# the snapshot is outdated
+		dbsc2 = DBSignatureCollection(**self.params)
+		self.assertFalse(isinstance(dbsc2.mat_up.indices, np.memmap))
+		self.assertEquals(dbsc2[uid].name, dbsc[uid].name)
+		self.assertEquals(dbsc2.generation, dbsc.generation)
+		# and saved again
+		dbsc3 = DBSignatureCollection(**self.params)
+		self.assertTrue(isinstance(dbsc3.mat_up.indices, np.memmap))
+
+		# a collection loaded before the edit reloads the document on refresh
+		dbsc3.source_state = source_state
+		dbsc3.metas[0] = meta_edited
+		dbsc3.init_signatures()
+		self.assertEquals(dbsc3[uid].name, 'EDITED')
+		dbsc4 = dbsc3.refresh()
+		self.assertEquals(dbsc4[uid].name, dbsc[uid].name)
+
+	def test_outdated_snapshot(self):
+		dbsc = DBSignatureCollection(**self.params)
+		params = self.params.copy()
+		params['limit'] = 1
+		# a different source fingerprint rebuilds the snapshot
+		dbsc2 = DBSignatureCollection(**params)
+		self.assertEquals(len(dbsc2), 1)
+		self.assertFalse(isinstance(dbsc2.mat_up.indices, np.memmap))
+
+
+if __name__ == '__main__':
+	unittest.main()